@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Builds the memory-mapped airport index the queue consumers use for landing checks."""
+
+from csv import reader
+import sys
+
+from shared.airport_index import build_index
+
+airport_csv_path = './data/ourairports-2017_02_19.csv'
+airport_index_path = './data/airports.idx'
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def read_airports(csv_path):
+    """Returns (airport ID, latitude, longitude) for every row of the ourairports CSV with a position."""
+    airports = []
+    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+        for row in reader(csvfile, delimiter=','):
+            if is_number(row[4]) and is_number(row[5]):
+                airports.append((row[0], float(row[4]), float(row[5])))  # airportID, lat, long
+    return airports
+
+
+if __name__ == '__main__':
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else airport_csv_path
+    index_path = sys.argv[2] if len(sys.argv) > 2 else airport_index_path
+    airport_count = build_index(read_airports(csv_path), index_path)
+    print("Indexed", airport_count, "airports from", csv_path, "into", index_path)
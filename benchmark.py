@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic-load benchmarks for the converter -> queue consumer pipeline.
+
+Runs converter.py and queue-consumer.py in process against the stand-ins in
+shared/standins.py, fed with snapshots from shared/synthetic_vrs.py. Each stage
+is timed on its own, and the whole pipeline end to end, in a fresh forked
+process so peak RSS is per stage:
+
+scanner     flight_snapshot_scanner + publishing frames, per poll
+merger      flight_merger, per snippet
+bearings    calculate_bearings_and_turns, per snippet track
+landing     find_landings (rolling tracks, airport lookups) per merged snippet
+stale       clean_stale_flights sweeping every flight, per sweep
+publish     pull_surveillance_flights, per marker
+end_to_end  scan, queue and consume a poll including its FileTime marker
+
+Results are compared with a stored baseline (--baseline); a stage whose
+throughput drops or whose p99 latency rises by more than --tolerance is
+reported as a regression and the exit status is 1. --save-baseline records
+the current run instead.
+
+    python3 benchmark.py --aircraft 5000 --polls 5
+"""
+
+import argparse
+import copy
+import json
+import logging
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from shared.airport_index import AirportIndex, build_index
+from shared.bearing_engine import calculate_bearings_and_turns
+from shared.flight_cache import CachedFlightUpdater
+from shared.s3_publisher import SnapshotPublisher
+from shared.standins import MemoryBackend, MemoryChannel, MemoryMongo, MemoryRedis, MemoryRedisData, load_script, repository
+from shared.synthetic_vrs import SyntheticSky
+from shared.track_store import TrackStore
+from shared.wire_format import decode_frame, is_frame
+
+stages = ('scanner', 'merger', 'bearings', 'landing', 'stale', 'publish', 'end_to_end')
+default_baseline = os.path.join(repository, 'benchmark-baseline.json')
+publish_warm_polls = 10
+
+
+class Timings(object):
+    """Durations of repeated calls and the number of items they processed."""
+
+    def __init__(self):
+        self.durations = []
+        self.items = 0
+
+    def time(self, function, *args, items=1):
+        started = time.perf_counter()
+        result = function(*args)
+        self.durations.append(time.perf_counter() - started)
+        self.items += items
+        return result
+
+    def report(self):
+        durations = np.array(self.durations) if len(self.durations) > 0 else np.zeros(1)
+        total = float(durations.sum())
+        return {'calls': len(self.durations),
+                'items': self.items,
+                'items_per_second': self.items / total if total > 0 else 0.0,
+                'p50_ms': float(np.percentile(durations, 50)) * 1000,
+                'p99_ms': float(np.percentile(durations, 99)) * 1000,
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+class Pipeline(object):
+    """The converter and consumer modules wired to in-process stand-ins."""
+
+    def __init__(self, options):
+        self.options = options
+        self.converter = load_script('converter', 'converter.py')
+        self.consumer = load_script('queue_consumer', 'queue-consumer.py')
+        self.converter.build_geofence()
+        if not options.debug_logging:
+            logging.getLogger().setLevel(logging.WARNING)
+        self.sky = SyntheticSky(options.aircraft, options.trail_points, surveillance_fraction=options.surveillance_fraction,
+                                seed=options.seed)
+        self.channel = MemoryChannel()
+        self.converter.connect_channel(self.channel)
+        data = MemoryRedisData()
+        self.r = MemoryRedis(data, decode_responses=True)
+        # MemoryRedis has no Lua, so commits take the WATCH/MULTI path
+        self.updater = CachedFlightUpdater(TrackStore(MemoryRedis(data)), False, self.consumer.flight_cache_size,
+                                           self.consumer.write_batch_size)
+        self.dbmongo = MemoryMongo()
+        self.consumer.snapshot_publisher = SnapshotPublisher(MemoryBackend(), self.consumer.publish_threads)
+        self.index_file = tempfile.NamedTemporaryFile(suffix='.idx')
+        build_index(self.sky.airports(), self.index_file.name)
+        self.consumer.airport_index = AirportIndex(self.index_file.name)
+
+    def scan(self, snapshot=None):
+        """Scans one poll onto the queues; returns the number of snippets published."""
+        snapshot = snapshot or self.sky.snapshot()
+        flights = self.converter.flight_snapshot_scanner(snapshot)
+        self.converter.flush_snippet_batch()
+        return len(flights['meta']['IcaoDict'])
+
+    def mark(self):
+        self.converter.enqueue_time_marker(self.sky.time)
+
+    def messages(self):
+        """Drains every queue, yielding (method, properties, body)."""
+        for queue in list(self.channel.queues):
+            for message in self.channel.drain(queue):
+                yield message
+
+    def consume(self):
+        for method, properties, body in self.messages():
+            self.consumer.callback(self.channel, method, properties, body, self.r, self.updater, self.dbmongo)
+
+    def snippets(self):
+        """Drains the queues and returns the snippets they held."""
+        snippets = []
+        for method, properties, body in self.messages():
+            if is_frame(body):
+                snippets.extend(decode_frame(body))
+            elif b'FileTime' not in body:
+                snippets.append(json.loads(body.decode()))
+        return snippets
+
+    def warm(self, polls):
+        """Runs polls through the whole pipeline so redis holds a realistic set of flights."""
+        for _ in range(polls):
+            self.scan()
+            self.consume()
+        self.updater.flush()
+
+    def tracked(self):
+        return self.r.zrange('flight_scan_times', 0, -1)
+
+
+def run_scanner(pipeline, options, timings):
+    for _ in range(options.polls):
+        snapshot = pipeline.sky.snapshot()
+        timings.time(lambda: pipeline.scan(snapshot), items=len(snapshot['acList']))
+        pipeline.channel.queues.clear()
+
+
+def run_merger(pipeline, options, timings):
+    for _ in range(options.polls):
+        pipeline.scan()
+        for snippet in pipeline.snippets():
+            timings.time(pipeline.consumer.flight_merger, snippet, pipeline.r, pipeline.updater, pipeline.dbmongo)
+    pipeline.updater.flush()
+
+
+def run_bearings(pipeline, options, timings):
+    for _ in range(options.polls):
+        pipeline.scan()
+        for snippet in pipeline.snippets():
+            coordinates = copy.deepcopy(snippet['geometry']['coordinates'])
+            timings.time(calculate_bearings_and_turns, coordinates, coordinates[0], pipeline.consumer.bearing_mode)
+
+
+def run_landing(pipeline, options, timings):
+    pipeline.warm(pipeline.consumer.landing_check_scans)  # so checks come due during the timed polls
+    for _ in range(options.polls):
+        pipeline.scan()
+        snippets = [snippet for snippet in pipeline.snippets() if pipeline.consumer.useful_snippet(snippet)]
+        pipeline.updater.load_heads([snippet['Icao'] for snippet in snippets])  # as flight_merger_bulk does first
+        timings.time(pipeline.consumer.find_landings, snippets, pipeline.updater, pipeline.r, items=len(snippets))
+        pipeline.consumer.flight_merger_bulk(snippets, pipeline.r, pipeline.updater, pipeline.dbmongo)
+        pipeline.updater.flush()
+
+
+def run_stale(pipeline, options, timings):
+    for _ in range(options.polls):
+        pipeline.warm(1)
+        tracked = len(pipeline.tracked())
+        # every flight is stale an hour after the sky's clock
+        timings.time(pipeline.consumer.clean_stale_flights, pipeline.sky.time + 7200, pipeline.r, pipeline.updater,
+                     pipeline.dbmongo, items=tracked)
+
+
+def run_publish(pipeline, options, timings):
+    pipeline.warm(publish_warm_polls)  # orbits need a few polls of turns to reach the publishing threshold
+    for _ in range(options.polls):
+        pipeline.warm(1)
+        flagged = len(pipeline.consumer.surveillance_aircraft(pipeline.sky.time, pipeline.r))
+        timings.time(pipeline.consumer.pull_surveillance_flights, pipeline.sky.time, pipeline.r, pipeline.updater.store,
+                     items=flagged)
+
+
+def run_end_to_end(pipeline, options, timings):
+    def poll(snapshot):
+        pipeline.scan(snapshot)
+        pipeline.mark()
+        pipeline.consume()
+        pipeline.updater.flush()
+    for _ in range(options.polls):
+        snapshot = pipeline.sky.snapshot()
+        timings.time(poll, snapshot, items=len(snapshot['acList']))
+
+
+def run_stage(stage, options, results):
+    """Runs one stage in this (freshly forked) process and puts its report on the results queue."""
+    timings = Timings()
+    globals()['run_' + stage](Pipeline(options), options, timings)
+    results.put((stage, timings.report()))
+
+
+def compare(current, baseline, tolerance):
+    """Returns a line for every stage that is slower than its baseline by more than tolerance."""
+    regressions = []
+    for stage, report in current.items():
+        reference = baseline.get(stage)
+        if reference is None:
+            continue
+        if report['items_per_second'] < reference['items_per_second'] * (1 - tolerance):
+            regressions.append("{0}: {1:.0f} items/s, baseline {2:.0f}".format(stage, report['items_per_second'], reference['items_per_second']))
+        if report['p99_ms'] > reference['p99_ms'] * (1 + tolerance):
+            regressions.append("{0}: p99 {1:.2f} ms, baseline {2:.2f} ms".format(stage, report['p99_ms'], reference['p99_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--aircraft', type=int, default=2000, help="aircraft in the synthetic sky")
+    parser.add_argument('--trail-points', type=int, default=60, help="trail points per aircraft in each poll")
+    parser.add_argument('--surveillance-fraction', type=float, default=0.05, help="share of aircraft flying orbits")
+    parser.add_argument('--polls', type=int, default=3, help="polls (or sweeps, markers) timed per stage")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', default=','.join(stages), help="comma separated stages to run")
+    parser.add_argument('--baseline', default=default_baseline, help="baseline file to compare with or save to")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="fractional slowdown reported as a regression")
+    parser.add_argument('--debug-logging', action='store_true', help="keep the scripts' DEBUG file logging on")
+    options = parser.parse_args()
+    os.chdir(repository)  # the scripts read vrscreds.json relative to the working directory
+
+    context = mp.get_context('fork')
+    current = {}
+    failed = False
+    for stage in options.stages.split(','):
+        if stage not in stages:
+            parser.error("unknown stage '{0}'".format(stage))
+        results = context.Queue()
+        process = context.Process(target=run_stage, args=(stage, options, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print("{0:<11} failed with exit code {1}".format(stage, process.exitcode))
+            failed = True
+            continue
+        stage_name, report = results.get()
+        current[stage_name] = report
+        print("{0:<11} {1:>8} items {2:>10.0f} items/s  p50 {3:>9.3f} ms  p99 {4:>9.3f} ms  peak RSS {5:>7.1f} MB".format(
+            stage_name, report['items'], report['items_per_second'], report['p50_ms'], report['p99_ms'], report['peak_rss_mb']))
+
+    scenario = "{0}ac_{1}pts_{2}polls".format(options.aircraft, options.trail_points, options.polls)
+    baselines = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    if options.save_baseline:
+        baselines.setdefault(scenario, {}).update(current)
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, sort_keys=True, indent=4)
+        print("Saved baseline for", scenario, "to", options.baseline)
+        return 0
+    regressions = compare(current, baselines.get(scenario, {}), options.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if scenario not in baselines:
+        print("No baseline for", scenario, "- run with --save-baseline to record one")
+    return 1 if len(regressions) > 0 or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
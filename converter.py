@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 import json
-from pymongo import MongoClient
 import time
 from geopy.distance import great_circle
 import pika
@@ -11,11 +10,44 @@ from os.path import isfile, join
 
 import requests
 
+from shared import metrics, vrs_stream
+from shared.geofence import Geofence
+from shared.sharding import shard_count, shard_for_icao, shard_queue
+from shared.trail_decode import TrailBatch
+from shared.vrs_stream import iter_aircraft_list
+from shared.wire_format import encode_frame, frame_content_type
+
 import logging
 from logging.config import dictConfig
 from logging.handlers import RotatingFileHandler
 
 write_debug_json_files = 0
+debug_directory = '/opt/converter-debug'  # raw VRS responses are saved here when write_debug_json_files = 1
+use_snippet_frames = 1  # publish snippets in batched binary frames instead of one JSON message per aircraft
+frame_batch_size = 500  # snippets per frame
+compress_frames = True
+publish_attempts = 3  # a frame the broker nacks is published again this many times
+use_delta_polling = 1  # ask VRS only for trail points added since the last poll's lastDv
+full_resync_polls = 30  # polls between full trail refreshes when delta polling
+stream_chunk_size = 65536  # bytes read from the VRS response at a time
+trail_batch_size = 200  # aircraft whose Cos trails are decoded together as one array
+use_icao_shards = 1  # route each aircraft to its Icao shard's queue, see shared/sharding.py
+metrics_directory = metrics.default_directory  # per-process metric dumps, served by the consumer's metrics endpoint
+use_async_poller = 0  # 1 polls every source in vrs_sources concurrently on a fixed cadence (Python 3.5+), see shared/vrs_poller.py
+# VRS instances polled by the async poller; bounds (south, west, north, east) limit a source to a region,
+# and a source may carry its own 'credentials' instead of vrscreds.json
+vrs_sources = [{'name': 'local', 'url': 'http://localhost:8080/VirtualRadar/AircraftList.json', 'bounds': None}]
+poll_interval = 60  # seconds between the starts of two polls
+backpressure_depth = 50000  # polls are skipped while a snippet queue holds more messages than this, 0 to never skip
+use_geofence = 0  # only queue aircraft seen in geofence_regions, see shared/geofence.py
+# regions of interest: 'bounds' (south, west, north, east) or a 'polygon' of [lon, lat] points
+geofence_regions = [{'name': 'example', 'bounds': (38.5, -77.6, 39.4, -76.5)}]
+geofence_cell_size = 0.25  # degrees per cell of the precomputed region grid
+geofence_min_altitude = None  # feet; trail points outside the band do not count as in a region
+geofence_max_altitude = 25000
+geofence_excluded_callsigns = ()  # callsign prefixes never queued, e.g. airline ICAO designators ('AAL', 'DAL', 'UAL')
+geofence_excluded_types = ()  # ICAO aircraft type designators never queued
+geofence = None  # built by build_geofence() when use_geofence = 1
 
 
 logging_config = dict(
@@ -43,23 +75,91 @@ logger = logging.getLogger()
 
 queue_name = 'real_time'  # use a different queue for the real-time stuff
 
-connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-channel = connection.channel()
-task_queue = channel.queue_declare(queue=queue_name, durable=True)
-channel.basic_qos(prefetch_count=1)
+connection = None
+channel = None
+snippet_batches = {}  # routing key -> snippets waiting to be framed
 
-lastDv = None
+lastDv = None  # timestamp from the last response, sent back as ldv to poll deltas
+polls_since_resync = 0
+aircraft_delta_state = {}  # last known fields of each aircraft by VRS Id, filled in when a delta omits them
 with open("vrscreds.json", 'r') as credentials_file:
     vrs_credentials = json.loads(credentials_file.read())
 
 
-def enqueue_flight_snippet(flight_snippet):
-    """Add items from the flight_dictionary to rabbitmq queue as json strings"""
-    channel.basic_publish(exchange='',
-                          routing_key=queue_name,
-                          body=flight_snippet,
-                          properties=pika.BasicProperties(delivery_mode=2)  # make message persistent
-                          )
+def connect_channel(new_channel):
+    """Declares the queues snippets are published to on a channel and makes it the one snippets go out on."""
+    global channel
+    channel = new_channel
+    channel.queue_declare(queue=queue_name, durable=True)
+    if use_icao_shards == 1:
+        for shard in range(shard_count):
+            channel.queue_declare(queue=shard_queue(shard), durable=True)
+    channel.basic_qos(prefetch_count=1)
+    # the broker confirms every message before basic_publish returns: one synchronous round trip per frame,
+    # so per frame_batch_size snippets rather than per snippet
+    channel.confirm_delivery()
+
+
+def snippet_routing_key(icao):
+    """Queue a snippet for this aircraft goes to: its Icao shard's queue, or the single real_time queue."""
+    if use_icao_shards == 1:
+        return shard_queue(shard_for_icao(icao))
+    return queue_name
+
+
+def enqueue_flight_snippet(flight_snippet, content_type=None, routing_key=queue_name):
+    """Publish a json string or snippet frame to the rabbitmq queue, retrying if the broker does not confirm it"""
+    with metrics.timer('publish_seconds'):
+        for attempt in range(publish_attempts):
+            try:
+                # pika 0.10 returns False for a nacked message; later versions return None and raise instead
+                confirmed = channel.basic_publish(exchange='',
+                                                  routing_key=routing_key,
+                                                  body=flight_snippet,
+                                                  properties=pika.BasicProperties(delivery_mode=2,  # make message persistent
+                                                                                  content_type=content_type)
+                                                  ) is not False
+            except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as e:
+                logger.error("Broker returned message: {0}".format(e))
+                confirmed = False
+            if confirmed:
+                metrics.increment('messages_published_total')
+                return True
+            logger.error("Broker did not confirm message, attempt {0}".format(attempt + 1))
+            metrics.increment('publish_failures_total')
+    return False
+
+
+def queue_flight_snippet(flight_snippet_dict):
+    """Publishes a snippet directly, or adds it to the current frame when batching."""
+    routing_key = snippet_routing_key(flight_snippet_dict['Icao'])
+    metrics.increment('snippets_published_total')
+    if use_snippet_frames == 1:
+        snippet_batch = snippet_batches.setdefault(routing_key, [])
+        snippet_batch.append(flight_snippet_dict)
+        if len(snippet_batch) >= frame_batch_size:
+            enqueue_flight_snippet(encode_frame(snippet_batch, compress_frames), frame_content_type, routing_key)
+            del snippet_batch[:]
+    else:
+        enqueue_flight_snippet(json.dumps(flight_snippet_dict), routing_key=routing_key)
+
+
+def flush_snippet_batch():
+    """Publishes the queued snippets for each queue as one frame."""
+    for routing_key, snippet_batch in snippet_batches.items():
+        if len(snippet_batch) > 0:
+            enqueue_flight_snippet(encode_frame(snippet_batch, compress_frames), frame_content_type, routing_key)
+            del snippet_batch[:]
+
+
+def enqueue_time_marker(file_time):
+    """Puts the FileTime marker behind the snippets on every queue snippets were routed to."""
+    time_marker = json.dumps({'FileTime': file_time})
+    if use_icao_shards == 1:
+        for shard in range(shard_count):
+            enqueue_flight_snippet(time_marker, routing_key=shard_queue(shard))
+    else:
+        enqueue_flight_snippet(time_marker)
 
 
 # this function reads a dictionary of a flight snapshot and returns a different and easier to work with dictionary
@@ -68,95 +168,186 @@ def flight_snapshot_scanner(flight_dictionary):
     flightdict_0 = {}
     flightdict_0['meta'] = {}
     flightdict_0['meta']['IcaoDict'] = {}
-    for item in flight_dictionary['acList']:
+    for flight_id, item_copy in flight_snippets(flight_dictionary['acList'], use_snippet_frames == 1):
+        flightdict_0[flight_id] = item_copy
+        # send the flight snippet to rabbitmq
+        #logger.debug(item_copy)
+        queue_flight_snippet(item_copy)
+        flightdict_0['meta']['IcaoDict'][item_copy['Icao']] = flight_id
+    return flightdict_0
+
+
+def flight_snippets(aircraft_list, compact=False):
+    """Yields (flight id, snippet) for every aircraft with trail coordinates, without queueing them.
+
+    Trails are decoded trail_batch_size aircraft at a time, so a streamed response is still scanned as it arrives.
+    With compact=True the snippet geometry holds the trail's coordinate records rather than lists, for frames.
+    """
+    batch = []
+    for item in aircraft_list:
         if 'Cos' in item:
             if item['TT'] == 'a' and len(item['Cos']) > 0:
-                i = 0
-                position_list = []
-                while i < len(item['Cos']):
-                    # the incoming list of coordinates is a repeating sequence of
-                    # latitude, longitude, time (unix * 1000), altitude
-                    # we need to calculate bearings and order this for geojson
-                    longitude = item['Cos'][i+1]
-                    latitude = item['Cos'][i]
-                    altitude = item['Cos'][i+3]
-                    unix_time = item['Cos'][i+2]/1000
-                    if i+4 < len(item['Cos']):
-                        longitude_next = item['Cos'][i+5]
-                        latitude_next = item['Cos'][i+4]
-                        # bearing = geodesic.Geodesic.WGS84.Inverse(lon1=longitude, lat1=latitude, lon2=longitude_next, lat2=latitude_next)['azi1']
-                    else:
-                        pass
-                        # bearing = None
-                        # bearing = position_list[-1][3]  # use the previous bearing if this is the last position in the flight - perhaps make null instead
-                    coordinate_list = [longitude,
-                                       latitude,
-                                       altitude,
-                                       unix_time,
-                                       ]
-                    # divide by 1000 above to get unix time
-                    #if coordinate_list[2] is None:
-                    #    coordinate_list[2] = 0  # need to figure out why geojson isn't letting me give null altitudes
-                    # filter out invalid coordinates
-                    if abs(coordinate_list[0]) <= 180 and abs(coordinate_list[1]) <= 90:
-                        position_list.append(coordinate_list)
-                    i += 4
-                # check if there are still coordinates left after filtering
-                if len(position_list) > 0:
-                    flight_id = item['Icao'] + '_' + str(int(round(item['Cos'][2] / 1000, 0)))
-                    item_copy = item.copy()
-                    del item_copy['Cos']
-                    # item_copy['positions'] = position_list
-                    # add the positions as geojson instead
-                    item_copy['geometry'] = {"type": "LineString", "coordinates": position_list}
-                    item_copy['LastSeen'] = position_list[len(position_list)-1][3]
-                    flightdict_0[flight_id] = item_copy
-                    # send the flight snippet to rabbitmq
-                    #logger.debug(item_copy)
-                    enqueue_flight_snippet(json.dumps(item_copy))
-                    flightdict_0['meta']['IcaoDict'][item['Icao']] = flight_id
+                batch.append(item)
+                if len(batch) >= trail_batch_size:
+                    yield from trail_snippets(batch, compact)
+                    batch = []
             else:
                 logger.debug("No altitude!")
-    return flightdict_0
+    yield from trail_snippets(batch, compact)
+
+
+def trail_snippets(batch, compact):
+    """Yields (flight id, snippet) for a batch of aircraft with trails."""
+    # the incoming list of coordinates is a repeating sequence of
+    # latitude, longitude, time (unix * 1000), altitude, which TrailBatch reorders for geojson
+    trails = TrailBatch([item['Cos'] for item in batch])
+    keep = geofence.keep(batch, trails) if geofence is not None else None
+    for n, item in enumerate(batch):
+        # check if there are still coordinates left after filtering out invalid ones, and the aircraft is of interest
+        if trails.bounds[n + 1] > trails.bounds[n] and (keep is None or keep[n]):
+            flight_id = item['Icao'] + '_' + str(int(round(item['Cos'][2] / 1000, 0)))
+            item_copy = {key: value for key, value in item.items() if key != 'Cos'}
+            # add the positions as geojson
+            item_copy['geometry'] = {"type": "LineString", "coordinates": trails.points(n) if compact else trails.coordinates(n)}
+            item_copy['LastSeen'] = trails.last_time(n)
+            yield flight_id, item_copy
+
+
+def merge_aircraft_delta(aircraft_list):
+    """Fills in fields left out of a delta response from the last known state of each aircraft, by VRS Id."""
+    return vrs_stream.merge_aircraft_delta(aircraft_list, aircraft_delta_state)
+
+
+def response_chunks(snapshot_req, debug_file=None):
+    """Yields the response body as it arrives, copying it to the debug file if one is open."""
+    for chunk in snapshot_req.iter_content(chunk_size=stream_chunk_size):
+        if debug_file is not None:
+            debug_file.write(chunk)
+        yield chunk
+
+
+def record_queue_depths():
+    """Sets the queue_depth gauge for every queue snippets are routed to; returns the deepest."""
+    queues = [shard_queue(shard) for shard in range(shard_count)] if use_icao_shards == 1 else [queue_name]
+    deepest = 0
+    for queue in queues:
+        declared = channel.queue_declare(queue=queue, durable=True, passive=True)
+        metrics.set_gauge('queue_depth', declared.method.message_count, queue=queue)
+        deepest = max(deepest, declared.method.message_count)
+    return deepest
+
+
+def consumers_behind():
+    """Backpressure check for the async poller: True while a snippet queue is deeper than backpressure_depth."""
+    return record_queue_depths() > backpressure_depth and backpressure_depth > 0
+
+
+def handle_poll(aircraft_batch, poll_time):
+    """Queues the snippets of a batch of aircraft from an async poll, as the poller hands them over."""
+    for flight_id, item_copy in flight_snippets(aircraft_batch, use_snippet_frames == 1):
+        queue_flight_snippet(item_copy)
+
+
+def finish_poll(poll_time):
+    """Puts the time marker of an async poll behind its snippets."""
+    flush_snippet_batch()  # every snippet must be on the queue ahead of the time marker
+    enqueue_time_marker(poll_time)
+
+
+def reset_delta_polling():
+    """Forgets lastDv and the aircraft state so the next poll fetches full trails."""
+    global lastDv, polls_since_resync
+    lastDv = None
+    polls_since_resync = 0
+    aircraft_delta_state.clear()
 
 
 def req_aircraft_inflight():
     """Makes a request to VirtualRadarServer's HTTP JSON api and enqueues flight snippets followed by EOF."""
-    client = MongoClient()
-    dbmongo = client.rt_flights_test
-    logger.debug(dbmongo.flighthistory.create_index([("geometry", "2dsphere")]))
+    global lastDv, polls_since_resync
     request_url = "http://localhost:8080/VirtualRadar/AircraftList.json"
-    request_params = {
-                        'trFmt': 'sa',
-                        'refreshTrails': 1
-                    }
+    if use_delta_polling == 1 and polls_since_resync >= full_resync_polls:
+        reset_delta_polling()
+    request_params = {'trFmt': 'sa'}
+    if use_delta_polling == 1 and lastDv is not None:
+        request_params['ldv'] = lastDv  # only send trail points added since the last poll
+    else:
+        request_params['refreshTrails'] = 1
 
-    snapshot_req = requests.put(request_url, params=request_params, auth=(vrs_credentials['username'], vrs_credentials['password']))
+    try:
+        with metrics.timer('vrs_fetch_seconds'):
+            snapshot_req = requests.put(request_url, params=request_params, auth=(vrs_credentials['username'], vrs_credentials['password']), stream=True)
+    except requests.exceptions.RequestException as e:
+        logger.error("Request to {0} failed: {1}".format(request_url, e))
+        metrics.increment('vrs_polls_total', result='error')
+        reset_delta_polling()
+        return
     if snapshot_req.ok:
-        snapshot_dict = json.loads(snapshot_req.content.decode())
-        # logger.debug(phx_snapshot_dict)
-        flight_snapshot_scanner(snapshot_dict)
-        lastDv = snapshot_dict['lastDv'] # this is a timestamp used by the server to identify updates
-        time_marker = {'FileTime': round(time.time())}
-        enqueue_flight_snippet(json.dumps(time_marker))
+        debug_file = None
         if write_debug_json_files == 1:
-            with open('/opt/converter-debug/vrssnapshot_' + str(round(time.time())) + '.json', 'w') as request_json:
-                request_json.write(snapshot_req.content.decode()) # take json sring and write out to file
-
+            debug_file = open(join(debug_directory, 'vrssnapshot_' + str(round(time.time())) + '.json'), 'wb')
+        snapshot_header = {}
+        try:
+            # aircraft are scanned and queued while the rest of the response is still arriving
+            aircraft_list = iter_aircraft_list(response_chunks(snapshot_req, debug_file), snapshot_header)
+            with metrics.timer('vrs_parse_seconds'):  # includes the rest of the download, which is streamed
+                flight_snapshot_scanner({'acList': merge_aircraft_delta(aircraft_list)})
+        except (ValueError, requests.exceptions.RequestException) as e:
+            logger.error("Reading response from {0} failed, next poll is a full resync: {1}".format(request_url, e))
+            metrics.increment('vrs_polls_total', result='error')
+            reset_delta_polling()
+            return
+        finally:
+            flush_snippet_batch()  # every snippet must be on the queue ahead of the time marker
+            snapshot_req.close()
+            if debug_file is not None:
+                debug_file.close()
+        lastDv = snapshot_header.get('lastDv')  # this is a timestamp used by the server to identify updates
+        polls_since_resync += 1
+        enqueue_time_marker(round(time.time()))
+        metrics.increment('vrs_polls_total', result='ok')
+        record_queue_depths()
     else:
         logger.error("Request to {0} failed with status code {1}".format(request_url, snapshot_req.status_code))
+        metrics.increment('vrs_polls_total', result='error')
+        reset_delta_polling()
+
+
+def build_geofence():
+    """Builds the region grid when use_geofence = 1; anything scanning snapshots calls this first."""
+    global geofence
+    geofence = None
+    if use_geofence == 1:
+        geofence = Geofence(geofence_regions, geofence_cell_size, geofence_min_altitude, geofence_max_altitude,
+                            geofence_excluded_callsigns, geofence_excluded_types)
 
 
 def main():
-    """Requests flight data from VirtualRadarServer every 60 seconds."""
+    """Requests flight data from VirtualRadarServer every poll_interval seconds."""
+    global connection
     logger.debug("Process started!")
+    build_geofence()
+    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+    connect_channel(connection.channel())
+    metrics.configure('converter', metrics_directory)
+    if use_async_poller == 1:
+        from shared.vrs_poller import VrsPoller, VrsSource  # Python 3.5+, so only imported when it is used
+        sources = [VrsSource(source['name'], source['url'], source.get('credentials', vrs_credentials), source.get('bounds'),
+                             use_delta_polling == 1, full_resync_polls, debug_directory if write_debug_json_files == 1 else None)
+                   for source in vrs_sources]
+        VrsPoller(sources, handle_poll, poll_interval, consumers_behind, finish_poll, trail_batch_size,
+                  connection.process_data_events).run_forever()  # heartbeats while waiting, as connection.sleep() does
+        return 0
     count = 0
     while True:
-        req_aircraft_inflight()
+        with metrics.timer('vrs_poll_seconds'):
+            req_aircraft_inflight()
+        metrics.write()
         logger.debug("Request {0} complete!".format(count))
         count += 1
-        connection.sleep(60)
+        connection.sleep(poll_interval)
     return 0
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Serves archived flights from the mongo flighthistory collection over HTTP.
+
+GET /flights?bbox=south,west,north,east&start=&end=&icao=&min_score=&page=&limit=&format=
+    flights whose track crosses the box and that were last seen between start
+    and end (unix seconds), newest first, a page of limit at a time. The
+    default format=geojson streams a FeatureCollection whose "next" is the
+    page token of the next page (null on the last one); format=frame returns a
+    snippet frame (see shared/wire_format.py) with the token in an X-Next-Page
+    header (empty on the last one).
+GET /stats
+    the result cache's entries, hits, misses and hit rate.
+
+Results come from the cache in shared/history_query.py. With --flights the
+server reads JSON lines files of flight dicts (snapshot-replay.py --output)
+into an in-memory stand-in instead of connecting to mongo.
+
+    python3 history-server.py --flights /tmp/replay/flights-0.jsonl
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+from logging.config import dictConfig
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from shared import metrics
+from shared.history_query import HistoryCache, geojson_pieces, parse_query
+from shared.standins import MemoryMongo
+from shared.wire_format import encode_frame, frame_content_type
+
+listen_port = 8095
+mongo_database = 'rt_flights_test'  # holding the flighthistory collection the consumers archive to
+cache_entries = 128  # windows of quantized queries kept
+cache_ttl = 60  # seconds a cached window is served for; archived flights only ever get added
+write_chunk_size = 65536  # bytes of GeoJSON buffered per socket write
+metrics_directory = metrics.default_directory  # served by the queue consumer's metrics endpoint
+
+logging_config = dict(
+    version=1,
+    formatters={
+        'f': {'format':
+              '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'}
+        },
+    handlers={
+        'h': {'class': 'logging.handlers.RotatingFileHandler',
+              'formatter': 'f',
+              'filename': 'log_history-server.log',
+              'maxBytes': 4096,
+              'backupCount': 3,
+              'level': logging.DEBUG}
+        },
+    root={
+        'handlers': ['h'],
+        'level': logging.INFO,
+        },
+)
+
+logger = logging.getLogger()
+
+
+class HistoryServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, cache, port=listen_port):
+        self.cache = cache
+        HTTPServer.__init__(self, ('', port), HistoryHandler)
+
+
+class HistoryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == '/flights':
+                self.send_flights({key: values[0] for key, values in parse_qs(url.query).items()})
+            elif url.path == '/stats':
+                self.send_body(200, 'application/json', json.dumps(self.server.cache.stats()).encode())
+            else:
+                self.send_error(404)
+        finally:
+            metrics.set_gauge('history_cache_hit_rate', self.server.cache.stats()['hit_rate'] or 0.0)
+            metrics.maybe_write()
+
+    def send_body(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_flights(self, parameters):
+        try:
+            query, token, limit, output_format = parse_query(parameters)
+        except ValueError as e:
+            self.send_body(400, 'text/plain', str(e).encode())
+            return
+        with metrics.timer('history_request_seconds', format=output_format):
+            try:
+                flights, next_token = self.server.cache.page(query, token, limit)
+            except PyMongoError as e:
+                logger.error("Reading flight history failed: {0}".format(e))
+                metrics.increment('history_request_errors_total')
+                self.send_body(503, 'text/plain', b'Flight history is unavailable')
+                return
+            metrics.increment('history_requests_total', format=output_format)
+            if output_format == 'frame':
+                self.send_body(200, frame_content_type, encode_frame(flights), [('X-Next-Page', next_token or '')])
+                return
+            # no Content-Length: the features are written as they are encoded and the connection closed after
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/geo+json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            chunk = []
+            size = 0
+            for piece in geojson_pieces(flights, next_token):
+                chunk.append(piece)
+                size += len(piece)
+                if size >= write_chunk_size:
+                    self.wfile.write(''.join(chunk).encode())
+                    chunk = []
+                    size = 0
+            self.wfile.write(''.join(chunk).encode())
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+
+def load_flights(paths):
+    """An in-memory flighthistory collection holding the flight dicts of JSON lines files."""
+    collection = MemoryMongo().flighthistory
+    for path in paths:
+        with open(path) as flights_file:
+            collection.insert_many(json.loads(line) for line in flights_file if line.strip())
+    return collection
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=listen_port, help="port to listen on")
+    parser.add_argument('--flights', nargs='+', help="serve these JSON lines files of flights instead of mongo")
+    options = parser.parse_args()
+    dictConfig(logging_config)
+    if options.flights is not None:
+        collection = load_flights(options.flights)
+    else:
+        collection = MongoClient()[mongo_database].flighthistory
+    metrics.configure('history-server', metrics_directory)
+    server = HistoryServer(HistoryCache(collection, cache_entries, cache_ttl), options.port)
+    logger.info("Serving flight history on port {0}".format(server.server_port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,33 @@
 
 import pika
 import json
+import copy
 from bson.son import SON
 from pymongo import MongoClient
 import pymongo
-from geopy.distance import great_circle
 from geographiclib import geodesic
 import redis
 import multiprocessing as mp
-from shared.analysis_functions import calculate_bearings_and_turns
+from shared import metrics, scoring
+from shared.airport_index import AirportIndex, georadius_nearest_many
+from shared.bearing_engine import calculate_bearings_and_turns
+from shared.flight_cache import CachedFlightUpdater
+from shared.flight_update import version_of
+from shared.heatmap import TurnHeatmap, ensure_heatmap_indexes, heatmap_collection, turn_cells
+from shared.landing import LandingDetector, slow_track
+from shared.mongo_writer import FlightWriter, ensure_indexes
+from shared.s3_publisher import LocalBackend, S3Backend, SnapshotPublisher
+from shared.simplify import filter_jitter, simplify_archive, simplify_tail, tail_tolerance, turn_points
+from shared.stale_sweeper import sweep_stale_flights
+from shared.sharding import WorkerMembership, shard_count, shard_for_icao, shard_of_queue, shard_queue
+from shared.track_store import TrackStore
+from shared.track_tiers import TrackTiers, ensure_segment_indexes, segment_collection
+from shared.wire_format import decode_frame, frame_content_type, is_frame
 import os
-import sys
+import time
 import logging
 from logging.config import dictConfig
 from logging.handlers import RotatingFileHandler
-import boto3
 
 logging_config = dict(
     version=1,
@@ -43,25 +56,88 @@ dictConfig(logging_config)
 logger = logging.getLogger()
 
 
-coord_chg = 0.0001
 queue_name = 'real_time'
 min_surveillance_score = 100
+use_decayed_ranking = 1  # publish the top of shared/scoring.py's decayed ranking; 0 for every flight over min_surveillance_score
+min_ranked_score = 40  # decayed score (scoring.ranking_window) a ranked flight needs to be published
+consumer_prefetch = 4  # messages (frames or legacy snippets) in flight per consumer
+merge_attempts = 5  # merges retried when another consumer updated the same aircraft first
+use_redis_scripts = 1  # 0 commits with WATCH/MULTI instead of Lua, for fake redis in tests
+landing_check_window = 300  # seconds of recent track read back for landing checks
+landing_check_scans = 10  # scans of a flight between landing checks
+bearing_mode = 'wgs84'  # or 'spherical' for the faster approximation, see shared/bearing_engine.py
+use_icao_shards = 1  # consume the per-shard queues the converter routes to, see shared/sharding.py
+marker_shard = 0  # the worker owning this shard handles FileTime markers
+rebalance_interval = 10  # seconds between membership heartbeats / shard ownership checks
+flight_cache_size = 20000  # flight heads kept in memory per worker
+landing_detector = LandingDetector(flight_cache_size)  # recent track of each flight, for landing checks
+write_batch_size = 200  # queued commits written to redis per pipelined round trip
+airport_index_path = './data/airports.idx'  # built by airport-index-builder.py
+airport_radius = 5000  # metres from an airport that count as landed there
+airport_index = None
+run_stale_sweep_inline = 1  # 0 when stale-sweeper.py runs as its own process
+publish_to_s3 = 1  # 0 writes snapshots under publish_directory instead of uploading them
+publish_directory = '/opt/output-json'
+publish_threads = 8  # concurrent uploads per marker
+write_snapshot_bundle = 1  # one file per marker with every flight at several levels of detail
+write_flight_files = 1  # one file per flight plus the aircraft list, for older map pages
+write_snapshot_delta = 1  # what changed since the previous marker, for maps already open
+snapshot_publisher = None
+compact_flight_documents = 0  # 1 archives flights in the columnar layout of shared/mongo_writer.py
+flight_writer = None
+use_track_tiers = 1  # move the old end of long tracks from redis to mongo segments, see shared/track_tiers.py
+track_tiers = None
+use_turn_heatmap = 1  # count turns by place, hour and altitude band for hotspot queries, see shared/heatmap.py
+turn_heatmap = None
+metrics_directory = metrics.default_directory  # each consumer dumps its metrics here
+metrics_port = 9108  # serves the metrics of every process writing to metrics_directory, 0 to turn off
 
 with open("vrscreds.json", 'r') as credentials_file:
     vrs_credentials = json.loads(credentials_file.read())
 
 
-def callback(ch, method, properties, body, r, dbmongo):
+def callback(ch, method, properties, body, r, updater, dbmongo):
     """Add msg content to a flight path, or pull surveillance list if EOF."""
     # logger.debug(" [x] Received %r" % (body,))
+    if (properties is not None and properties.content_type == frame_content_type) or is_frame(body):
+        flight_snippet_list = decode_frame(body)
+        record_snippet_lag(flight_snippet_list)
+        with metrics.timer('merge_seconds'):
+            flight_merger_bulk(flight_snippet_list, r, updater, dbmongo)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        metrics.maybe_write()
+        if turn_heatmap is not None:
+            turn_heatmap.maybe_flush(r)
+        return
     message_dict = json.loads(body.decode())
     if 'FileTime' in message_dict:  # if we get the special 5 minute marker message on the queue, time to mark stale flights
-        pull_surveillance_flights(message_dict['FileTime'], r)
-        clean_stale_flights(message_dict['FileTime'], r, dbmongo)
+        metrics.set_gauge('marker_lag_seconds', time.time() - message_dict['FileTime'])
+        # the marker is sent to every shard queue; only the one arriving on marker_shard publishes and cleans
+        shard = shard_of_queue(method.routing_key)
+        if shard is None or shard == marker_shard:
+            with metrics.timer('s3_publish_seconds'):
+                pull_surveillance_flights(message_dict['FileTime'], r, updater.store)
+            if turn_heatmap is not None:
+                turn_heatmap.maybe_write_tiles(r, snapshot_publisher.backend, message_dict['FileTime'])
+            if run_stale_sweep_inline == 1:
+                with metrics.timer('sweep_seconds'):
+                    clean_stale_flights(message_dict['FileTime'], r, updater, dbmongo)
     else:
-        flight_merger(message_dict, r, dbmongo)
+        record_snippet_lag([message_dict])
+        with metrics.timer('merge_seconds'):
+            flight_merger(message_dict, r, updater, dbmongo)
     # logger.debug(" [x] Done")
     ch.basic_ack(delivery_tag=method.delivery_tag)
+    metrics.maybe_write()
+    if turn_heatmap is not None:
+        turn_heatmap.maybe_flush(r)
+
+
+def record_snippet_lag(flight_snippet_list):
+    """Counts received snippets and sets how far the newest of them is behind the clock."""
+    metrics.increment('snippets_received_total', len(flight_snippet_list))
+    if len(flight_snippet_list) > 0:
+        metrics.set_gauge('snippet_lag_seconds', time.time() - max(x['LastSeen'] for x in flight_snippet_list))
 
 
 def coordinate_uniqueness_check(coordinate_list):
@@ -72,268 +148,352 @@ def coordinate_uniqueness_check(coordinate_list):
     return 0
 
 
-def coordinate_lossy_compression(coordinate_list):
-    """Selectively discards coordinates that do not convey much information."""
-    coordinate_list.sort(key=lambda coord: coord[3])
-    if len(coordinate_list) < 2:
-        return coordinate_list
-    else:
-        compressed_coordinate_list = []
-        compressed_coordinate_list.append(coordinate_list[0])
-        for i in coordinate_list:
-            # if float(i[3]) > (compressed_coordinate_list[-1][3] + 0.5): # drop coordinates within 0.5 seconds of each other
-            if abs(i[0] - compressed_coordinate_list[-1][0]) + abs(i[1] - compressed_coordinate_list[-1][1]) > coord_chg:
-                compressed_coordinate_list.append(i)
-        # logger.debug("Dropped '{0}' of '{1}' coordinates!".format(len(coordinate_list)-len(compressed_coordinate_list), len(coordinate_list)))
-        return compressed_coordinate_list
-
-
-def clean_stale_flights(file_time, r, dbmongo):
+def clean_stale_flights(file_time, r, updater, dbmongo):
     """Writes data for flights that have dropped from our data feed and removes them from redis."""
-    stale_flight_list = r.zrangebyscore('flight_scan_times', '0', file_time - 3600)
-    flights_to_mongo = []
-    for i in stale_flight_list:
-        flight_dict = json.loads(r.get(i))
-        r.delete(i)
-        r.zrem("flight_scan_times", i)
-        r.zrem("surveillance_score", i)
-        if len(flight_dict['geometry']['coordinates']) > 0 and len(flight_dict['geometry']['coordinates'][-1]) >= 2:  # not sure why this check is needed.
-            airport_check_value = airport_proximity_check(flight_dict['geometry']['coordinates'][-1][0:2], r)
-        else:
-            airport_check_value = 0
-        if airport_check_value == 0:
-            flight_dict['FlightStatus'] = 'OutOfRange'
-        else:
-            flight_dict['LandedAirportID'] = airport_check_value
-            flight_dict['FlightStatus'] = 'Landed'
-        flight_dict['geometry']['coordinates'] = coordinate_lossy_compression(flight_dict['geometry']['coordinates'])
-        if len(flight_dict['geometry']['coordinates']) > 1:
-            flights_to_mongo.append(flight_dict)
-    if len(flights_to_mongo) > 0:
-        dbmongo.flighthistory.insert_many(flights_to_mongo, ordered=False)
-    else:
-        logger.debug("No flights inserted")
+    sweep_stale_flights(file_time, updater, dbmongo, lambda coordinates: airport_proximity_check_many(coordinates, r),
+                        writer=flight_writer, tiers=track_tiers)
     return 0
 
 
 def airport_proximity_check(coordinate, r):
-    '''Query redis for nearby airports and return closest one, or 0 if none within range.'''
+    '''Look up nearby airports and return closest one, or 0 if none within range.'''
+    if airport_index is not None:
+        return airport_index.nearest(coordinate, airport_radius)
     if abs(coordinate[1]) >= 85.05112878:
         return 0
     else:
-        airports_in_range = r.georadius('airports', *coordinate, radius=5000, unit='m', withdist=False, withcoord=False, withhash=False, count=1, sort='ASC')
+        airports_in_range = r.georadius('airports', *coordinate, radius=airport_radius, unit='m', withdist=False, withcoord=False, withhash=False, count=1, sort='ASC')
     if len(airports_in_range) == 0:
         return 0
     else:
         return airports_in_range[0]
 
 
-def landed_check(coordinate_list, r):
-    '''Check if the plane has not moved fast enough recently to be airborne.'''
-    # first do naive check - two points distance / time
-    naive_distance = great_circle(coordinate_list[0][0:1], coordinate_list[-1][0:1]).meters
-    time_delta = coordinate_list[-1][3] - coordinate_list[0][3]
-    if time_delta < 200:
-        return 0
-    elif (naive_distance / time_delta) < 8.94:
-        # logger.debug("Something is moving too slow to be flying!")
-        return airport_proximity_check((coordinate_list[-1][0], coordinate_list[-1][1]), r)
-    else:
-        return 0
+def airport_proximity_check_many(coordinates, r):
+    '''airport_proximity_check for a batch of coordinates.'''
+    if airport_index is not None:
+        return airport_index.nearest_many(coordinates, airport_radius)
+    return georadius_nearest_many(r, coordinates, airport_radius)
 
 
 def extended_landing_check(coordinate_list, r):
-    '''Run landed_check for multiple segments of the flight.'''
-    check_index = [None] * 5
-    check_index[0] = time_index_search(coordinate_list, 300)
-    if check_index[0] == 0:  # start with a check over 5 minutes
-        return 0  # if it's moving too fast, we can stop
-    else:
-        airport_result = landed_check(coordinate_list[check_index[0]:-1], r)
-        if airport_result != 0:
-            # additional scrutiny required to confirm landing - must be moving slowly over each minute
-            for i in reversed(range(1, 4)):
-                check_index[i] = time_index_search(coordinate_list, 60*i)
-                if check_index[i] == check_index[i-1]:
-                    return 0
-                airport_result_loop = landed_check(coordinate_list[check_index[i-1]:check_index[i]], r)
-                if airport_result_loop == 0:
-                    return 0
-    return airport_result
-
-
-def time_index_search(coordinate_list, seconds):
-    '''Look for coordinate matching a given time back, and return its index.'''
-    if len(coordinate_list) < 5:
-        return 0
-    if coordinate_list[-1][3] - coordinate_list[0][3] < seconds:
-        logger.debug("Coordinate list too short")
+    '''Airport ID if the plane moved too slowly to be airborne over the last few minutes of a time-sorted track, else 0.'''
+    if not slow_track(coordinate_list):
         return 0
-    coordinate_count = 0
-    for i in reversed(coordinate_list):
-        coordinate_count += 1
-        if coordinate_list[-1][3] - i[3] >= seconds:
-            return len(coordinate_list) - coordinate_count
-
-
-def pull_surveillance_flights(timestamp, r):
-    """Pulls flight data for aircraft with a surveillance score above threshold, writes files, and uploads to S3."""
-    try:
-        logger.debug("Connecting to AWS S3 - secret key found")
-        s3 = boto3.client('s3',
-                          aws_access_key_id=vrs_credentials['aws_access_key_id'],
-                          aws_secret_access_key=vrs_credentials['aws_secret_access_key'],
-                          config=boto3.session.Config(signature_version='s3v4'))
-    except:
-        logger.debug("S3 connection failed")
-
-    surveillance_aircraft_list = r.zrangebyscore('surveillance_score', min_surveillance_score, '+inf', withscores=True)
+    return airport_proximity_check((coordinate_list[-1][0], coordinate_list[-1][1]), r)
+
+
+def find_landings(flight_snippet_list, updater, r):
+    '''Adds each snippet's new points to its flight's rolling track; returns {Icao: airport ID} for flights that landed.
+
+    Only flights due a check and found too slow to be airborne are looked up, in one batch.
+    '''
+    candidates = []
+    for flight_snippet_dict in flight_snippet_list:
+        icao = flight_snippet_dict['Icao']
+        existing_flight_fields, last_coordinate, record_count = updater.load_head(icao)
+        coordinates = sorted(flight_snippet_dict['geometry']['coordinates'], key=lambda coord: coord[3])
+        if existing_flight_fields is None:
+            landing_detector.update(icao, [x for x in coordinates if x[2] != 0])  # the points merges would take
+            continue
+        time_watermark = existing_flight_fields.get('TimeWatermark')
+        if time_watermark is None:
+            time_watermark = last_coordinate[3] if last_coordinate is not None else 0
+        new_points = [x for x in coordinates if x[3] > time_watermark and x[2] != 0]
+        due = int(existing_flight_fields['LandedScan']) + 1 >= landing_check_scans
+        # a flight this process has not followed yet starts from its stored tail when its check is due
+        seed = (lambda: updater.read_tail(icao, landing_check_window)) if due else None
+        track = landing_detector.update(icao, new_points, seed)
+        if due and track.is_slow():
+            candidates.append((icao, tuple(track.last()[0:2])))
+    if len(candidates) == 0:
+        return {}
+    airports = airport_proximity_check_many([coordinate for icao, coordinate in candidates], r)
+    return {icao: airport for (icao, coordinate), airport in zip(candidates, airports) if airport != 0}
+
+
+def surveillance_aircraft(timestamp, r):
+    """(Icao, score) of the flights to publish at timestamp."""
+    if use_decayed_ranking:
+        return scoring.ranked_flights(r, timestamp, min_ranked_score)
+    return r.zrangebyscore('surveillance_score', min_surveillance_score, '+inf', withscores=True)
+
+
+def pull_surveillance_flights(timestamp, r, store):
+    """Pulls flight data for aircraft with a surveillance score above threshold and publishes it for the web map."""
+    surveillance_aircraft_list = surveillance_aircraft(timestamp, r)
     logger.debug("surveillance aircraft list dump")
     logger.debug(surveillance_aircraft_list)
+    flights = store.load_many([aircraft[0] for aircraft in surveillance_aircraft_list])  # rebuild the GeoJSON flights
+    if track_tiers is not None:
+        track_tiers.stitch_many(flights)  # with the part of long tracks moved to mongo
+    snapshot_publisher.publish(timestamp, surveillance_aircraft_list, flights)
 
-    # write local data files
-    with open('latest.json', 'w+') as latest_file:
-        json.dump({'TimeStamp': timestamp}, latest_file, sort_keys=True, indent=4)
-    s3.upload_file(Bucket="nstarpost-flightmap-east2", Key="latest.json", Filename="latest.json")
-    try:
-        os.mkdir(str(timestamp))
-    except:
-        e = sys.exc_info()[0]
-        logger.debug(e)
-    aircraft_list_file_path = str(timestamp) + '/' + 'aircraft_list_' + str(timestamp) + '.json'
-    with open('./' + aircraft_list_file_path, 'w') as aircraft_list_file:
-        json.dump({'Aircraft': surveillance_aircraft_list}, aircraft_list_file, sort_keys=True, indent=4)
-    try:
-        upload_result = s3.upload_file(Bucket="nstarpost-flightmap-east2", Key=aircraft_list_file_path, Filename=('./' + aircraft_list_file_path))
-    except:
-        logger.debug(upload_result)
-    for aircraft in surveillance_aircraft_list:
-        flight_file_path = str(timestamp) + '/' + str(aircraft[0]) + '_' + str(timestamp) + '.json'
-        with open('./' + flight_file_path, 'w') as flight_file:
-            flight_file.write(str(r.get(aircraft[0])))  # take json sring and write out to file
-        try:
-            upload_result = s3.upload_file(Bucket="nstarpost-flightmap-east2", Key=flight_file_path, Filename=('./' + flight_file_path))
-        except:
-            logger.debug(upload_result)
-            # logger.debug("aircraft info from redis")
-            # logger.debug(r.get(aircraft[0]))
-
-
-def flight_merger(flight_snippet_dict, r, dbmongo):
-    """Takes flight snippets and appends them to flight paths or creates new flight records."""
-    # Check if the dictionary contains useful info
+
+def useful_snippet(flight_snippet_dict):
+    """Checks if a snippet has enough distinct coordinates to merge."""
     if len(flight_snippet_dict['geometry']['coordinates']) < 2:
+        return False
+    return coordinate_uniqueness_check(flight_snippet_dict['geometry']['coordinates']) != 0
+
+
+def flight_merger_bulk(flight_snippet_list, r, updater, dbmongo):
+    """Merges a batch of snippets, reading uncached flight heads in one round trip and writing through in batches."""
+    flight_snippet_list = [x for x in flight_snippet_list if useful_snippet(x)]
+    if len(flight_snippet_list) == 0:
         return 1
-    elif coordinate_uniqueness_check(flight_snippet_dict['geometry']['coordinates']) == 0:
-        return 1
+    updater.load_heads([x['Icao'] for x in flight_snippet_list])
+    with metrics.timer('landing_check_seconds'):
+        landed_airports = find_landings(flight_snippet_list, updater, r)
+
+    # another consumer may update the same aircraft between our read and write; if so, merge again on the fresh state
+    to_merge = flight_snippet_list
+    for attempt in range(merge_attempts):
+        merged = []
+        failed = [x for x in to_merge if not attempt_flight_merge(copy.deepcopy(x), r, updater, dbmongo, x, landed_airports, merged)]
+        failed_ids = set(id(x) for x in failed + updater.flush())
+        for tag, new_turns, cells, landed in merged:
+            if id(tag) in failed_ids:  # a merge that lost a race is counted on the retry
+                continue
+            metrics.increment('turns_total', new_turns)
+            if cells is not None:
+                turn_heatmap.add(cells)
+            if landed:
+                metrics.increment('landings_total')
+        if len(failed_ids) == 0:
+            if track_tiers is not None:
+                track_tiers.spill_due(updater, [x['Icao'] for x in flight_snippet_list])
+            return 0
+        to_merge = [x for x in flight_snippet_list if id(x) in failed_ids]
+        logger.debug("Conflicting updates for {0}, merging again".format([x['Icao'] for x in to_merge]))
+        metrics.increment('merge_conflicts_total', len(to_merge))
+    logger.error("Gave up merging snippets for {0} after {1} conflicts".format([x['Icao'] for x in to_merge], merge_attempts))
+    return 1
+
+
+def flight_merger(flight_snippet_dict, r, updater, dbmongo):
+    """Takes flight snippets and appends them to flight paths or creates new flight records."""
+    return flight_merger_bulk([flight_snippet_dict], r, updater, dbmongo)
+
+
+def heatmap_cells(bearing_dict):
+    """The heatmap cells of the new turns of a calculate_bearings_and_turns result, or None without a heatmap."""
+    if turn_heatmap is None or len(bearing_dict['turn_indexes']) == 0:
+        return None
+    return turn_cells(bearing_dict['coordinates'], bearing_dict['turn_indexes'])
+
+
+def attempt_flight_merge(flight_snippet_dict, r, updater, dbmongo, tag=None, landed_airports=None, merged=None):
+    """Merges one snippet against the current flight head; returns False if the commit lost a race.
+
+    landed_airports is find_landings() for the batch the snippet came in. If merged is a list, (tag, new turns, their
+    heatmap cells, whether the flight landed) is appended to it, to be counted once the commit is known to have applied.
+
+    With a CachedFlightUpdater the commit is queued and a lost race shows up as tag in updater.flush() instead.
+    """
+    icao = flight_snippet_dict['Icao']
+    existing_flight_fields, last_coordinate, record_count = updater.load_head(icao)
 
     # If the aircraft is not tracked in redis, add it
-    if r.exists(flight_snippet_dict['Icao']) == 0:
+    if existing_flight_fields is None:
         # Set some initial information about the aircraft
         flight_snippet_dict['FlightStatus'] = 'InFlight'
         flight_snippet_dict['LandedScan'] = 0
         flight_snippet_dict['LandedAirportID'] = None
-
-        # compress and calculate bearings / turns. should be ok with single coordinate
-        flight_snippet_dict['geometry']['coordinates'] = coordinate_lossy_compression(flight_snippet_dict['geometry']['coordinates'])
-        bearing_dict = calculate_bearings_and_turns(flight_snippet_dict['geometry']['coordinates'], flight_snippet_dict['geometry']['coordinates'][0])
-        # replace existing coordinate list with compressed list that includes bearings
-        flight_snippet_dict['geometry']['coordinates'] = bearing_dict['coordinates']
+        flight_snippet_dict['TimeWatermark'] = max(x[3] for x in flight_snippet_dict['geometry']['coordinates'])
+
+        # drop jitter and calculate bearings / turns. should be ok with single coordinate
+        flight_snippet_dict['geometry']['coordinates'] = filter_jitter(None, flight_snippet_dict['geometry']['coordinates'])
+        bearing_dict = calculate_bearings_and_turns(flight_snippet_dict['geometry']['coordinates'], flight_snippet_dict['geometry']['coordinates'][0], bearing_mode)
+        cells = heatmap_cells(bearing_dict)
+        # replace existing coordinate list with the simplified list that includes bearings, keeping the turn points
+        flight_snippet_dict['geometry']['coordinates'] = simplify_tail(None, bearing_dict['coordinates'], tail_tolerance,
+                                                                       turn_points(bearing_dict['turn_indexes']))
         # record last turn point, # of turns, and surveillance_score
         flight_snippet_dict['LastTurnPoint'] = bearing_dict['LastTurnPoint']
         flight_snippet_dict['LiveTurns'] = bearing_dict['new_turns']
         flight_snippet_dict['SurveillanceScore'] = bearing_dict['surveillance_score_incr']
+        flight_snippet_dict['WindowScores'], flight_snippet_dict['ScoredAt'] = scoring.apply_turn_events(None, None, bearing_dict['turn_events'])
+        flight_snippet_dict['HotSince'] = flight_snippet_dict['geometry']['coordinates'][0][3]  # oldest point kept in redis
 
-        # put the last seen time into redis ranked list
-        r.zadd("flight_scan_times", flight_snippet_dict['LastSeen'], flight_snippet_dict['Icao'])
-
-        # assign a surveillance score in another ranked list
-        r.zadd("surveillance_score", flight_snippet_dict['SurveillanceScore'], flight_snippet_dict['Icao'])
-        # put flight_snippet_dict into redis, as a json string
-        r.set(flight_snippet_dict['Icao'], json.dumps(flight_snippet_dict))
+        # put the packed track and flight fields into redis, along with the last seen time and surveillance score ranked lists
+        if merged is not None:
+            merged.append((tag, bearing_dict['new_turns'], cells, False))
+        return updater.create(flight_snippet_dict, tag)
     else:
         # the aircraft is already tracked in redis. update flight info in redis
-        existing_flight_dict = json.loads(r.get(flight_snippet_dict['Icao']))
-        landed_scan_count = int(existing_flight_dict['LandedScan']) + 1
-
-        update_flight_dict = dict(existing_flight_dict)
-        new_coordinates = existing_flight_dict['geometry']['coordinates']
-
-        # walk through new snippet coordinates and add the ones we don't have
-        for x in flight_snippet_dict['geometry']['coordinates']:
-            if x not in new_coordinates and x[2] != 0:  # disregard coordinate if altitude = 0
-                new_coordinates.append(x)
-        # check for bounds and then compress the coordinates we added.
-        if len(new_coordinates) > 1:
-            new_coordinates = coordinate_lossy_compression(new_coordinates)  # this could be optimized
-        # now calculate bearings and put results in update_flight_dict
-        bearing_dict = calculate_bearings_and_turns(new_coordinates, existing_flight_dict['LastTurnPoint'])
-        new_coordinates = bearing_dict['coordinates']
-        update_flight_dict['LastTurnPoint'] = bearing_dict['LastTurnPoint']
-        update_flight_dict['LiveTurns'] += bearing_dict['new_turns']
-        update_flight_dict['SurveillanceScore'] += bearing_dict['surveillance_score_incr']
-
-        new_geometry = dict(existing_flight_dict['geometry'])
-        new_geometry['coordinates'] = new_coordinates
-
-        update_flight_dict['geometry'] = new_geometry
-        update_flight_dict['LastSeen'] = flight_snippet_dict['LastSeen']
-        update_flight_dict['LandedScan'] += 1
+        expected_version = version_of(existing_flight_fields)
+        landed_scan_count = int(existing_flight_fields['LandedScan']) + 1
+        update_flight_fields = {}
+
+        # only points newer than the flight's time watermark are merged; everything at or before it was already seen
+        time_watermark = existing_flight_fields.get('TimeWatermark')
+        if time_watermark is None:  # flights stored before the watermark existed
+            time_watermark = last_coordinate[3] if last_coordinate is not None else 0
+        new_points = [x for x in flight_snippet_dict['geometry']['coordinates'] if x[3] > time_watermark and x[2] != 0]  # disregard coordinate if altitude = 0
+        if len(new_points) > 0:
+            update_flight_fields['TimeWatermark'] = max(x[3] for x in new_points)
+
+        # drop jitter against the last stored coordinate, calculate bearings for just that tail,
+        # then simplify it keeping the turn points
+        if last_coordinate is not None:
+            new_tail = filter_jitter(last_coordinate, new_points)
+            bearing_dict = calculate_bearings_and_turns([last_coordinate] + new_tail, existing_flight_fields['LastTurnPoint'], bearing_mode)
+            new_tail = simplify_tail(last_coordinate, new_tail, tail_tolerance, turn_points(bearing_dict['turn_indexes'], 1))
+        else:
+            new_tail = filter_jitter(None, new_points)
+            bearing_dict = calculate_bearings_and_turns(new_tail, existing_flight_fields['LastTurnPoint'], bearing_mode)
+            new_tail = simplify_tail(None, new_tail, tail_tolerance, turn_points(bearing_dict['turn_indexes']))
+        cells = heatmap_cells(bearing_dict)
+        update_flight_fields['LastTurnPoint'] = bearing_dict['LastTurnPoint']
+        update_flight_fields['LiveTurns'] = existing_flight_fields['LiveTurns'] + bearing_dict['new_turns']
+        update_flight_fields['SurveillanceScore'] = existing_flight_fields['SurveillanceScore'] + bearing_dict['surveillance_score_incr']
+        if len(bearing_dict['turn_events']) > 0:  # the decayed scores only change, and the flight is only re-ranked, on turns
+            update_flight_fields['WindowScores'], update_flight_fields['ScoredAt'] = scoring.apply_turn_events(
+                existing_flight_fields.get('WindowScores'), existing_flight_fields.get('ScoredAt'), bearing_dict['turn_events'])
+        update_flight_fields['LastSeen'] = flight_snippet_dict['LastSeen']
+        update_flight_fields['LandedScan'] = landed_scan_count
 
         # check if the aircraft landed
-        if landed_scan_count >= 10:
+        if landed_scan_count >= landing_check_scans:
             # landing_check gets the airport ID of the nearest airport in range, or 0 if none
-            landing_check = extended_landing_check(new_coordinates, r)
+            landing_check = landed_airports.get(icao, 0) if landed_airports is not None else 0
             if landing_check != 0:
                 logger.debug("The plane landed")
-                update_flight_dict['FlightStatus'] = 'Landed'
-                update_flight_dict['LandedAirportID'] = landing_check
-                existing_flight_dict.update(update_flight_dict)
+                landed_flight_dict = updater.load(icao)
+                if track_tiers is not None:
+                    track_tiers.stitch_many([landed_flight_dict])
+                landed_coordinates = landed_flight_dict['geometry']['coordinates']
+                if len(landed_coordinates) > 0:
+                    landed_coordinates[-1] = last_coordinate  # now carries its bearing
+                landed_coordinates.extend(new_tail)
+                landed_flight_dict.update(update_flight_fields)
+                landed_flight_dict['FlightStatus'] = 'Landed'
+                landed_flight_dict['LandedAirportID'] = landing_check
+
+                # delete from redis, unless the flight changed since we read it
+                if not updater.delete(icao, expected_version):
+                    return False
+                landing_detector.forget(icao)
+                if merged is not None:
+                    merged.append((tag, bearing_dict['new_turns'], cells, True))
 
                 # if this has some coordinates, write flight to mongodb
-                if len(existing_flight_dict['geometry']['coordinates']) > 1:
-                    dbmongo.flighthistory.insert_one(existing_flight_dict)
-
-                # delete from redis and exit function
-                r.delete(flight_snippet_dict['Icao'])
-                r.zrem("flight_scan_times", flight_snippet_dict['Icao'])
-                r.zrem("surveillance_score", flight_snippet_dict['Icao'])
-                return 0
+                landed_flight_dict['geometry']['coordinates'] = landed_coordinates = simplify_archive(landed_coordinates)
+                queued = False
+                if len(landed_coordinates) > 1:
+                    if flight_writer is not None:
+                        flight_writer.write(landed_flight_dict)  # written in the background, merging goes on
+                        queued = True
+                    else:
+                        dbmongo.flighthistory.insert_one(landed_flight_dict)
+                if track_tiers is not None:
+                    if queued:
+                        # the writer deletes the segments once the archive is in mongo
+                        track_tiers.forget([landed_flight_dict])
+                    else:
+                        track_tiers.discard([landed_flight_dict])
+                return True
             else:
                 # reset the counter
-                update_flight_dict['LandedScan'] = 0
+                update_flight_fields['LandedScan'] = 0
 
-        # update redis
-        r.zadd("flight_scan_times", update_flight_dict['LastSeen'], update_flight_dict['Icao'])
-        r.zadd("surveillance_score", update_flight_dict['SurveillanceScore'], update_flight_dict['Icao'])
-        r.set(update_flight_dict['Icao'], json.dumps(update_flight_dict))
-    return 0
+        # append the new tail to the packed track (and the bearing now known for the old last point),
+        # update the flight fields and both ranked lists in one round trip
+        if merged is not None:
+            merged.append((tag, bearing_dict['new_turns'], cells, False))
+        return updater.append(icao, expected_version, record_count, last_coordinate, new_tail, update_flight_fields, tag)
 
 
 def consume():
     """Creates mongo, redis, and rabbitmq connections; consumes queue."""
+    global snapshot_publisher, flight_writer, track_tiers, turn_heatmap
     logger.debug("Consume started")
+    metrics.configure('consumer', metrics_directory)
     redis_host = 'localhost'
     redis_port = 6379
     # connect to mongodb
     client = MongoClient()
     dbmongo = client.rt_flights_test
+    if use_track_tiers == 1:
+        track_tiers = TrackTiers(dbmongo[segment_collection])
+    flight_writer = FlightWriter(dbmongo.flighthistory, compact=compact_flight_documents == 1,
+                                 on_written=track_tiers.delete_segments if track_tiers is not None else None)
+    if use_turn_heatmap == 1:
+        turn_heatmap = TurnHeatmap(dbmongo[heatmap_collection])
     # connect to redis
     r = redis.StrictRedis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+    # packed tracks are binary, so the track store gets its own connection without decoding
+    updater = CachedFlightUpdater(TrackStore(redis.StrictRedis(host=redis_host, port=redis_port, db=0)), use_redis_scripts == 1,
+                                  flight_cache_size, write_batch_size)
+    # clients are created after the fork, one pooled client per consumer process
+    if publish_to_s3 == 1:
+        backend = S3Backend(vrs_credentials, max_connections=publish_threads)
+    else:
+        backend = LocalBackend(publish_directory)
+    snapshot_publisher = SnapshotPublisher(backend, publish_threads, write_bundle=write_snapshot_bundle == 1,
+                                           write_flight_files=write_flight_files == 1, write_delta=write_snapshot_delta == 1)
     # connect to rabbitmq and create queue
     connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
     channel = connection.channel()
-    task_queue = channel.queue_declare(queue=queue_name, durable=True)
-    channel.basic_qos(prefetch_count=1)
-    # start pulling data off the queue
-    channel.basic_consume(lambda ch, method, properties, body: callback(ch, method, properties, body, r, dbmongo), queue=queue_name)
-    channel.start_consuming()
-    client.close()
+    channel.basic_qos(prefetch_count=consumer_prefetch)
+    on_message = lambda ch, method, properties, body: callback(ch, method, properties, body, r, updater, dbmongo)
+    if use_icao_shards == 1:
+        for shard in range(shard_count):
+            channel.queue_declare(queue=shard_queue(shard), durable=True)
+        membership = WorkerMembership(r)
+        consumer_tags = {}
+
+        def rebalance():
+            """Heartbeats, then follows the hash ring: stops consuming shards we lost and starts on shards we gained."""
+            owned_shards = membership.owned_shards(membership.heartbeat())
+            lost_shards = [shard for shard in consumer_tags if shard not in owned_shards]
+            for shard in lost_shards:
+                channel.basic_cancel(consumer_tags.pop(shard))  # undelivered messages go back to the queue
+            if len(lost_shards) > 0:
+                updater.evict(lambda icao: shard_for_icao(icao) not in owned_shards)
+            gained_shards = [shard for shard in owned_shards if shard not in consumer_tags]
+            for shard in gained_shards:
+                consumer_tags[shard] = channel.basic_consume(on_message, queue=shard_queue(shard))
+            if len(lost_shards) > 0 or len(gained_shards) > 0:
+                logger.debug("{0} now owns shards {1}".format(membership.name, sorted(owned_shards)))
+            connection.add_timeout(rebalance_interval, rebalance)
+
+        rebalance()
+    else:
+        task_queue = channel.queue_declare(queue=queue_name, durable=True)
+        # start pulling data off the queue
+        channel.basic_consume(on_message, queue=queue_name)
+    try:
+        channel.start_consuming()
+    finally:
+        if use_icao_shards == 1:
+            membership.leave()
+        if turn_heatmap is not None:
+            turn_heatmap.flush(r)
+        flight_writer.close()
+        client.close()
     return 0
 
 
+def load_airport_index():
+    """Maps the airport index before the workers fork so they all share it; falls back to redis GEORADIUS without it."""
+    global airport_index
+    try:
+        airport_index = AirportIndex(airport_index_path)
+        logger.debug("Loaded {0} airports from {1}".format(airport_index.count, airport_index_path))
+    except (OSError, ValueError) as e:
+        logger.error("No airport index at {0}, using the redis airports key: {1}".format(airport_index_path, e))
+
+
 def main():
     """Launches consume() function in n multiple processes, where n = number of cores."""
+    load_airport_index()
+    client = MongoClient()
+    ensure_indexes(client.rt_flights_test.flighthistory)  # once, rather than on every poll
+    ensure_segment_indexes(client.rt_flights_test[segment_collection])
+    ensure_heatmap_indexes(client.rt_flights_test[heatmap_collection])
+    client.close()  # the workers open their own clients after the fork
     os.chdir("/opt/output-json")
     cores = mp.cpu_count()
     jobs = []
@@ -341,6 +501,11 @@ def main():
         p = mp.Process(target=consume)
         jobs.append(p)
         p.start()
+    if metrics_port != 0:
+        metrics.serve(metrics_port, metrics_directory)  # started after the fork so workers do not inherit the thread
+    for p in jobs:
+        p.join()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped airport index for landing checks.
+
+Replaces the redis 'airports' geo set. The index is a single file built once
+from the ourairports CSV (see airport-index-builder.py) holding airports
+bucketed on a regular lat/lon grid:
+
+header    magic b'SSWA', format version, grid cell size, airport count,
+          grid rows/columns, id width, build time (unix seconds)
+offsets   uint32 per grid cell (+1): airports of cell c are [offsets[c], offsets[c+1])
+latitude  float64 per airport, sorted by cell
+longitude float64 per airport
+ids       fixed-width ASCII airport IDs
+
+The file is opened with mmap, so every consumer process forked after loading
+shares the same pages and startup costs no parsing. Distances use the same
+haversine and earth radius as redis GEORADIUS, so results match the old lookup.
+"""
+
+import mmap
+import struct
+import time
+
+import numpy as np
+
+index_magic = b'SSWA'
+index_version = 1
+index_header = struct.Struct('<4sHdIIIHd')
+header_size = 64
+earth_radius = 6372797.560856  # metres, as used by redis geo commands
+max_latitude = 85.05112878  # redis geo sets cannot hold points beyond this latitude
+default_cell_degrees = 0.5
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _grid_shape(cell_degrees):
+    return int(np.ceil(180.0 / cell_degrees)), int(np.ceil(360.0 / cell_degrees))
+
+
+def _cells(latitudes, longitudes, cell_degrees, rows, columns):
+    row = np.clip(((np.asarray(latitudes) + 90.0) // cell_degrees).astype(np.int64), 0, rows - 1)
+    column = np.clip(((np.asarray(longitudes) + 180.0) // cell_degrees).astype(np.int64), 0, columns - 1)
+    return row * columns + column
+
+
+def build_index(airports, path, cell_degrees=default_cell_degrees):
+    """Writes an index file from (airport ID, latitude, longitude) tuples; returns the airport count."""
+    airports = [a for a in airports if abs(a[1]) <= max_latitude and abs(a[2]) <= 180.0]
+    rows, columns = _grid_shape(cell_degrees)
+    ids = np.array([str(a[0]).encode('ascii') for a in airports], dtype=bytes)
+    latitudes = np.array([a[1] for a in airports], dtype='<f8')
+    longitudes = np.array([a[2] for a in airports], dtype='<f8')
+    cells = _cells(latitudes, longitudes, cell_degrees, rows, columns)
+    order = np.argsort(cells, kind='stable')
+    counts = np.bincount(cells, minlength=rows * columns)
+    offsets = np.zeros(rows * columns + 1, dtype='<u4')
+    offsets[1:] = np.cumsum(counts)
+    id_width = max(ids.dtype.itemsize, 1)
+
+    with open(path, 'wb') as index_file:
+        header = index_header.pack(index_magic, index_version, cell_degrees, len(airports), rows, columns, id_width, time.time())
+        index_file.write(header.ljust(header_size, b'\0'))
+        for array in (offsets, latitudes[order], longitudes[order], ids[order].astype('S{0}'.format(id_width))):
+            index_file.write(b'\0' * (_align(index_file.tell()) - index_file.tell()))
+            index_file.write(array.tobytes())
+    return len(airports)
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance in metres on the redis geo sphere; arguments may be arrays."""
+    phi1, phi2 = np.radians(latitude1), np.radians(latitude2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(longitude2 - longitude1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class AirportIndex(object):
+    """Read-only nearest-airport lookups over a memory-mapped index file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.cell_degrees, self.count, self.rows, self.columns, id_width, self.built = \
+            index_header.unpack_from(self.buffer)
+        if magic != index_magic or version != index_version:
+            raise ValueError("{0} is not a version {1} airport index".format(path, index_version))
+        offset = header_size
+        arrays = []
+        for dtype, length in (('<u4', self.rows * self.columns + 1), ('<f8', self.count), ('<f8', self.count), ('S{0}'.format(id_width), self.count)):
+            offset = _align(offset)
+            array = np.frombuffer(self.buffer, dtype=dtype, count=length, offset=offset)
+            offset += array.nbytes
+            arrays.append(array)
+        self.offsets, self.latitudes, self.longitudes, self.ids = arrays
+
+    def _candidates(self, latitude, longitude, radius):
+        """Index ranges of the airports in grid cells that may lie within radius of the point."""
+        lat_margin = np.degrees(radius / earth_radius)
+        lat_low, lat_high = max(latitude - lat_margin, -90.0), min(latitude + lat_margin, 90.0)
+        widest = np.cos(np.radians(min(max(abs(lat_low), abs(lat_high)), 89.999)))
+        lon_margin = min(lat_margin / widest, 180.0)
+        row_low = max(int((lat_low + 90.0) // self.cell_degrees), 0)
+        row_high = min(int((lat_high + 90.0) // self.cell_degrees), self.rows - 1)
+        if lon_margin >= 180.0:
+            column_spans = [(0, self.columns - 1)]
+        else:
+            column_low = int((longitude - lon_margin + 180.0) // self.cell_degrees)
+            column_high = int((longitude + lon_margin + 180.0) // self.cell_degrees)
+            # split spans that cross the antimeridian
+            if column_low < 0:
+                column_spans = [(column_low + self.columns, self.columns - 1), (0, column_high)]
+            elif column_high >= self.columns:
+                column_spans = [(column_low, self.columns - 1), (0, column_high - self.columns)]
+            else:
+                column_spans = [(column_low, column_high)]
+        ranges = []
+        for row in range(row_low, row_high + 1):
+            for column_low, column_high in column_spans:
+                start = self.offsets[row * self.columns + column_low]
+                end = self.offsets[row * self.columns + column_high + 1]
+                if end > start:
+                    ranges.append((start, end))
+        return ranges
+
+    def nearest(self, coordinate, radius=5000):
+        """Returns the ID of the closest airport within radius metres of a (lon, lat) coordinate, or 0 if none."""
+        longitude, latitude = float(coordinate[0]), float(coordinate[1])
+        if abs(latitude) >= max_latitude:
+            return 0
+        ranges = self._candidates(latitude, longitude, radius)
+        if len(ranges) == 0:
+            return 0
+        candidates = np.concatenate([np.arange(start, end) for start, end in ranges])
+        distances = haversine(latitude, longitude, self.latitudes[candidates], self.longitudes[candidates])
+        closest = int(np.argmin(distances))
+        if distances[closest] > radius:
+            return 0
+        return self.ids[candidates[closest]].decode('ascii')
+
+    def nearest_many(self, coordinates, radius=5000):
+        """nearest() for a batch of (lon, lat) coordinates."""
+        return [self.nearest(coordinate, radius) for coordinate in coordinates]
+
+
+def georadius_nearest_many(r, coordinates, radius=5000):
+    """nearest() against the legacy redis 'airports' geo set, pipelined into one round trip."""
+    pipe = r.pipeline(transaction=False)
+    for coordinate in coordinates:
+        if abs(coordinate[1]) < max_latitude:
+            pipe.georadius('airports', coordinate[0], coordinate[1], radius=radius, unit='m', count=1, sort='ASC')
+    replies = iter(pipe.execute())
+    nearest = []
+    for coordinate in coordinates:
+        airports_in_range = next(replies) if abs(coordinate[1]) < max_latitude else []
+        if len(airports_in_range) == 0:
+            nearest.append(0)
+        else:
+            airport_id = airports_in_range[0]
+            nearest.append(airport_id.decode() if isinstance(airport_id, bytes) else airport_id)
+    return nearest
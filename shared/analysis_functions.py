@@ -97,7 +97,6 @@ def calculate_bearings_and_turns(coordinates, last_turn_point):
             if abs(max(last_turn_bearing, current_bearing) - min(last_turn_bearing, current_bearing)) > 90.0:
                 altitude = coordinates[i][2]
                 surveillance_score_incr += score_altitude(altitude)
-                print("Turn ", turn_count, " identified. Point ", last_turn_point, " to ", coordinates[i+1])
                 turn_count += 1
                 last_turn_bearing = current_bearing
                 last_turn_point = coordinates[i+1]
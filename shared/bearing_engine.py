@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array-based bearing and turn engine.
+
+Drop-in replacement for analysis_functions.calculate_bearings_and_turns that
+works on whole coordinate arrays (or a batch of many flights at once) instead
+of calling geodesic.Geodesic.WGS84.Inverse once per coordinate pair.
+
+Two azimuth modes are available:
+
+'wgs84'     - vectorized Vincenty inverse on the WGS84 ellipsoid. Pairs that
+              Vincenty cannot handle (coincident points, poles, near-antipodal
+              pairs that fail to converge) fall back to geographiclib, so the
+              results agree with geodesic.Geodesic.WGS84.Inverse well below the
+              1e-4 degree rounding applied to stored bearings.
+'spherical' - great-circle initial bearing on a sphere using geodetic latitude.
+              Cheaper again, but ignores flattening: for segments shorter than
+              100 km (ADS-B trail points are seconds apart) the azimuth differs
+              from WGS84 by at most 0.2 degrees, worst around 45/135 degree
+              headings near the equator. Turns are counted at a 90 degree
+              threshold, so only bearings within 0.2 degrees of that threshold
+              can be classified differently.
+"""
+
+from geographiclib import geodesic
+import numpy as np
+import logging
+
+logger = logging.getLogger()
+
+wgs84_a = 6378137.0
+wgs84_f = 1 / 298.257223563
+vincenty_max_iterations = 20
+vincenty_tolerance = 1e-12
+turn_threshold = 90.0  # degrees between the last turn bearing and the current bearing
+
+# upper bounds (feet) of the altitude bands used by score_altitude, and the score for each band
+altitude_band_edges = np.array([0.0, 1000.0, 4000.0, 6000.0, 7000.0, 12000.0, 17000.0, 23000.0, 25000.0, 55000.0])
+altitude_band_scores = np.array([0, 1, 2, 3, 5, 10, 5, 3, 2, 1, 0])
+
+azimuth_modes = ('wgs84', 'spherical')
+
+
+def altitude_band_array(altitudes):
+    """Returns the score_altitude band (an index into altitude_band_scores) of each altitude in an array."""
+    altitudes = np.asarray(altitudes, dtype=float)
+    # side='left' puts alt in band k when edges[k-1] < alt <= edges[k], matching score_altitude
+    # NaN sorts past the last edge and lands in the trailing zero band
+    return np.searchsorted(altitude_band_edges, altitudes, side='left')
+
+
+def score_altitude_array(altitudes):
+    """Returns score_altitude for each altitude in an array. None or NaN altitudes score 0."""
+    return altitude_band_scores[altitude_band_array(altitudes)]
+
+
+def _geographiclib_azimuths(lon1, lat1, lon2, lat2):
+    """Per-pair geographiclib azimuths, used as the fallback for awkward pairs."""
+    azimuths = np.empty(len(lon1))
+    for i in range(len(lon1)):
+        azimuths[i] = geodesic.Geodesic.WGS84.Inverse(lat1[i], lon1[i], lat2[i], lon2[i], geodesic.Geodesic.AZIMUTH)['azi1']
+    return azimuths
+
+
+def _vincenty_azimuths(lon1, lat1, lon2, lat2):
+    """Vectorized Vincenty inverse returning the initial azimuth on WGS84."""
+    f = wgs84_f
+    lon_delta = np.radians((lon2 - lon1 + 180.0) % 360.0 - 180.0)
+    u1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = lon_delta.copy()
+    converged = np.zeros(len(lam), dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(vincenty_max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = cos_u1 * cos_u2 * sin_lam / sin_sigma
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # equatorial lines have cos_sq_alpha == 0 and no defined cos_2sigma_m
+            cos_2sigma_m = np.where(cos_sq_alpha != 0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha, 0.0)
+            c = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            lam_next = lon_delta + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam_next - lam) < vincenty_tolerance
+            lam = lam_next
+            if converged.all():
+                break
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        azimuths = np.degrees(np.arctan2(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam))
+
+    # coincident points, poles and non-converged pairs go to geographiclib
+    fallback = ~converged | ~np.isfinite(azimuths) | ((lon_delta == 0) & (lat1 == lat2)) | \
+        (np.abs(lat1) >= 90.0) | (np.abs(lat2) >= 90.0)
+    if fallback.any():
+        azimuths[fallback] = _geographiclib_azimuths(lon1[fallback], lat1[fallback], lon2[fallback], lat2[fallback])
+    return azimuths
+
+
+def _spherical_azimuths(lon1, lat1, lon2, lat2):
+    """Great-circle initial bearing on a sphere, see the module docstring for the error bound."""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    lon_delta = np.radians(lon2 - lon1)
+    y = np.sin(lon_delta) * np.cos(phi2)
+    x = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(lon_delta)
+    return np.degrees(np.arctan2(y, x))
+
+
+def azimuths(lon1, lat1, lon2, lat2, mode='wgs84'):
+    """Returns initial azimuths in degrees [0, 360) for arrays of point pairs."""
+    lon1, lat1, lon2, lat2 = (np.asarray(a, dtype=float) for a in (lon1, lat1, lon2, lat2))
+    if len(lon1) == 0:
+        return np.empty(0)
+    if mode == 'wgs84':
+        result = _vincenty_azimuths(lon1, lat1, lon2, lat2)
+    elif mode == 'spherical':
+        result = _spherical_azimuths(lon1, lat1, lon2, lat2)
+    else:
+        raise ValueError("Unknown azimuth mode '{0}', expected one of {1}".format(mode, azimuth_modes))
+    # same normalisation as calculate_bearings_and_turns: only negative bearings get 360 added
+    return np.where(result < 0.0, result + 360.0, result)
+
+
+def _next_turn(bearings, start, reference):
+    """Index of the first bearing at or after start more than turn_threshold from reference, or None."""
+    chunk = 16
+    while start < len(bearings):
+        hits = np.abs(bearings[start:start + chunk] - reference) > turn_threshold
+        if hits.any():
+            return start + int(np.argmax(hits))
+        start += chunk
+        chunk *= 2  # long straight legs: widen the window so the scan stays O(n) in numpy
+    return None
+
+
+def _pending_pairs(coordinates):
+    """Indexes of coordinates that still need a bearing (every point but the last without one)."""
+    return [i for i in range(len(coordinates) - 1) if len(coordinates[i]) != 5]
+
+
+def _apply_turns(coordinates, last_turn_point, pending, bearings):
+    """Stores bearings on the coordinates and walks turns, returning the calculate_bearings_and_turns dict."""
+    # if we don't have a bearing to start with, start with a bearing that will always be more than 90 degrees off
+    # first point should count as the first turn
+    if len(last_turn_point) == 4 or (len(last_turn_point) == 5 and last_turn_point[4] is None):
+        last_turn_bearing = 999.0
+        turn_count = -1
+    else:
+        last_turn_bearing = last_turn_point[4]
+        turn_count = 0
+
+    for i, bearing in zip(pending, np.round(bearings, 4).tolist()):
+        coordinates[i].append(bearing)
+
+    turn_positions = []
+    position = _next_turn(bearings, 0, last_turn_bearing)
+    while position is not None:
+        turn_positions.append(position)
+        position = _next_turn(bearings, position + 1, bearings[position])
+
+    surveillance_score_incr = 0
+    turn_events = []
+    turn_indexes = [pending[p] for p in turn_positions]
+    if turn_positions:
+        altitudes = [coordinates[i][2] for i in turn_indexes]
+        turn_scores = score_altitude_array(np.array(altitudes, dtype=float))
+        surveillance_score_incr = int(turn_scores.sum())
+        turn_events = [(coordinates[i][3], int(score)) for i, score in zip(turn_indexes, turn_scores)]
+        turn_count += len(turn_positions)
+        last_turn_point = coordinates[turn_indexes[-1] + 1]
+    if turn_count < 0:
+        turn_count = 0
+    return {"coordinates": coordinates, "LastTurnPoint": last_turn_point, "new_turns": turn_count, "surveillance_score_incr": surveillance_score_incr,
+            "turn_indexes": turn_indexes, "turn_events": turn_events}
+
+
+def find_turn_indices(coordinates):
+    """Indexes of the coordinates whose stored bearing starts a turn, walking the track from its first bearing."""
+    bearing_indexes = [i for i in range(len(coordinates)) if len(coordinates[i]) == 5 and coordinates[i][4] is not None]
+    bearings = np.array([coordinates[i][4] for i in bearing_indexes], dtype=float)
+    turn_indexes = []
+    position = _next_turn(bearings, 0, 999.0)
+    while position is not None:
+        turn_indexes.append(bearing_indexes[position])
+        position = _next_turn(bearings, position + 1, bearings[position])
+    return turn_indexes
+
+
+def calculate_bearings_and_turns(coordinates, last_turn_point, mode='wgs84'):
+    """Takes a list of coordinates and finds turns, computing all missing bearings as one array operation."""
+    pending = _pending_pairs(coordinates)
+    if pending:
+        points = np.array([coordinates[i][0:2] + coordinates[i+1][0:2] for i in pending], dtype=float)
+        bearings = azimuths(points[:, 0], points[:, 1], points[:, 2], points[:, 3], mode)
+    else:
+        bearings = np.empty(0)
+    return _apply_turns(coordinates, last_turn_point, pending, bearings)
+
+
+def calculate_bearings_and_turns_batch(flights, mode='wgs84'):
+    """Takes (coordinates, last_turn_point) pairs for many flights and returns one result dict per flight.
+
+    Azimuths for every flight are computed in a single array operation; turn detection then runs per flight.
+    """
+    flights = list(flights)
+    pending_per_flight = []
+    points = []
+    for coordinates, _ in flights:
+        pending = _pending_pairs(coordinates)
+        pending_per_flight.append(pending)
+        points.extend(coordinates[i][0:2] + coordinates[i+1][0:2] for i in pending)
+    if points:
+        points = np.array(points, dtype=float)
+        all_bearings = azimuths(points[:, 0], points[:, 1], points[:, 2], points[:, 3], mode)
+    else:
+        all_bearings = np.empty(0)
+
+    results = []
+    offset = 0
+    for (coordinates, last_turn_point), pending in zip(flights, pending_per_flight):
+        bearings = all_bearings[offset:offset + len(pending)]
+        offset += len(pending)
+        results.append(_apply_turns(coordinates, last_turn_point, pending, bearings))
+    return results
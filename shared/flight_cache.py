@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process hot state for the flights a consumer owns.
+
+CachedFlightUpdater keeps the head of each recently merged flight (fields, last
+coordinate, record count) in an LRU, so a worker that owns an aircraft's shard
+merges consecutive snippets without reading redis first. Commits are queued and
+written through in pipelined batches; every commit still carries the expected
+Version, so if another worker touched the flight (for example while shard
+ownership is moving) the commit fails, the cached head is dropped and the tag
+passed with the commit comes back from flush() to be merged again.
+"""
+
+from collections import OrderedDict
+
+from shared.flight_update import FlightUpdater
+
+
+class CachedFlightUpdater(FlightUpdater):
+    """FlightUpdater that caches flight heads in an LRU and writes through in batches."""
+
+    def __init__(self, store, use_scripts=True, capacity=10000, batch_size=200):
+        super(CachedFlightUpdater, self).__init__(store, use_scripts)
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.heads = OrderedDict()
+        self.pending = []
+        self.failed = []
+
+    def _remember(self, icao, head):
+        self.heads[icao] = head
+        self.heads.move_to_end(icao)
+        while len(self.heads) > self.capacity:
+            self.heads.popitem(last=False)
+
+    def load_head(self, icao):
+        return self.load_heads([icao])[0]
+
+    def load_heads(self, icao_list):
+        """Returns flight heads, reading only the uncached ones from redis (in one round trip)."""
+        if any(icao not in self.heads for icao in icao_list):
+            self._write_pending()  # redis must reflect queued commits before it is read
+        found = {}
+        for icao in icao_list:
+            if icao not in found and icao in self.heads:
+                found[icao] = self.heads[icao]
+                self.heads.move_to_end(icao)
+        missing = list(OrderedDict.fromkeys(icao for icao in icao_list if icao not in found))
+        if len(missing) > 0:
+            for icao, head in zip(missing, self.store.load_heads(missing)):
+                found[icao] = head
+                self._remember(icao, head)  # may evict other heads of this batch, so they are read from found
+        heads = []
+        for icao in icao_list:
+            fields, last_coordinate, record_count = found[icao]
+            # the merge appends a bearing to the last coordinate, so hand out a copy
+            heads.append((fields, list(last_coordinate) if last_coordinate is not None else None, record_count))
+        return heads
+
+    def read_tail(self, icao, seconds):
+        self._write_pending()
+        return self.store.read_tail(icao, seconds)
+
+    def load(self, icao):
+        self._write_pending()
+        return self.store.load(icao)
+
+    def load_many(self, icao_list):
+        self._write_pending()
+        return self.store.load_many(icao_list)
+
+    def create(self, flight_dict, tag=None):
+        """Queues a new flight; returns True, conflicts are reported by flush()."""
+        commit = self.prepare_create(flight_dict)
+        coordinates = flight_dict['geometry']['coordinates']
+        head = (commit[3], list(coordinates[-1]) if len(coordinates) > 0 else None, len(coordinates))
+        return self._queue(commit, tag, head)
+
+    def append(self, icao, expected_version, record_count, last_coordinate, new_coordinates, field_updates, tag=None):
+        """Queues an append; returns True, conflicts are reported by flush()."""
+        commit = self.prepare_append(icao, expected_version, record_count, last_coordinate, new_coordinates, field_updates)
+        cached = self.heads.get(icao)
+        if cached is None or cached[0] is None:
+            # evicted meanwhile: queue it, but do not guess at a head to cache
+            return self._queue(commit, tag, None)
+        fields = dict(cached[0])
+        fields.update(commit[3])
+        new_last = new_coordinates[-1] if len(new_coordinates) > 0 else last_coordinate
+        head = (fields, list(new_last) if new_last is not None else None, record_count + len(new_coordinates))
+        return self._queue(commit, tag, head)
+
+    def spill(self, icao, expected_version, spilled_records, field_updates):
+        """Drops the oldest records immediately, after writing anything queued; returns False on a conflict."""
+        self._write_pending()
+        commit = self.prepare_spill(icao, expected_version, spilled_records, field_updates)
+        applied = self.commit(commit)
+        cached = self.heads.get(icao)
+        if not applied or cached is None or cached[0] is None:
+            self.heads.pop(icao, None)
+            return applied
+        fields = dict(cached[0])
+        fields.update(commit[3])
+        self.heads[icao] = (fields, cached[1], cached[2] - spilled_records)
+        return True
+
+    def delete(self, icao, expected_version):
+        """Deletes immediately, after writing anything queued; returns False on a conflict."""
+        self._write_pending()
+        self.heads.pop(icao, None)
+        return self.commit(self.prepare_delete(icao, expected_version))
+
+    def delete_many(self, deletes):
+        """delete() for several flights in one round trip."""
+        self._write_pending()
+        for icao, expected_version in deletes:
+            self.heads.pop(icao, None)
+        return FlightUpdater.delete_many(self, deletes)
+
+    def _queue(self, commit, tag, head):
+        self.pending.append((commit, tag))
+        if head is not None:
+            self._remember(commit[0], head)
+        if len(self.pending) >= self.batch_size:
+            self._write_pending()
+        return True
+
+    def _write_pending(self):
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = self.pending, []
+        results = self.commit_many([commit for commit, tag in pending])
+        for (commit, tag), applied in zip(pending, results):
+            if not applied:
+                self.heads.pop(commit[0], None)
+                self.failed.append(tag)
+
+    def flush(self):
+        """Writes queued commits and returns the tags of every commit that lost a race since the last flush."""
+        self._write_pending()
+        failed, self.failed = self.failed, []
+        return failed
+
+    def evict(self, predicate):
+        """Writes queued commits and drops cached heads whose Icao matches predicate, e.g. after losing a shard."""
+        self._write_pending()
+        for icao in [icao for icao in self.heads if predicate(icao)]:
+            del self.heads[icao]
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Atomic flight updates against the redis track store.
+
+A merge reads the flight head once (TrackStore.load_head) and then commits
+everything it changed in a single round trip: the bearing of the previous last
+point, the appended tail, the updated flight fields and the sorted sets
+(flight_scan_times, surveillance_score and, when the flight's decayed score
+grew, the top-K surveillance_rank of shared/scoring.py, trimmed to
+scoring.ranking_size in the same step). The commit only applies if the
+flight's Version field still matches what was read, so two consumers racing on
+the same Icao cannot overwrite each other; the loser gets False back and
+re-runs its merge against the fresh state.
+
+Commits can also be prepared up front and applied with commit_many(), which
+pipelines many script calls into one round trip. A spill commit drops the oldest
+records of the track once shared/track_tiers.py has copied them to mongo.
+
+By default the commit is a registered Lua script. Stand-in mode (use_scripts=False)
+does the same check with WATCH/MULTI so tests can run against a local fake redis
+that has no scripting support, such as MemoryRedis in shared/standins.py.
+"""
+
+import json
+import uuid
+from redis.exceptions import WatchError
+
+from shared import metrics, scoring
+
+from shared.track_store import TrackStore, bearing_field, bearing_offset, coordinate_record, encode_fields, pack_coordinates
+
+# KEYS: flight hash, track, flight_scan_times, surveillance_score, surveillance_rank
+# ARGV: icao, expected version, new version, operation, last seen, score, bearing offset (bytes dropped for a spill), bearing,
+#       tail, rank key ('' to leave the ranking alone), ranking size, field/value pairs...
+commit_script = """
+local current = redis.call('HGET', KEYS[1], 'Version') or ''
+if current ~= ARGV[2] then
+    return 0
+end
+if ARGV[4] == 'delete' then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    redis.call('ZREM', KEYS[4], ARGV[1])
+    redis.call('ZREM', KEYS[5], ARGV[1])
+    return 1
+end
+if ARGV[4] == 'create' then
+    redis.call('DEL', KEYS[1])
+    redis.call('SET', KEYS[2], ARGV[9])
+elseif ARGV[4] == 'spill' then
+    redis.call('SET', KEYS[2], redis.call('GETRANGE', KEYS[2], tonumber(ARGV[7]), -1))
+else
+    if tonumber(ARGV[7]) >= 0 then
+        redis.call('SETRANGE', KEYS[2], tonumber(ARGV[7]), ARGV[8])
+    end
+    if string.len(ARGV[9]) > 0 then
+        redis.call('APPEND', KEYS[2], ARGV[9])
+    end
+end
+for i = 12, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], 'Version', ARGV[3])
+if ARGV[4] == 'spill' then
+    return 1
+end
+redis.call('ZADD', KEYS[3], ARGV[5], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[6], ARGV[1])
+if ARGV[10] ~= '' then
+    redis.call('ZADD', KEYS[5], ARGV[10], ARGV[1])
+    redis.call('ZREMRANGEBYRANK', KEYS[5], 0, -tonumber(ARGV[11]) - 1)
+end
+return 1
+"""
+
+
+def version_of(flight_fields):
+    """Returns the stored Version value a commit must match, '' for a flight that does not exist yet."""
+    if flight_fields is None or 'Version' not in flight_fields:
+        return ''
+    return json.dumps(flight_fields['Version'])
+
+
+def new_version():
+    """Versions are random tokens rather than counters, so two writers can never produce the same successor."""
+    return uuid.uuid4().hex[:16]
+
+
+class FlightUpdater(object):
+    """Commits merged flight state in one round trip with optimistic concurrency."""
+
+    def __init__(self, store, use_scripts=True):
+        self.store = store
+        self.use_scripts = use_scripts
+        if use_scripts:
+            self.commit_script = store.r.register_script(commit_script)
+
+    def _keys(self, icao):
+        return [TrackStore.meta_key(icao), TrackStore.track_key(icao), 'flight_scan_times', 'surveillance_score',
+                scoring.rank_key_name]
+
+    # reads go straight to the track store; CachedFlightUpdater overrides these
+    def load_head(self, icao):
+        return self.store.load_head(icao)
+
+    def load_heads(self, icao_list):
+        return self.store.load_heads(icao_list)
+
+    def read_tail(self, icao, seconds):
+        return self.store.read_tail(icao, seconds)
+
+    def load(self, icao):
+        return self.store.load(icao)
+
+    def load_many(self, icao_list):
+        return self.store.load_many(icao_list)
+
+    @staticmethod
+    def prepare_create(flight_dict):
+        """Builds the commit for a new flight; it only applies if nothing is tracked under the Icao."""
+        fields = dict(flight_dict)
+        geometry = fields.pop('geometry')
+        fields['Version'] = new_version()
+        return (flight_dict['Icao'], '', 'create', fields, pack_coordinates(geometry['coordinates']), -1, b'')
+
+    @staticmethod
+    def prepare_append(icao, expected_version, record_count, last_coordinate, new_coordinates, field_updates):
+        """Builds the commit appending a tail and updating fields of a flight still at expected_version."""
+        fields = dict(field_updates)
+        fields['Version'] = new_version()
+        offset = -1
+        bearing = b''
+        if last_coordinate is not None and len(last_coordinate) > 4 and record_count > 0:
+            offset = (record_count - 1) * coordinate_record.size + bearing_offset
+            bearing = bearing_field.pack(last_coordinate[4])
+        return (icao, expected_version, 'append', fields, pack_coordinates(new_coordinates), offset, bearing)
+
+    @staticmethod
+    def prepare_spill(icao, expected_version, spilled_records, field_updates):
+        """Builds the commit dropping the oldest spilled_records of the track and updating fields."""
+        fields = dict(field_updates)
+        fields['Version'] = new_version()
+        return (icao, expected_version, 'spill', fields, b'', spilled_records * coordinate_record.size, b'')
+
+    @staticmethod
+    def prepare_delete(icao, expected_version):
+        """Builds the commit removing a flight and its sorted set entries if it is still at expected_version."""
+        return (icao, expected_version, 'delete', {}, b'', -1, b'')
+
+    def create(self, flight_dict, tag=None):
+        """Stores a new flight if nothing was tracked under its Icao; returns False on a conflict."""
+        return self.commit(self.prepare_create(flight_dict))
+
+    def append(self, icao, expected_version, record_count, last_coordinate, new_coordinates, field_updates, tag=None):
+        """Appends a tail and updates fields if the flight is still at expected_version; returns False on a conflict."""
+        return self.commit(self.prepare_append(icao, expected_version, record_count, last_coordinate, new_coordinates, field_updates))
+
+    def spill(self, icao, expected_version, spilled_records, field_updates):
+        """Drops the oldest records of a track still at expected_version; returns False on a conflict."""
+        return self.commit(self.prepare_spill(icao, expected_version, spilled_records, field_updates))
+
+    def delete(self, icao, expected_version):
+        """Removes the flight and its sorted set entries if it is still at expected_version."""
+        return self.commit(self.prepare_delete(icao, expected_version))
+
+    def delete_many(self, deletes):
+        """Deletes (icao, expected_version) pairs in one round trip; returns which deletes applied."""
+        return self.commit_many([self.prepare_delete(icao, expected_version) for icao, expected_version in deletes])
+
+    def flush(self):
+        """Commits are applied immediately, so there is never anything left to report (see CachedFlightUpdater)."""
+        return []
+
+    def commit(self, commit):
+        """Applies one prepared commit; returns False if the flight changed since it was read."""
+        return self.commit_many([commit])[0]
+
+    def commit_many(self, commits):
+        """Applies prepared commits in order, pipelined into one round trip when scripts are available."""
+        with metrics.timer('redis_seconds', op='commit'):
+            if not self.use_scripts:
+                return [self._commit_watched(*commit) for commit in commits]
+            pipe = self.store.r.pipeline(transaction=False)
+            for commit in commits:
+                keys, args = self._script_arguments(*commit)
+                self.commit_script(keys=keys, args=args, client=pipe)
+            return [result == 1 for result in pipe.execute()]
+
+    @staticmethod
+    def _sorted_set_scores(operation, fields):
+        # creates and appends must carry LastSeen and SurveillanceScore for the sorted sets; WindowScores only come
+        # with a commit whose turns changed them, so the flight is ranked again only then
+        if operation in ('delete', 'spill'):
+            return 0, 0, ''
+        rank = ''
+        if 'WindowScores' in fields:
+            rank = scoring.rank_key(fields['WindowScores'], fields['ScoredAt'])
+        return fields['LastSeen'], fields['SurveillanceScore'], '' if rank is None else rank
+
+    def _script_arguments(self, icao, expected_version, operation, fields, tail, offset, bearing):
+        last_seen, score, rank = self._sorted_set_scores(operation, fields)
+        args = [icao, expected_version, json.dumps(fields.get('Version', '')), operation, last_seen, score, offset, bearing, tail,
+                rank, scoring.ranking_size]
+        for key, value in encode_fields({key: value for key, value in fields.items() if key != 'Version'}).items():
+            args.extend([key, value])
+        return self._keys(icao), args
+
+    def _commit_watched(self, icao, expected_version, operation, fields, tail, offset, bearing):
+        """Stand-in for the Lua script using WATCH/MULTI."""
+        meta_key, track_key, scan_times_key, score_key, rank_key = self._keys(icao)
+        last_seen, score, rank = self._sorted_set_scores(operation, fields)
+        pipe = self.store.r.pipeline()
+        try:
+            pipe.watch(meta_key)
+            current = pipe.hget(meta_key, 'Version')
+            current = current.decode() if isinstance(current, bytes) else (current or '')
+            if current != expected_version:
+                return False
+            if operation == 'spill':
+                remaining = pipe.getrange(track_key, offset, -1)  # still watching, so this runs now
+            pipe.multi()
+            if operation == 'delete':
+                pipe.delete(meta_key, track_key)
+                pipe.zrem(scan_times_key, icao)
+                pipe.zrem(score_key, icao)
+                pipe.zrem(rank_key, icao)
+            else:
+                if operation == 'create':
+                    pipe.delete(meta_key)
+                    pipe.set(track_key, tail)
+                elif operation == 'spill':
+                    pipe.set(track_key, remaining)
+                else:
+                    if offset >= 0:
+                        pipe.setrange(track_key, offset, bearing)
+                    if len(tail) > 0:
+                        pipe.append(track_key, tail)
+                pipe.hmset(meta_key, encode_fields(fields))
+            if operation in ('create', 'append'):
+                pipe.execute_command('ZADD', scan_times_key, last_seen, icao)
+                pipe.execute_command('ZADD', score_key, score, icao)
+                if rank != '':
+                    pipe.execute_command('ZADD', rank_key, rank, icao)
+                    pipe.zremrangebyrank(rank_key, 0, -scoring.ranking_size - 1)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+        finally:
+            pipe.reset()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Region-of-interest prefilter for the converter.
+
+A Geofence holds regions of interest, each either a bounding box
+{'name': ..., 'bounds': (south, west, north, east)} (west > east crosses the
+antimeridian) or a polygon {'name': ..., 'polygon': [[lon, lat], ...]} (split
+polygons that cross the antimeridian in two). Regions are rasterized once into
+a global grid of cell_size degree cells marked outside, inside or boundary, so
+testing a trail point is one array lookup; only points in boundary cells get
+the exact box or polygon test. keep() tests every point of a TrailBatch (see
+shared/trail_decode.py) at once.
+
+An aircraft is kept if any of its trail points is in a region within the
+altitude band (points without an altitude count), and it is not excluded by
+callsign prefix (for example airline ICAO designators) or aircraft type. Kept
+and dropped aircraft are counted in geofence_aircraft_total by result.
+"""
+
+import math
+
+import numpy as np
+
+from shared import metrics
+from shared.track_store import altitude_none
+
+cell_outside = 0
+cell_inside = 1
+cell_boundary = 2
+
+
+def box_contains(bounds, longitudes, latitudes):
+    south, west, north, east = bounds
+    in_latitude = (latitudes >= south) & (latitudes <= north)
+    if west <= east:
+        return in_latitude & (longitudes >= west) & (longitudes <= east)
+    return in_latitude & ((longitudes >= west) | (longitudes <= east))
+
+
+def polygon_contains(polygon, longitudes, latitudes):
+    """Even-odd test of many points against a polygon given as an N x 2 array of lon, lat."""
+    inside = np.zeros(len(longitudes), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(np.roll(polygon, 1, axis=0), polygon):
+        if y1 == y2:
+            continue
+        crosses = (y1 > latitudes) != (y2 > latitudes)
+        inside ^= crosses & (longitudes < x1 + (latitudes - y1) * (x2 - x1) / (y2 - y1))
+    return inside
+
+
+class Geofence(object):
+    """Regions of interest with a precomputed grid, plus altitude and callsign/type exclusions."""
+
+    def __init__(self, regions, cell_size=0.25, min_altitude=None, max_altitude=None, excluded_callsigns=(), excluded_types=()):
+        self.cell_size = cell_size
+        self.min_altitude = min_altitude  # feet
+        self.max_altitude = max_altitude
+        self.excluded_callsigns = tuple(excluded_callsigns)
+        self.excluded_types = frozenset(excluded_types)
+        self.columns = int(math.ceil(360 / cell_size))
+        self.rows = int(math.ceil(180 / cell_size))
+        self.grid = np.zeros((self.rows, self.columns), dtype=np.uint8)
+        self.regions = []
+        for region in regions:
+            if 'polygon' in region:
+                polygon = np.array(region['polygon'], dtype=float)
+                self.regions.append((polygon_contains, polygon))
+                self._rasterize_polygon(polygon)
+            else:
+                bounds = tuple(region['bounds'])
+                self.regions.append((box_contains, bounds))
+                self._rasterize_box(bounds)
+
+    def cells(self, longitudes, latitudes):
+        """(row, column) grid indexes of points."""
+        columns = np.clip(np.floor((longitudes + 180) / self.cell_size), 0, self.columns - 1).astype(np.intp)
+        rows = np.clip(np.floor((latitudes + 90) / self.cell_size), 0, self.rows - 1).astype(np.intp)
+        return rows, columns
+
+    def _mark(self, rows, columns, inside):
+        """Marks cells inside, or boundary where a region's edge may pass; inside wins over boundary wins over outside."""
+        cells = self.grid[rows, columns]
+        self.grid[rows, columns] = np.where(inside | (cells == cell_inside), cell_inside, cell_boundary)
+
+    def _rasterize_box(self, bounds):
+        south, west, north, east = bounds
+        spans = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+        for span_west, span_east in spans:
+            (row_south, row_north), (column_west, column_east) = self.cells(np.array([span_west, span_east]), np.array([south, north]))
+            rows, columns = np.meshgrid(np.arange(row_south, row_north + 1), np.arange(column_west, column_east + 1), indexing='ij')
+            # a cell is wholly inside when no edge of the box runs through it
+            inside = (rows > row_south) & (rows < row_north) & (columns > column_west) & (columns < column_east)
+            self._mark(rows, columns, inside)
+
+    def _rasterize_polygon(self, polygon):
+        (row_south, row_north), (column_west, column_east) = self.cells(np.array([polygon[:, 0].min(), polygon[:, 0].max()]),
+                                                                          np.array([polygon[:, 1].min(), polygon[:, 1].max()]))
+        edge = np.zeros((self.rows, self.columns), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(np.roll(polygon, 1, axis=0), polygon):
+            # sample each edge at under half a cell and widen by a cell, so every cell it crosses is caught
+            steps = int(math.ceil(max(abs(x2 - x1), abs(y2 - y1)) / (self.cell_size / 2))) + 1
+            fractions = np.linspace(0.0, 1.0, steps + 1)
+            rows, columns = self.cells(x1 + (x2 - x1) * fractions, y1 + (y2 - y1) * fractions)
+            for row_offset in (-1, 0, 1):
+                for column_offset in (-1, 0, 1):
+                    edge[np.clip(rows + row_offset, 0, self.rows - 1), np.clip(columns + column_offset, 0, self.columns - 1)] = True
+        rows, columns = np.meshgrid(np.arange(row_south, row_north + 1), np.arange(column_west, column_east + 1), indexing='ij')
+        centre_longitudes = (columns + 0.5) * self.cell_size - 180
+        centre_latitudes = (rows + 0.5) * self.cell_size - 90
+        on_edge = edge[rows, columns]
+        # cells the edge misses are wholly on one side of it, so their centre decides
+        inside = ~on_edge & polygon_contains(polygon, centre_longitudes.ravel(), centre_latitudes.ravel()).reshape(rows.shape)
+        self._mark(rows[on_edge | inside], columns[on_edge | inside], inside[on_edge | inside])
+
+    def contains(self, longitudes, latitudes):
+        """Which points are in any region."""
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        cells = self.grid[self.cells(longitudes, latitudes)]
+        inside = cells == cell_inside
+        boundary = np.flatnonzero(cells == cell_boundary)
+        if len(boundary) > 0:
+            exact = np.zeros(len(boundary), dtype=bool)
+            for test, shape in self.regions:
+                exact |= test(shape, longitudes[boundary], latitudes[boundary])
+            inside[boundary] = exact
+        return inside
+
+    def excluded(self, aircraft):
+        """Why an aircraft is excluded whatever its position ('callsign' or 'type'), or None."""
+        callsign = aircraft.get('Call')
+        if callsign and self.excluded_callsigns and callsign.startswith(self.excluded_callsigns):
+            return 'callsign'
+        if aircraft.get('Type') in self.excluded_types:
+            return 'type'
+        return None
+
+    def keep(self, batch, trails):
+        """Which aircraft of a batch to queue, given their decoded TrailBatch."""
+        records = trails.records
+        hits = self.contains(records['lon'], records['lat'])
+        altitudes = records['alt']
+        if self.min_altitude is not None:
+            hits &= (altitudes >= self.min_altitude) | (altitudes == altitude_none)
+        if self.max_altitude is not None:
+            hits &= altitudes <= self.max_altitude  # altitude_none is below any band
+        counts = np.concatenate(([0], np.cumsum(hits, dtype=np.int64)))[trails.bounds]
+        touching = (counts[1:] > counts[:-1]).tolist()
+        keep = []
+        results = {'passed': 0, 'outside': 0, 'callsign': 0, 'type': 0}
+        for item, inside in zip(batch, touching):
+            reason = self.excluded(item) or (None if inside else 'outside')
+            results[reason or 'passed'] += 1
+            keep.append(reason is None)
+        for result, count in results.items():
+            if count > 0:
+                metrics.increment('geofence_aircraft_total', count, result=result)
+        return keep
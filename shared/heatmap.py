@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Turn density by place, hour and altitude band, kept up to date as flights merge.
+
+Each turn calculate_bearings_and_turns finds is counted in a cell: the geohash
+of the point the turn starts at (cell_precision characters, about 5 km square),
+the unix hour it happened in and its score_altitude band (see
+shared/bearing_engine.py), so the count times the band's score is the
+surveillance score the cell collected. A TurnHeatmap adds up the turns of one
+consumer process in a dict and flush()es them every flush_interval seconds:
+
+redis  turn_heatmap:<hour> hashes of '<cell>:<band>' -> turns, expiring
+       redis_hours after the hour, and turn_heatmap:total over every hour
+mongo  the turn_heatmap collection, {_id: '<cell>:<hour>:<band>', Cell, Hour,
+       Band, Turns} documents incremented with upserts, kept for good
+
+cell_turns() reads a cell with one field per band from each hash asked for, so
+a hotspot query costs the same however much history is stored. write_tiles()
+sums the last tile_hours hours into one JSON file per tile_precision geohash
+prefix under heatmap/, {cell: [turns, score]}, listed in heatmap/index.json,
+for the web map.
+"""
+
+import gzip
+import json
+import logging
+import time
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+from redis.exceptions import RedisError
+
+from shared import metrics
+from shared.bearing_engine import altitude_band_array, altitude_band_scores
+
+logger = logging.getLogger()
+
+geohash_alphabet = '0123456789bcdefghjkmnpqrstuvwxyz'
+cell_precision = 5  # geohash characters of a cell, about 4.9 x 4.9 km at the equator
+tile_precision = 2  # geohash characters of a web map tile
+flush_interval = 60  # seconds between flushes of a process's counts
+tile_interval = 600  # seconds between tile writes
+tile_hours = 24  # hours of turns summed into the tiles
+redis_hours = 48  # hours an hour's hash is kept in redis after it ends; mongo keeps everything
+key_prefix = 'turn_heatmap:'
+total_key = 'turn_heatmap:total'
+heatmap_collection = 'turn_heatmap'
+tile_directory = 'heatmap'
+
+
+def ensure_heatmap_indexes(collection):
+    collection.create_index([('Cell', ASCENDING), ('Hour', ASCENDING)])
+    collection.create_index([('Hour', ASCENDING)])
+
+
+def geohash(longitude, latitude, precision=cell_precision):
+    """The geohash of a point, precision characters long."""
+    bounds = [[-180.0, 180.0], [-90.0, 90.0]]  # longitude, then latitude
+    point = (longitude, latitude)
+    characters = []
+    value = bits = 0
+    axis = 0  # even bits split longitude, odd bits latitude
+    while len(characters) < precision:
+        low, high = bounds[axis]
+        middle = (low + high) / 2
+        if point[axis] >= middle:
+            value = value * 2 + 1
+            bounds[axis][0] = middle
+        else:
+            value *= 2
+            bounds[axis][1] = middle
+        axis = 1 - axis
+        bits += 1
+        if bits == 5:
+            characters.append(geohash_alphabet[value])
+            value = bits = 0
+    return ''.join(characters)
+
+
+def hour_key(hour):
+    return key_prefix + str(hour)
+
+
+def turn_cells(coordinates, turn_indexes):
+    """(cell, hour, band) of each turn of a calculate_bearings_and_turns result."""
+    if len(turn_indexes) == 0:
+        return []
+    bands = altitude_band_array([coordinates[i][2] for i in turn_indexes]).tolist()
+    return [(geohash(coordinates[i][0], coordinates[i][1]), int(coordinates[i][3] // 3600), band)
+            for i, band in zip(turn_indexes, bands)]
+
+
+def band_score(turns):
+    """The surveillance score of a list of turn counts per altitude band."""
+    return int(sum(count * score for count, score in zip(turns, altitude_band_scores.tolist())))
+
+
+def cell_turns(r, cell, hours=None):
+    """Turns per altitude band in a cell over the given unix hours (which must still be in redis), or ever."""
+    fields = ['{0}:{1}'.format(cell, band) for band in range(len(altitude_band_scores))]
+    keys = [total_key] if hours is None else [hour_key(hour) for hour in hours]
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, fields)
+    turns = [0] * len(fields)
+    for values in pipe.execute():
+        for band, value in enumerate(values):
+            if value is not None:
+                turns[band] += int(value)
+    return turns
+
+
+def tiles(r, now, hours=tile_hours):
+    """{tile prefix: {cell: [turns, score]}} of the hours up to and including now's."""
+    last = int(now // 3600)
+    pipe = r.pipeline(transaction=False)
+    for hour in range(last - hours + 1, last + 1):
+        pipe.hgetall(hour_key(hour))
+    scores = altitude_band_scores.tolist()
+    tiled = {}
+    for counts in pipe.execute():
+        for field, value in counts.items():
+            cell, band = (field.decode() if isinstance(field, bytes) else field).rsplit(':', 1)
+            totals = tiled.setdefault(cell[:tile_precision], {}).setdefault(cell, [0, 0])
+            totals[0] += int(value)
+            totals[1] += int(value) * scores[int(band)]
+    return tiled
+
+
+def write_tiles(r, backend, now, hours=tile_hours):
+    """Writes the tiles and their index through a SnapshotPublisher backend (see shared/s3_publisher.py)."""
+    tiled = tiles(r, now, hours)
+
+    def put(key, document):
+        body = json.dumps(document, sort_keys=True, separators=(',', ':')).encode()
+        if backend.supports_content_encoding:
+            backend.put(key, gzip.compress(body, 6), content_encoding='gzip')
+        else:
+            backend.put(key, body)
+
+    for prefix, cells in tiled.items():
+        put('{0}/{1}.json'.format(tile_directory, prefix), {'time': now, 'hours': hours, 'cells': cells})
+    put(tile_directory + '/index.json', {'time': now, 'hours': hours, 'precision': cell_precision, 'tiles': sorted(tiled)})
+    return len(tiled)
+
+
+class TurnHeatmap(object):
+    """The turn counts of one process by (cell, hour, band), waiting to be flushed to redis and mongo."""
+
+    def __init__(self, collection=None):
+        self.collection = collection
+        self.pending = {}
+        self.flushed = time.time()
+        self.tiles_written = 0.0  # marker time of the last tile write
+
+    def add(self, cells):
+        for cell in cells:
+            self.pending[cell] = self.pending.get(cell, 0) + 1
+        metrics.increment('heatmap_turns_total', len(cells))
+
+    def maybe_flush(self, r):
+        """flush() if flush_interval has passed since the last one; cheap enough to call per message."""
+        if time.time() - self.flushed >= flush_interval:
+            self.flush(r)
+
+    def flush(self, r):
+        """Adds the pending counts to redis in one transaction, then to mongo; returns the number of counters written."""
+        self.flushed = time.time()
+        if len(self.pending) == 0:
+            return 0
+        pending, self.pending = self.pending, {}
+        pipe = r.pipeline()
+        for (cell, hour, band), turns in pending.items():
+            field = '{0}:{1}'.format(cell, band)
+            pipe.hincrby(hour_key(hour), field, turns)
+            pipe.hincrby(total_key, field, turns)
+        for hour in set(hour for cell, hour, band in pending):
+            pipe.expireat(hour_key(hour), (hour + 1 + redis_hours) * 3600)
+        try:
+            with metrics.timer('heatmap_flush_seconds', store='redis'):
+                pipe.execute()
+        except RedisError as e:
+            # nothing was applied, so the counts wait for the next flush
+            logger.error("Flushing {0} heatmap counters to redis failed: {1}".format(len(pending), e))
+            for cell, turns in pending.items():
+                self.pending[cell] = self.pending.get(cell, 0) + turns
+            return 0
+        if self.collection is not None:
+            updates = [UpdateOne({'_id': '{0}:{1}:{2}'.format(cell, hour, band)},
+                                 {'$inc': {'Turns': turns}, '$setOnInsert': {'Cell': cell, 'Hour': hour, 'Band': band}}, upsert=True)
+                       for (cell, hour, band), turns in pending.items()]
+            try:
+                with metrics.timer('heatmap_flush_seconds', store='mongo'):
+                    self.collection.bulk_write(updates, ordered=False)
+            except PyMongoError as e:
+                logger.error("Flushing {0} heatmap counters to mongo failed, only redis has them: {1}".format(len(updates), e))
+                metrics.increment('heatmap_mongo_failures_total')
+        metrics.increment('heatmap_counters_flushed_total', len(pending))
+        return len(pending)
+
+    def maybe_write_tiles(self, r, backend, now):
+        """write_tiles() if tile_interval has passed since the last write, by marker time."""
+        if now - self.tiles_written < tile_interval:
+            return 0
+        self.tiles_written = now
+        with metrics.timer('heatmap_tiles_seconds'):
+            return write_tiles(r, backend, now)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached queries of archived flights in the mongo flighthistory collection.
+
+A HistoryQuery selects flights whose geometry intersects a bounding box (with
+the 2dsphere index), that were last seen in a time range, by Icao and by a
+minimum SurveillanceScore. Before it goes to mongo a query is quantized: the
+box is widened to multiples of bounds_quantum degrees, the time range to
+multiples of time_quantum seconds and the score lowered to a multiple of
+score_quantum, so a map panned a little, or asked again a minute later, asks
+mongo the same question.
+
+Mongo is read in windows of window_size flights, newest first (by LastSeen,
+then Icao), each starting after the last flight of the one before. HistoryCache
+keeps windows by quantized query and start for cache_ttl seconds, least
+recently used dropped first, and counts hits and misses in history_cache_total.
+A page is cut from the windows after narrowing them back to the exact box, time
+range and score, and its page token (the window's start and how many matching
+flights of it were handed out) leads to the next page, however far back.
+
+history-server.py writes pages as a GeoJSON FeatureCollection, one feature at a
+time, or as a snippet frame (see shared/wire_format.py) of full-resolution
+tracks. Compact documents are expanded first (see shared/mongo_writer.py).
+"""
+
+from collections import OrderedDict
+import json
+import math
+import threading
+import time
+
+import numpy as np
+from pymongo import DESCENDING
+
+from shared import metrics
+from shared.mongo_writer import expand_document
+
+bounds_quantum = 0.1  # degrees the box is widened to
+time_quantum = 300  # seconds the time range is widened to
+score_quantum = 5  # the minimum score is lowered to a multiple of this
+window_size = 2000  # flights read from mongo and cached at a time
+box_part_width = 90  # widest box sent to mongo in one polygon, in degrees of longitude
+cache_entries = 128  # windows cached
+cache_ttl = 60  # seconds a cached result is used for
+default_page_size = 100
+max_page_size = 1000
+
+
+def _floor(value, quantum):
+    return round(math.floor(value / quantum) * quantum, 6)
+
+
+def _ceil(value, quantum):
+    return round(math.ceil(value / quantum) * quantum, 6)
+
+
+def box_polygons(bounds):
+    """GeoJSON rings covering a (south, west, north, east) box, split at the antimeridian (west > east) and into
+    parts at most box_part_width wide, since mongo takes the smaller of the areas a ring could enclose."""
+    south, west, north, east = bounds
+    spans = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+    rings = []
+    for span_west, span_east in spans:
+        parts = max(int(math.ceil((span_east - span_west) / box_part_width)), 1)
+        edges = [span_west + (span_east - span_west) * n / parts for n in range(parts + 1)]
+        for part_west, part_east in zip(edges, edges[1:]):
+            rings.append([[part_west, south], [part_east, south], [part_east, north], [part_west, north], [part_west, south]])
+    return rings
+
+
+def segment_meets_box(a, b, box):
+    """Whether the straight lon/lat segment from a to b touches a (west, south, east, north) box."""
+    west, south, east, north = box
+    low, high = 0.0, 1.0
+    for start, delta, minimum, maximum in ((a[0], b[0] - a[0], west, east), (a[1], b[1] - a[1], south, north)):
+        if delta == 0:
+            if start < minimum or start > maximum:
+                return False
+            continue
+        enter, leave = sorted(((minimum - start) / delta, (maximum - start) / delta))
+        low, high = max(low, enter), min(high, leave)
+        if low > high:
+            return False
+    return True
+
+
+def track_meets_box(coordinates, bounds):
+    """Whether a [lon, lat, ...] track touches a (south, west, north, east) box, taking its segments as straight
+    lon/lat lines where mongo follows great circles."""
+    if len(coordinates) == 0:
+        return False
+    south, west, north, east = bounds
+    boxes = [(west, south, east, north)] if west <= east else [(west, south, 180.0, north), (-180.0, south, east, north)]
+    points = np.array([coordinate[0:2] for coordinate in coordinates], dtype=float)
+    starts, ends = (points[:-1], points[1:]) if len(points) > 1 else (points, points)
+    low, high = np.minimum(starts, ends), np.maximum(starts, ends)
+    for box in boxes:
+        # only segments whose own extent overlaps the box can touch it
+        near = np.flatnonzero((high[:, 0] >= box[0]) & (low[:, 0] <= box[2]) & (high[:, 1] >= box[1]) & (low[:, 1] <= box[3]))
+        if any(segment_meets_box(starts[i], ends[i], box) for i in near.tolist()):
+            return True
+    return False
+
+
+def window_order(flight_dict):
+    """Where a flight sorts in a window, which is in descending order of this."""
+    return flight_dict.get('LastSeen'), flight_dict.get('Icao')
+
+
+class HistoryQuery(object):
+    """What to look for in flighthistory; any of bounds, time range, Icao and minimum score may be left out."""
+
+    def __init__(self, bounds=None, start=None, end=None, icao=None, min_score=None):
+        self.bounds = tuple(bounds) if bounds is not None else None  # (south, west, north, east)
+        self.start = start  # unix seconds
+        self.end = end
+        self.icao = icao.upper() if icao else None
+        self.min_score = min_score
+
+    def quantized(self):
+        """The widened query that is sent to mongo and cached."""
+        bounds = None
+        if self.bounds is not None:
+            south, west, north, east = self.bounds
+            bounds = (max(_floor(south, bounds_quantum), -90.0), max(_floor(west, bounds_quantum), -180.0),
+                      min(_ceil(north, bounds_quantum), 90.0), min(_ceil(east, bounds_quantum), 180.0))
+        return HistoryQuery(bounds,
+                            None if self.start is None else _floor(self.start, time_quantum),
+                            None if self.end is None else _ceil(self.end, time_quantum),
+                            self.icao,
+                            None if self.min_score is None else _floor(self.min_score, score_quantum))
+
+    def key(self):
+        return self.bounds, self.start, self.end, self.icao, self.min_score
+
+    def mongo_filter(self, after=None):
+        """The filter of the query, limited to flights that sort after the (LastSeen, Icao) after."""
+        conditions = {}
+        if self.bounds is not None:
+            conditions['geometry'] = {'$geoIntersects': {'$geometry': {
+                'type': 'MultiPolygon', 'coordinates': [[ring] for ring in box_polygons(self.bounds)]}}}
+        if self.start is not None or self.end is not None:
+            conditions['LastSeen'] = {}
+            if self.start is not None:
+                conditions['LastSeen']['$gte'] = self.start
+            if self.end is not None:
+                conditions['LastSeen']['$lte'] = self.end
+        if self.icao is not None:
+            conditions['Icao'] = self.icao
+        if self.min_score is not None:
+            conditions['SurveillanceScore'] = {'$gte': self.min_score}
+        if after is not None:
+            last_seen, icao = after
+            conditions['$or'] = [{'LastSeen': {'$lt': last_seen}}, {'LastSeen': last_seen, 'Icao': {'$lt': icao}}]
+        return conditions
+
+    def matches(self, flight_dict):
+        """The exact box, time range and score test, for narrowing a quantized result."""
+        last_seen = flight_dict.get('LastSeen')
+        if self.start is not None and (last_seen is None or last_seen < self.start):
+            return False
+        if self.end is not None and (last_seen is None or last_seen > self.end):
+            return False
+        if self.min_score is not None and flight_dict.get('SurveillanceScore', 0) < self.min_score:
+            return False
+        return self.bounds is None or track_meets_box(flight_dict['geometry']['coordinates'], self.bounds)
+
+
+def page_token(after, skip):
+    """The page token of the page that starts skip matching flights into the window after (LastSeen, Icao)."""
+    return '' if after is None and skip == 0 else json.dumps([after, skip], separators=(',', ':'))
+
+
+def parse_page_token(token):
+    """(window start or None, matching flights of the window to skip) of a page token; raises ValueError on a bad one."""
+    if not token:
+        return None, 0
+    try:
+        after, skip = json.loads(token)
+        return (None if after is None else (float(after[0]), str(after[1]))), int(skip)
+    except (TypeError, IndexError, KeyError) as e:
+        raise ValueError("bad page token: {0}".format(e))
+
+
+def parse_query(parameters):
+    """(HistoryQuery, page token, page size, format) from request parameters; raises ValueError on bad ones.
+
+    bbox=south,west,north,east start=<unix seconds> end=<unix seconds> icao=<hex> min_score=<n>
+    page=<token from the previous page> limit=<n> format=geojson|frame
+    """
+    bounds = None
+    if parameters.get('bbox'):
+        bounds = tuple(float(value) for value in parameters['bbox'].split(','))
+        if len(bounds) != 4 or not (-90 <= bounds[0] <= bounds[2] <= 90) or not all(-180 <= value <= 180 for value in bounds[1::2]):
+            raise ValueError("bbox must be south,west,north,east")
+    start = float(parameters['start']) if parameters.get('start') else None
+    end = float(parameters['end']) if parameters.get('end') else None
+    min_score = float(parameters['min_score']) if parameters.get('min_score') else None
+    token = parameters.get('page') or ''
+    parse_page_token(token)
+    limit = min(int(parameters.get('limit') or default_page_size), max_page_size)
+    output_format = parameters.get('format') or 'geojson'
+    if limit <= 0:
+        raise ValueError("limit must be positive")
+    if output_format not in ('geojson', 'frame'):
+        raise ValueError("format must be geojson or frame")
+    return HistoryQuery(bounds, start, end, parameters.get('icao'), min_score), token, limit, output_format
+
+
+def find_flights(collection, query, after=None, limit=window_size):
+    """The newest flights matching a query that sort after (LastSeen, Icao) after, as GeoJSON flight dicts."""
+    with metrics.timer('mongo_read_seconds', op='history'):
+        documents = list(collection.find(query.mongo_filter(after), {'_id': False},
+                                         sort=[('LastSeen', DESCENDING), ('Icao', DESCENDING)], limit=limit))
+    return [expand_document(document) for document in documents]
+
+
+class HistoryCache(object):
+    """Windows by quantized query and start, each used for at most ttl seconds, least recently used dropped first."""
+
+    def __init__(self, collection, capacity=cache_entries, ttl=cache_ttl):
+        self.collection = collection
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (quantized query key, window start) -> (time read, flight dicts)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def window(self, quantized, after):
+        """The window of a quantized query starting after (LastSeen, Icao) after, read from mongo unless cached."""
+        key = (quantized.key(), after)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.increment('history_cache_total', result='hit')
+                return entry[1]
+            self.misses += 1
+            metrics.increment('history_cache_total', result='miss')
+        # concurrent misses on the same window may both read it; the last one is kept
+        flights = find_flights(self.collection, quantized, after, window_size)
+        with self.lock:
+            self.entries[key] = (now, flights)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            metrics.set_gauge('history_cache_entries', len(self.entries))
+        return flights
+
+    def page(self, query, token='', limit=default_page_size):
+        """(flights of the page, page token of the next page or None) for a query."""
+        quantized = query.quantized()
+        after, skip = parse_page_token(token)
+        flights = []
+        while True:
+            window = self.window(quantized, after)
+            matching = [flight_dict for flight_dict in window if query.matches(flight_dict)]
+            taken = matching[skip:skip + limit - len(flights)]
+            flights.extend(taken)
+            skip += len(taken)
+            if len(window) < window_size and skip >= len(matching):
+                return flights, None  # the last window, used up
+            if skip < len(matching):
+                return flights, page_token(after, skip)  # the page is full inside this window
+            after, skip = window_order(window[-1]), 0
+            if len(flights) == limit:
+                return flights, page_token(after, skip)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else None}
+
+
+def geojson_pieces(flights, next_token):
+    """A page as the pieces of a GeoJSON FeatureCollection, one feature per piece."""
+    yield '{{"type":"FeatureCollection","next":{0},"features":['.format(json.dumps(next_token))
+    for n, flight_dict in enumerate(flights):
+        properties = {key: value for key, value in flight_dict.items() if key != 'geometry'}
+        feature = {'type': 'Feature', 'geometry': flight_dict['geometry'], 'properties': properties}
+        yield (',' if n > 0 else '') + json.dumps(feature, separators=(',', ':'))
+    yield ']}'
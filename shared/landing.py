@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Landing detection over the last few minutes of a flight's track.
+
+A flight has stopped flying when its track covers check_window seconds, its
+straight-line ground speed over that window is below landed_speed, and so is
+its speed over each segment between the boundaries in segment_offsets (seconds
+back from the newest point). The boundary for s seconds is the newest point at
+least s seconds older than the newest point.
+
+RollingTrack keeps a flight's points from the oldest boundary on, with a cursor
+per boundary. Points arrive in time order, so cursors only move forwards and
+each update is O(1) amortized, and is_slow() is O(1). LandingDetector keeps a
+RollingTrack per recently seen flight. slow_track() gives the same answer for a
+whole time-sorted coordinate list with bisect, where no rolling state exists.
+Only flights found slow need the airport lookup that decides they landed.
+"""
+
+import bisect
+from collections import OrderedDict, deque
+import math
+
+earth_radius = 6371008.8  # metres
+check_window = 300  # seconds of track a landing check covers
+segment_offsets = (300, 180, 120, 60)  # seconds back from the newest point of each segment boundary
+landed_speed = 8.94  # metres per second (20 mph); slower than this is not flying
+min_check_seconds = 200  # the whole window must span at least this long
+
+
+def distance(a, b):
+    """Great circle distance in metres between two [lon, lat, ...] coordinates."""
+    lon1, lat1, lon2, lat2 = math.radians(a[0]), math.radians(a[1]), math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * math.asin(min(math.sqrt(h), 1.0))
+
+
+def slow_between(a, b, min_seconds=0):
+    """True if going from coordinate a to b took at least min_seconds (and some time) at less than landed_speed."""
+    seconds = b[3] - a[3]
+    if seconds <= 0 or seconds < min_seconds:
+        return False
+    return distance(a, b) / seconds < landed_speed
+
+
+def slow_points(boundaries, last):
+    """The landing test on the boundary points (oldest first) and the newest point."""
+    if any(point is None for point in boundaries):
+        return False
+    if not slow_between(boundaries[0], last, min_check_seconds):
+        return False
+    for start, end in zip(boundaries, boundaries[1:]):
+        if start is end or not slow_between(start, end):
+            return False
+    return True
+
+
+def time_index(times, seconds):
+    """Index of the newest time at least seconds before the last one in a sorted list, or None if there is none."""
+    if len(times) == 0:
+        return None
+    i = bisect.bisect_right(times, times[-1] - seconds) - 1
+    return i if i >= 0 else None
+
+
+def slow_track(coordinate_list):
+    """The landing test for a whole time-sorted coordinate list."""
+    if len(coordinate_list) < 2:
+        return False
+    times = [coordinate[3] for coordinate in coordinate_list]
+    indexes = [time_index(times, seconds) for seconds in segment_offsets]
+    boundaries = [None if i is None else coordinate_list[i] for i in indexes]
+    return slow_points(boundaries, coordinate_list[-1])
+
+
+class RollingTrack(object):
+    """The recent points of one flight with a cursor per segment boundary."""
+
+    __slots__ = ('points', 'cursors')
+
+    def __init__(self, coordinates=()):
+        self.points = deque()
+        self.cursors = [None] * len(segment_offsets)  # index into points of each boundary, None until one exists
+        self.add(coordinates)
+
+    def add(self, coordinates):
+        """Appends time-sorted coordinates; any not newer than the last point are ignored."""
+        points = self.points
+        for coordinate in coordinates:
+            if len(points) > 0 and coordinate[3] <= points[-1][3]:
+                continue
+            points.append(coordinate)
+            newest = coordinate[3]
+            for n, seconds in enumerate(segment_offsets):
+                i = self.cursors[n]
+                if i is None:
+                    if newest - points[0][3] < seconds:
+                        continue
+                    i = 0
+                while i + 1 < len(points) and newest - points[i + 1][3] >= seconds:
+                    i += 1
+                self.cursors[n] = i
+            # nothing before the oldest boundary is needed again
+            oldest = self.cursors[0]
+            if oldest is not None and oldest > 0:
+                for _ in range(oldest):
+                    points.popleft()
+                self.cursors = [None if i is None else i - oldest for i in self.cursors]
+
+    def is_slow(self):
+        if len(self.points) < 2:
+            return False
+        return slow_points([None if i is None else self.points[i] for i in self.cursors], self.points[-1])
+
+    def last(self):
+        return self.points[-1] if len(self.points) > 0 else None
+
+
+class LandingDetector(object):
+    """RollingTracks of the flights seen most recently by this process, least recently updated dropped first."""
+
+    def __init__(self, capacity=20000):
+        self.capacity = capacity
+        self.tracks = OrderedDict()
+
+    def update(self, icao, coordinates, seed=None):
+        """Adds new points to a flight's track and returns it.
+
+        A flight without a track starts from the coordinates seed() returns, if seed is given: the stored tail of a
+        flight this process has not followed, so a check due now has the whole window.
+        """
+        track = self.tracks.get(icao)
+        if track is None:
+            track = RollingTrack(seed() if seed is not None else ())
+            self.tracks[icao] = track
+            if len(self.tracks) > self.capacity:
+                self.tracks.popitem(last=False)
+        else:
+            self.tracks.move_to_end(icao)
+        track.add(coordinates)
+        return track
+
+    def forget(self, icao):
+        self.tracks.pop(icao, None)
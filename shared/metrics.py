@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Low-overhead metrics for the converter, consumers and stale sweeper.
+
+Each process records counters, gauges and histograms into a module-level
+registry (a dict update per event under one lock, no I/O on the hot path), so
+the FlightWriter, poller and HTTP handler threads can record alongside the main
+thread. Processes that called configure() dump the registry as JSON to
+<directory>/<name>-<pid>.json at most every write_interval seconds from
+maybe_write(), from a copy taken under the lock; aggregate() merges the
+files of every live process, summing counters and histograms and keeping gauges
+per process, and render() turns the result into the Prometheus text format.
+serve() exposes that on /metrics from a background thread.
+
+    with metrics.timer('merge_seconds'):
+        ...
+    metrics.increment('snippets_total', len(snippets))
+"""
+
+import bisect
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import threading
+import time
+
+prefix = 'skyspywatch_'
+default_directory = '/tmp/skyspywatch-metrics'
+write_interval = 10  # seconds between registry dumps
+stale_after = 300  # seconds without a dump before a process is left out of the aggregate
+# histogram bucket upper bounds, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+counters = {}  # (name, labels) -> value
+gauges = {}  # (name, labels) -> value
+histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+process = {'directory': None, 'name': None, 'written': 0.0}
+lock = threading.Lock()  # held for every registry update and while the registry is copied
+write_lock = threading.Lock()  # one dump at a time
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def increment(name, value=1, **labels):
+    key = (name, _labels(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = (name, _labels(labels))
+    with lock:
+        gauges[key] = value
+
+
+def observe(name, value, **labels):
+    key = (name, _labels(labels))
+    bucket = bisect.bisect_left(buckets, value)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 2)
+        histogram[bucket] += 1
+        histogram[-1] += value
+
+
+class timer(object):
+    """Context manager observing the seconds spent in its block into a histogram."""
+
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def configure(name, directory=default_directory):
+    """Turns on dumping this process's registry, under a file named for the process."""
+    os.makedirs(directory, exist_ok=True)
+    process.update(directory=directory, name='{0}-{1}'.format(name, os.getpid()), written=0.0)
+    global lock
+    # a forked worker starts from a copy of its parent's registry, and of its lock as some thread may have held it
+    lock = threading.Lock()
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+
+
+def snapshot():
+    """The registry as a JSON-serialisable dict, copied under the lock."""
+    def entries(registry):
+        return [[name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in registry.items()]
+    with lock:
+        return {'time': time.time(), 'counters': entries(counters), 'gauges': entries(gauges), 'histograms': entries(histograms)}
+
+
+def write():
+    if process['directory'] is None:
+        return
+    path = os.path.join(process['directory'], process['name'] + '.json')
+    dump = snapshot()
+    with write_lock:
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump(dump, metrics_file)
+        os.replace(path + '.tmp', path)
+        process['written'] = time.time()
+
+
+def maybe_write():
+    """Dumps the registry if write_interval has passed since the last dump; cheap enough to call per message."""
+    if process['directory'] is not None and time.time() - process['written'] >= write_interval:
+        write()
+
+
+def aggregate(directory=default_directory):
+    """Merges the dumps of every process that wrote one recently."""
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    now = time.time()
+    for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as metrics_file:
+                dump = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue
+        if now - dump['time'] > stale_after:
+            continue
+        worker = filename[:-len('.json')]
+        for name, labels, value in dump['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+        for name, labels, value in dump['gauges']:
+            key = (name, tuple(sorted([tuple(label) for label in labels] + [('worker', worker)])))
+            merged['gauges'][key] = value
+        for name, labels, value in dump['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = merged['histograms'].get(key)
+            merged['histograms'][key] = value if total is None else [a + b for a, b in zip(total, value)]
+    return merged
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('"', '\\"')) for key, value in pairs) + '}'
+
+
+def render(merged):
+    """Prometheus text exposition of an aggregate."""
+    lines = []
+    for kind, registry in (('counter', merged['counters']), ('gauge', merged['gauges'])):
+        typed = set()
+        for (name, labels), value in sorted(registry.items()):
+            if name not in typed:
+                lines.append('# TYPE {0}{1} {2}'.format(prefix, name, kind))
+                typed.add(name)
+            lines.append('{0}{1}{2} {3}'.format(prefix, name, _format_labels(labels), value))
+    typed = set()
+    for (name, labels), histogram in sorted(merged['histograms'].items()):
+        if name not in typed:
+            lines.append('# TYPE {0}{1} histogram'.format(prefix, name))
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), histogram[:-1]):
+            cumulative += count
+            lines.append('{0}{1}_bucket{2} {3}'.format(prefix, name, _format_labels(labels, [('le', bound)]), cumulative))
+        lines.append('{0}{1}_sum{2} {3}'.format(prefix, name, _format_labels(labels), histogram[-1]))
+        lines.append('{0}{1}_count{2} {3}'.format(prefix, name, _format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, directory=default_directory):
+    """Serves the aggregate of every process on http://<host>:port/metrics from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render(aggregate(directory)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Buffered writes of archived flights to the mongo flighthistory collection.
+
+FlightWriter queues flight dicts and writes them from a background thread in
+unordered insert_many batches, flushed when batch_size documents are waiting or
+the oldest has waited max_age seconds, so a landing or a stale sweep never waits
+on mongo. Up to max_pending flights are buffered before write() blocks. A batch
+that cannot be compacted or written is logged and counted as failed, and the
+thread goes on with the next one. Anything still buffered when a process is
+killed is lost, so close() the writer on the way out; flush() and close() give
+up after flush_timeout seconds, or at once if the thread has died.
+
+With compact=True documents are stored in the columnar layout:
+
+geometry  LineString of [lon, lat] only, simplified to index_tolerance metres,
+          for the 2dsphere index
+Track     the full track as little-endian packed arrays: Lon, Lat (float64),
+          Alt (int32 feet, altitude_none for missing), TimeOffset (uint32 ms
+          after StartMs) and Bearing (float32, NaN where unknown)
+
+expand_document() turns either layout back into the GeoJSON flight dict.
+ensure_indexes() creates the collection's indexes once at startup.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from bson.binary import Binary
+import numpy as np
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from shared import metrics
+from shared.simplify import simplify_track
+from shared.track_store import altitude_none
+
+logger = logging.getLogger()
+
+writer_batch_size = 500  # documents per insert_many
+writer_max_age = 5.0  # seconds a flight may wait for its batch to fill
+writer_max_pending = 20000  # flights buffered before write() blocks
+flush_timeout = 60.0  # seconds flush() waits for the queued flights to be written
+index_tolerance = 500.0  # metres of error allowed in the geometry of compact documents
+compact_layout = 'columnar-1'
+
+
+def ensure_indexes(collection):
+    """Creates the flighthistory indexes; cheap to repeat, but meant to run once when a process starts."""
+    collection.create_index([('geometry', '2dsphere')])
+    collection.create_index([('Icao', ASCENDING), ('LastSeen', DESCENDING)])
+    collection.create_index([('LastSeen', DESCENDING)])
+    collection.create_index([('SurveillanceScore', DESCENDING)])
+
+
+def compact_document(flight_dict):
+    """The columnar layout of a flight dict."""
+    coordinates = flight_dict['geometry']['coordinates']
+    document = {key: value for key, value in flight_dict.items() if key != 'geometry'}
+    times = np.array([round(c[3] * 1000) for c in coordinates], dtype=np.int64)
+    start = int(times[0]) if len(times) > 0 else 0
+    document['Layout'] = compact_layout
+    document['geometry'] = {'type': 'LineString', 'coordinates': [c[0:2] for c in simplify_track(coordinates, index_tolerance)]}
+    document['Track'] = {
+        'Count': len(coordinates),
+        'StartMs': start,
+        'Lon': Binary(np.array([c[0] for c in coordinates], dtype='<f8').tobytes()),
+        'Lat': Binary(np.array([c[1] for c in coordinates], dtype='<f8').tobytes()),
+        'Alt': Binary(np.array([altitude_none if c[2] is None else round(c[2]) for c in coordinates], dtype='<i4').tobytes()),
+        'TimeOffset': Binary((times - start).astype('<u4').tobytes()),
+        'Bearing': Binary(np.array([c[4] if len(c) > 4 and c[4] is not None else np.nan for c in coordinates], dtype='<f4').tobytes()),
+    }
+    return document
+
+
+def expand_document(document):
+    """The GeoJSON flight dict of a flighthistory document in either layout."""
+    if document.get('Layout') != compact_layout:
+        return document
+    flight_dict = {key: value for key, value in document.items() if key not in ('Layout', 'Track', 'geometry')}
+    track = document['Track']
+    longitudes = np.frombuffer(track['Lon'], dtype='<f8').tolist()
+    latitudes = np.frombuffer(track['Lat'], dtype='<f8').tolist()
+    altitudes = np.frombuffer(track['Alt'], dtype='<i4').tolist()
+    times = ((np.frombuffer(track['TimeOffset'], dtype='<u4').astype(np.int64) + track['StartMs']) / 1000).tolist()
+    bearings = np.frombuffer(track['Bearing'], dtype='<f4').astype(float).tolist()
+    coordinates = []
+    for longitude, latitude, altitude, unix_time, bearing in zip(longitudes, latitudes, altitudes, times, bearings):
+        coordinate = [longitude, latitude, None if altitude == altitude_none else altitude, unix_time]
+        if bearing == bearing:  # not NaN
+            coordinate.append(bearing)
+        coordinates.append(coordinate)
+    flight_dict['geometry'] = {'type': 'LineString', 'coordinates': coordinates}
+    return flight_dict
+
+
+def insert_documents(collection, documents, failed_indexes=None):
+    """Inserts documents unordered in one batch; returns (written, failed).
+
+    If failed_indexes is a list, the positions of the documents that were not written are added to it.
+    """
+    try:
+        with metrics.timer('mongo_write_seconds'):
+            result = collection.insert_many(documents, ordered=False)
+        return len(result.inserted_ids), 0
+    except BulkWriteError as e:
+        # unordered, so everything but the failed documents is written
+        errors = e.details.get('writeErrors', [])
+        logger.error("Writing flights failed for {0} documents".format(len(errors)))
+        if failed_indexes is not None:
+            failed_indexes.extend(error['index'] for error in errors)
+        return e.details.get('nInserted', 0), len(errors)
+    except PyMongoError as e:
+        logger.error("Writing {0} flights failed: {1}".format(len(documents), e))
+        if failed_indexes is not None:
+            failed_indexes.extend(range(len(documents)))
+        return 0, len(documents)
+
+
+class FlightWriter(object):
+    """Writes flight dicts to a collection from a background thread in size- or age-triggered unordered batches."""
+
+    def __init__(self, collection, batch_size=writer_batch_size, max_age=writer_max_age, compact=False,
+                 max_pending=writer_max_pending, on_written=None):
+        self.collection = collection
+        self.on_written = on_written  # called from the writer thread with the flight dicts of each batch written
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.compact = compact
+        self.pending = queue.Queue(max_pending)
+        self.written = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name='flight-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, flight_dict):
+        """Queues a flight; the caller must not change it afterwards."""
+        self._put(flight_dict)
+
+    def write_many(self, flights):
+        for flight_dict in flights:
+            self._put(flight_dict)
+
+    def _put(self, item, timeout=None):
+        """Queues an item, waiting for room while the thread is alive; returns False if it could not be queued."""
+        waited = 0.0
+        while self.thread.is_alive():
+            try:
+                self.pending.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                waited += 1.0
+                if timeout is not None and waited >= timeout:
+                    break
+        logger.error("Flight writer is {0}, dropping a queued item".format('stuck' if self.thread.is_alive() else 'not running'))
+        return False
+
+    def flush(self, timeout=flush_timeout):
+        """Blocks until every flight queued so far has been written; returns False if that took over timeout seconds
+        or the thread died."""
+        done = threading.Event()
+        started = time.time()
+        if not self._put(done, timeout):
+            return False
+        while not done.wait(min(1.0, max(started + timeout - time.time(), 0))):
+            if not self.thread.is_alive() or time.time() - started >= timeout:
+                logger.error("Flushing the flight writer gave up after {0:.0f} seconds".format(time.time() - started))
+                return False
+        return True
+
+    def close(self, timeout=flush_timeout):
+        if self.flush(timeout) and self._put(None, timeout):
+            self.thread.join(timeout)
+
+    def _write(self, batch, flights):
+        failed_indexes = []
+        written, failed = insert_documents(self.collection, batch, failed_indexes)
+        self.written += written
+        self.failed += failed
+        metrics.increment('mongo_documents_written_total', written)
+        metrics.increment('mongo_documents_failed_total', failed)
+        if self.on_written is not None and written > 0:
+            failed_indexes = set(failed_indexes)
+            try:
+                self.on_written([flight_dict for n, flight_dict in enumerate(flights) if n not in failed_indexes])
+            except Exception as e:
+                logger.exception("Handling {0} written flights failed: {1}".format(written, e))
+
+    def _fail(self, count, e):
+        logger.exception("Writing {0} flights failed: {1}".format(count, e))
+        self.failed += count
+        metrics.increment('mongo_documents_failed_total', count)
+
+    def _run(self):
+        batch = []
+        flights = []  # the flight dicts of the batch's documents
+        oldest = None  # when the first flight of the batch arrived
+        while True:
+            try:
+                item = self.pending.get(timeout=None if oldest is None else max(oldest + self.max_age - time.time(), 0))
+            except queue.Empty:
+                item = False  # the batch is old enough to go
+            if isinstance(item, dict):
+                try:
+                    batch.append(compact_document(item) if self.compact else item)
+                    flights.append(item)
+                except Exception as e:
+                    self._fail(1, e)
+                if oldest is None:
+                    oldest = time.time()
+                if len(batch) < self.batch_size and time.time() - oldest < self.max_age:
+                    continue
+            if len(batch) > 0:
+                try:
+                    self._write(batch, flights)
+                except Exception as e:
+                    # an error other than mongo's, such as an InvalidDocument; the thread must live on
+                    self._fail(len(batch), e)
+                batch = []
+                flights = []
+                oldest = None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
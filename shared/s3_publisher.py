@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Publishing of surveillance flight snapshots for the web map.
+
+Each FileTime marker publishes one object per flagged aircraft, then the
+aircraft list, then latest.json, so a reader following latest.json never finds
+a list that points at objects not yet written. Flights whose content has not
+changed since the last marker are not uploaded again: the aircraft list maps
+each Icao to the key its current content was last published under (Files).
+
+Bodies are serialised and gzipped in memory and uploaded with put_object from a
+bounded thread pool sharing one client, whose connection pool is sized to match.
+S3Backend writes to the bucket; LocalBackend writes the same layout to a
+directory, for running without AWS credentials.
+
+With write_bundle, every flagged aircraft is also written to one bundle file
+per marker (see shared/snapshot_bundle.py), named by latest.json, which the web
+map loads in a single request. write_flight_files can then be turned off.
+With write_delta, a delta document per marker lets an open map patch what it
+already drew; its Previous timestamp is None when this publisher has no earlier
+marker (e.g. after a restart), which tells the map to reload the bundle.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+import boto3
+
+from shared import metrics
+from shared.snapshot_bundle import build_bundle, build_delta
+
+logger = logging.getLogger()
+
+default_bucket = 'nstarpost-flightmap-east2'
+publish_threads = 8
+
+
+class S3Backend(object):
+    """Writes objects to an S3 bucket with one pooled, thread-safe client."""
+
+    supports_content_encoding = True
+
+    def __init__(self, credentials, bucket=default_bucket, max_connections=publish_threads):
+        self.bucket = bucket
+        self.client = boto3.client('s3',
+                                   aws_access_key_id=credentials['aws_access_key_id'],
+                                   aws_secret_access_key=credentials['aws_secret_access_key'],
+                                   config=boto3.session.Config(signature_version='s3v4', max_pool_connections=max_connections))
+
+    def put(self, key, body, content_type='application/json', content_encoding=None):
+        extra = {'ContentEncoding': content_encoding} if content_encoding is not None else {}
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType=content_type, **extra)
+
+
+class LocalBackend(object):
+    """Writes objects as files under a directory, laid out as they would be in the bucket."""
+
+    supports_content_encoding = False  # a plain file server would not send Content-Encoding
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, key, body, content_type='application/json', content_encoding=None):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as object_file:
+            object_file.write(body)
+        os.replace(path + '.tmp', path)  # readers never see a partly written file
+
+
+def flight_key(timestamp, icao):
+    return str(timestamp) + '/' + str(icao) + '_' + str(timestamp) + '.json'
+
+
+def aircraft_list_key(timestamp):
+    return str(timestamp) + '/' + 'aircraft_list_' + str(timestamp) + '.json'
+
+
+def bundle_key(timestamp):
+    return str(timestamp) + '/' + 'bundle_' + str(timestamp) + '.json'
+
+
+def delta_key(timestamp):
+    return str(timestamp) + '/' + 'delta_' + str(timestamp) + '.json'
+
+
+class SnapshotPublisher(object):
+    """Publishes flight snapshots through a backend, skipping flights whose content has not changed."""
+
+    def __init__(self, backend, threads=publish_threads, compress=True, write_bundle=True, write_flight_files=True,
+                 write_delta=True):
+        self.backend = backend
+        self.write_bundle = write_bundle
+        self.write_flight_files = write_flight_files
+        self.write_delta = write_delta
+        self.delta_timestamp = None  # marker the delta state below was published at
+        self.delta_state = {}  # Icao -> (score, time of the last coordinate published)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.compress = compress and backend.supports_content_encoding
+        self.published = {}  # Icao -> (content hash, key it was published under)
+
+    def _encode(self, document):
+        """Returns (body, content hash, content encoding) for a JSON document."""
+        body = json.dumps(document, sort_keys=True).encode()
+        digest = hashlib.sha1(body).hexdigest()
+        if self.compress:
+            return gzip.compress(body, 6), digest, 'gzip'
+        return body, digest, None
+
+    def _put(self, key, body, content_encoding):
+        self.backend.put(key, body, content_encoding=content_encoding)
+
+    def publish(self, timestamp, aircraft_scores, flights):
+        """Publishes (Icao, score) pairs and their flight dicts for a marker; returns publish statistics."""
+        started = time.time()
+        stats = {'timestamp': timestamp}
+        latest = {'TimeStamp': timestamp}
+        if self.write_flight_files:
+            stats.update(self._publish_flight_files(timestamp, aircraft_scores, flights))
+        if self.write_bundle:
+            body, digest, content_encoding = self._encode(build_bundle(timestamp, aircraft_scores, flights))
+            self._put(bundle_key(timestamp), body, content_encoding)
+            latest['Bundle'] = bundle_key(timestamp)
+            stats['bundle_bytes'] = len(body)
+        if self.write_delta:
+            delta, delta_state = build_delta(timestamp, self.delta_timestamp, self.delta_state, aircraft_scores, flights)
+            body, digest, content_encoding = self._encode(delta)
+            self._put(delta_key(timestamp), body, content_encoding)
+            self.delta_timestamp, self.delta_state = timestamp, delta_state
+            latest['Delta'] = delta_key(timestamp)
+            stats['delta_bytes'] = len(body)
+        body, digest, content_encoding = self._encode(latest)
+        self._put('latest.json', body, content_encoding)
+        stats['seconds'] = time.time() - started
+        for result in ('uploaded', 'unchanged', 'failed'):
+            metrics.increment('snapshot_objects_total', stats.get(result, 0), result=result)
+        logger.debug("Published snapshot {0}: {1}".format(timestamp, stats))
+        return stats
+
+    def _publish_flight_files(self, timestamp, aircraft_scores, flights):
+        """Uploads changed flights and the aircraft list pointing at every flight's latest copy."""
+        uploads = {}
+        files = {}
+        uploaded_bytes = 0
+        unchanged = 0
+        for (icao, score), flight_dict in zip(aircraft_scores, flights):
+            if flight_dict is None:
+                continue  # archived between the score read and the load
+            body, digest, content_encoding = self._encode(flight_dict)
+            previous = self.published.get(icao)
+            if previous is not None and previous[0] == digest:
+                files[icao] = previous[1]  # unchanged, point at the copy already published
+                unchanged += 1
+                continue
+            key = flight_key(timestamp, icao)
+            uploads[icao] = (digest, key, self.pool.submit(self._put, key, body, content_encoding))
+            uploaded_bytes += len(body)
+        failed = 0
+        for icao, (digest, key, upload) in uploads.items():
+            try:
+                upload.result()
+            except Exception as e:
+                failed += 1
+                logger.error("Publishing {0} failed: {1}".format(key, e))
+                previous = self.published.pop(icao, None)
+                if previous is not None:
+                    files[icao] = previous[1]  # an older copy beats a missing one
+                continue
+            self.published[icao] = (digest, key)
+            files[icao] = key
+        for icao in set(self.published) - set(icao for icao, score in aircraft_scores):
+            del self.published[icao]  # forget aircraft that are no longer flagged
+
+        aircraft_list = {'Aircraft': [[icao, score] for icao, score in aircraft_scores if icao in files], 'Files': files}
+        body, digest, content_encoding = self._encode(aircraft_list)
+        self._put(aircraft_list_key(timestamp), body, content_encoding)
+        return {'aircraft': len(files), 'uploaded': len(uploads) - failed, 'unchanged': unchanged,
+                'failed': failed, 'bytes': uploaded_bytes}
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time-decayed surveillance scores and the bounded top-K ranking.
+
+SurveillanceScore adds up every turn a flight ever made, so a long holding
+pattern ends up as high as a short, tight orbit. Alongside it each flight keeps
+WindowScores, one exponentially decayed sum of its turn scores per time
+constant in score_windows (15 minutes and an hour), last brought up to date at
+ScoredAt. Merges apply the turn_events calculate_bearings_and_turns returns, in
+O(turns) per merge.
+
+The surveillance_rank sorted set ranks flights by the ranking_window score using
+forward decay: a flight's member score is log(score) + ScoredAt / window, so
+every member decays at the same rate and the order never needs recomputing.
+Only members whose score grew are re-added, and the commit script trims the set
+to the ranking_size best, so it stays small. ranked_flights() reads it back with
+ZREVRANGE and turns the keys into scores as of a given time.
+"""
+
+import math
+
+score_windows = (900, 3600)  # seconds, time constants of WindowScores
+ranking_window = 900  # time constant of the score surveillance_rank orders by
+ranking_size = 500  # flights kept in surveillance_rank
+rank_key_name = 'surveillance_rank'
+
+
+def apply_turn_events(window_scores, scored_at, turn_events):
+    """Decays the window scores to each (time, score) turn event and adds it; returns (window scores, scored at)."""
+    window_scores = list(window_scores) if window_scores is not None else [0.0] * len(score_windows)
+    for event_time, score in turn_events:
+        if scored_at is None:
+            scored_at = event_time
+        if event_time >= scored_at:
+            window_scores = [value * math.exp((scored_at - event_time) / window) + score
+                             for value, window in zip(window_scores, score_windows)]
+            scored_at = event_time
+        else:  # an older turn, decayed to scored_at
+            window_scores = [value + score * math.exp((event_time - scored_at) / window)
+                             for value, window in zip(window_scores, score_windows)]
+    return window_scores, scored_at
+
+
+def decayed(window_scores, scored_at, now):
+    """The window scores decayed to now."""
+    return [value * math.exp(min(scored_at - now, 0) / window) for value, window in zip(window_scores, score_windows)]
+
+
+def rank_key(window_scores, scored_at):
+    """surveillance_rank member score for a flight, or None while it has no score to rank."""
+    value = window_scores[score_windows.index(ranking_window)]
+    if value <= 0:
+        return None
+    return math.log(value) + scored_at / ranking_window
+
+
+def rank_score(key, now):
+    """The ranking_window score as of now from a surveillance_rank member score."""
+    return math.exp(key - now / ranking_window)
+
+
+def ranked_flights(r, now, min_score, count=ranking_size):
+    """(Icao, ranking score as of now) of the best flights scoring at least min_score, best first."""
+    ranked = []
+    for icao, key in r.zrevrange(rank_key_name, 0, count - 1, withscores=True):
+        score = rank_score(key, now)
+        if score < min_score:
+            break
+        ranked.append((icao.decode() if isinstance(icao, bytes) else icao, round(score, 1)))
+    return ranked
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Icao-affine routing of flight snippets to consumer workers.
+
+Aircraft are hashed by Icao onto a fixed number of shards, each with its own
+durable queue (real_time.shard.<n>), so the converter can route without knowing
+which workers exist. Shards are in turn assigned to the live workers with a
+consistent hash ring: when a worker joins or leaves only the shards on its arc
+move. Workers announce themselves with a heartbeat in the redis sorted set
+consumer_workers, which works across hosts.
+"""
+
+import bisect
+import hashlib
+import os
+import socket
+import time
+import zlib
+
+shard_count = 64
+shard_queue_prefix = 'real_time.shard.'
+ring_replicas = 100  # virtual nodes per worker
+workers_key = 'consumer_workers'
+
+
+def shard_for_icao(icao, shards=shard_count):
+    """Returns the shard an aircraft is routed to."""
+    return zlib.crc32(icao.encode()) % shards
+
+
+def shard_queue(shard):
+    return shard_queue_prefix + str(shard)
+
+
+def shard_of_queue(queue):
+    """Returns the shard number of a shard queue name, or None for any other queue."""
+    if queue.startswith(shard_queue_prefix):
+        return int(queue[len(shard_queue_prefix):])
+    return None
+
+
+def worker_name():
+    """Identifies this consumer process across hosts."""
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def _ring_hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys onto a set of members."""
+
+    def __init__(self, members, replicas=ring_replicas):
+        self.members = sorted(members)
+        points = sorted((_ring_hash('{0}#{1}'.format(member, i)), member) for member in self.members for i in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, key):
+        if len(self.owners) == 0:
+            return None
+        index = bisect.bisect(self.hashes, _ring_hash(key)) % len(self.hashes)
+        return self.owners[index]
+
+
+class WorkerMembership(object):
+    """Heartbeats this worker into redis and works out which shards it owns."""
+
+    def __init__(self, r, name=None, ttl=30, shards=shard_count):
+        self.r = r
+        self.name = name or worker_name()
+        self.ttl = ttl
+        self.shards = shards
+
+    def heartbeat(self):
+        """Refreshes this worker, drops workers that stopped heartbeating and returns the live members."""
+        now = time.time()
+        pipe = self.r.pipeline()
+        pipe.execute_command('ZADD', workers_key, now, self.name)
+        pipe.zremrangebyscore(workers_key, '-inf', now - self.ttl)
+        pipe.zrange(workers_key, 0, -1)
+        members = pipe.execute()[-1]
+        return [m.decode() if isinstance(m, bytes) else m for m in members]
+
+    def owned_shards(self, members):
+        ring = HashRing(members)
+        return set(shard for shard in range(self.shards) if ring.owner('shard-' + str(shard)) == self.name)
+
+    def leave(self):
+        self.r.zrem(workers_key, self.name)
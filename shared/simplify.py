@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Error-bounded simplification of flight coordinate lists.
+
+Tracks are simplified with Douglas-Peucker on a local equirectangular
+projection, so the tolerance is the largest distance in metres any dropped
+point may lie from the simplified line. Indices passed as keep (turn points
+from calculate_bearings_and_turns) are never dropped, so turn counts and
+surveillance scores come out the same from the simplified track.
+
+filter_jitter()  drops points closer than a few metres to the last point kept,
+                 which would otherwise give noisy bearings; run it before bearings
+simplify_tail()  the streaming pass for the live track: simplifies newly merged
+                 points anchored on the last coordinate already stored, always
+                 keeping the newest point so the head stays current
+simplify_track() the offline pass over a whole track, used with a larger
+                 tolerance before flights are archived to mongo (simplify_archive,
+                 which finds the turn points from the stored bearings) and for
+                 the zoom levels of the web map bundle
+"""
+
+import math
+
+import numpy as np
+
+from shared.bearing_engine import find_turn_indices
+
+earth_radius = 6371008.8  # metres, mean radius
+min_point_spacing = 10.0  # metres a point must move from the last one kept to be kept
+tail_tolerance = 15.0  # metres of error allowed when simplifying the live track
+archive_tolerance = 50.0  # metres of error allowed in tracks archived to mongo
+
+
+def sort_by_time(coordinate_list):
+    """Sorts coordinates by time in place, skipping the sort when they already are (the usual case)."""
+    times = np.fromiter((coordinate[3] for coordinate in coordinate_list), dtype=float, count=len(coordinate_list))
+    if len(times) > 1 and (np.diff(times) < 0).any():
+        coordinate_list.sort(key=lambda coord: coord[3])
+    return coordinate_list
+
+
+def project(coordinate_list):
+    """Projects [lon, lat, ...] coordinates to an (n, 2) array of metres around their mean latitude."""
+    lonlat = np.radians(np.array([coordinate[0:2] for coordinate in coordinate_list], dtype=float).reshape(-1, 2))
+    longitudes = np.unwrap(lonlat[:, 0])  # keeps tracks crossing the antimeridian continuous
+    scale = np.cos(lonlat[:, 1].mean()) if len(lonlat) > 0 else 1.0
+    return np.column_stack((longitudes * scale * earth_radius, lonlat[:, 1] * earth_radius))
+
+
+def douglas_peucker_indices(points, tolerance, keep=()):
+    """Indices of the points kept by Douglas-Peucker simplification of an (n, 2) array.
+
+    The first and last points and every index in keep are always kept.
+    """
+    count = len(points)
+    if count < 3:
+        return np.arange(count)
+    kept = np.zeros(count, dtype=bool)
+    kept[[0, count - 1]] = True
+    kept[[i for i in keep if 0 <= i < count]] = True
+    if tolerance <= 0:
+        return np.arange(count)
+    anchors = np.flatnonzero(kept)
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while len(stack) > 0:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            # distance to the segment, not the infinite line, so reversals (orbits) are not cut off
+            along = np.clip(offsets.dot(segment) / (length * length), 0.0, 1.0)
+            distances = np.hypot(offsets[:, 0] - along * segment[0], offsets[:, 1] - along * segment[1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            kept[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(kept)
+
+
+def filter_jitter(last_coordinate, coordinate_list, spacing=min_point_spacing):
+    """Time-sorted coordinates that moved at least spacing metres from the previous one kept.
+
+    With last_coordinate None the first coordinate is always kept.
+    """
+    coordinate_list = sort_by_time(coordinate_list)
+    if len(coordinate_list) == 0:
+        return []
+    # equirectangular metres per degree at this latitude are plenty accurate over a few metres
+    scale = math.cos(math.radians(coordinate_list[0][1]))
+    degree = math.radians(1.0) * earth_radius
+    spacing_squared = (spacing / degree) ** 2
+    filtered = []
+    if last_coordinate is None:
+        last_coordinate = coordinate_list[0]
+        filtered.append(last_coordinate)
+    for coordinate in coordinate_list[len(filtered):]:
+        longitude_delta = ((coordinate[0] - last_coordinate[0] + 180.0) % 360.0 - 180.0) * scale
+        if longitude_delta * longitude_delta + (coordinate[1] - last_coordinate[1]) ** 2 >= spacing_squared:
+            filtered.append(coordinate)
+            last_coordinate = coordinate
+    return filtered
+
+
+def simplify_track(coordinate_list, tolerance=archive_tolerance, keep=()):
+    """Simplifies a time-ordered coordinate list so no dropped point is more than tolerance metres off the track kept."""
+    if len(coordinate_list) < 3:
+        return list(coordinate_list)
+    return [coordinate_list[i] for i in douglas_peucker_indices(project(coordinate_list), tolerance, keep)]
+
+
+def simplify_tail(last_coordinate, coordinate_list, tolerance=tail_tolerance, keep=()):
+    """Simplifies coordinates appended after last_coordinate, which is already stored and is not returned.
+
+    Indices in keep refer to coordinate_list. The newest coordinate is always kept.
+    """
+    if last_coordinate is None:
+        return simplify_track(coordinate_list, tolerance, keep)
+    if len(coordinate_list) < 2:
+        return list(coordinate_list)
+    points = project([last_coordinate] + coordinate_list)
+    kept = douglas_peucker_indices(points, tolerance, [i + 1 for i in keep])
+    return [coordinate_list[i - 1] for i in kept[1:]]
+
+
+def turn_points(turn_indexes, offset=0):
+    """Indexes to keep for turns found at turn_indexes: the turning point and the one after, shifted by offset."""
+    return sorted(set(j - offset for i in turn_indexes for j in (i, i + 1)))
+
+
+def simplify_archive(coordinate_list, tolerance=archive_tolerance):
+    """The offline pass for a whole stored track, keeping the turn points its bearings give."""
+    coordinate_list = sort_by_time(coordinate_list)
+    return simplify_track(coordinate_list, tolerance, turn_points(find_turn_indices(coordinate_list)))
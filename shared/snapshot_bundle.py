@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-file snapshot of the surveillance flights for the web map.
+
+Instead of one full-resolution GeoJSON file per aircraft, a bundle holds every
+flagged aircraft of a marker with its track simplified for a few zoom ranges
+(detail_levels) and stored as an encoded polyline: coordinates quantised to
+1e-5 degrees, delta-encoded and written as base64-like varints (the Google
+polyline format, decoded by decode_polyline() in webview/leaflet-aws.js).
+
+A delta document lists what changed since the previous marker: aircraft added
+(with their whole track), removed, and updated (new score and/or only the
+coordinates newer than those already published). A map that has drawn the
+Previous marker patches its layers from the delta instead of reloading.
+"""
+
+from shared.simplify import simplify_track
+
+polyline_precision = 5
+# (lowest map zoom the level is drawn at, simplification tolerance in metres)
+detail_levels = ((0, 2000.0), (6, 200.0), (10, 0.0))
+bundle_fields = ('Icao', 'Reg', 'Type', 'Op', 'Call', 'LastSeen')  # copied from the flight for popups
+
+
+def _encode_value(value, pieces):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        pieces.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    pieces.append(chr(value + 63))
+
+
+def encode_polyline(coordinate_list, precision=polyline_precision):
+    """Encodes [lon, lat, ...] coordinates as a polyline string of quantised lat/lon deltas."""
+    factor = 10 ** precision
+    pieces = []
+    previous_latitude = previous_longitude = 0
+    for coordinate in coordinate_list:
+        latitude = int(round(coordinate[1] * factor))
+        longitude = int(round(coordinate[0] * factor))
+        _encode_value(latitude - previous_latitude, pieces)
+        _encode_value(longitude - previous_longitude, pieces)
+        previous_latitude, previous_longitude = latitude, longitude
+    return ''.join(pieces)
+
+
+def decode_polyline(encoded, precision=polyline_precision):
+    """Decodes a polyline string back to [lon, lat] coordinates."""
+    factor = float(10 ** precision)
+    values = []
+    value = shift = 0
+    for character in encoded:
+        chunk = ord(character) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coordinates = []
+    latitude = longitude = 0
+    for latitude_delta, longitude_delta in zip(values[0::2], values[1::2]):
+        latitude += latitude_delta
+        longitude += longitude_delta
+        coordinates.append([longitude / factor, latitude / factor])
+    return coordinates
+
+
+def build_bundle(timestamp, aircraft_scores, flights, levels=detail_levels):
+    """Returns the bundle document for (Icao, score) pairs and their flight dicts."""
+    aircraft = []
+    for (icao, score), flight_dict in zip(aircraft_scores, flights):
+        if flight_dict is None:
+            continue
+        coordinate_list = sorted(flight_dict['geometry']['coordinates'], key=lambda coord: coord[3])
+        entry = {field: flight_dict[field] for field in bundle_fields if field in flight_dict}
+        entry['Score'] = score
+        entry['Tracks'] = [encode_polyline(simplify_track(coordinate_list, tolerance)) for min_zoom, tolerance in levels]
+        aircraft.append(entry)
+    return {'TimeStamp': timestamp,
+            'Precision': polyline_precision,
+            'Levels': [min_zoom for min_zoom, tolerance in levels],
+            'Aircraft': aircraft}
+
+
+def build_delta(timestamp, previous_timestamp, published, aircraft_scores, flights):
+    """Returns the delta document since previous_timestamp and the new published state.
+
+    published maps each Icao drawn at previous_timestamp to (score, time of its last coordinate).
+    """
+    added = []
+    updated = []
+    state = {}
+    for (icao, score), flight_dict in zip(aircraft_scores, flights):
+        if flight_dict is None:
+            continue
+        coordinate_list = sorted(flight_dict['geometry']['coordinates'], key=lambda coord: coord[3])
+        if len(coordinate_list) == 0:
+            continue
+        state[icao] = (score, coordinate_list[-1][3])
+        if icao not in published:
+            entry = {field: flight_dict[field] for field in bundle_fields if field in flight_dict}
+            entry['Score'] = score
+            entry['Track'] = encode_polyline(coordinate_list)
+            added.append(entry)
+            continue
+        previous_score, previous_time = published[icao]
+        update = {}
+        if score != previous_score:
+            update['Score'] = score
+        tail = [coordinate for coordinate in coordinate_list if coordinate[3] > previous_time]
+        if len(tail) > 0:
+            update['Tail'] = encode_polyline(tail)
+        if len(update) > 0:
+            update['Icao'] = icao
+            updated.append(update)
+    delta = {'TimeStamp': timestamp,
+             'Previous': previous_timestamp,
+             'Precision': polyline_precision,
+             'Added': added,
+             'Removed': [icao for icao in published if icao not in state],
+             'Updated': updated}
+    return delta, state
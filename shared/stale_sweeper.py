@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental archiving of flights that have dropped out of the data feed.
+
+sweep_stale_flights() walks the flight_scan_times sorted set in bounded pages
+instead of reading every stale Icao at once: each page is loaded with one
+pipelined round trip, deleted from redis with one pipelined batch of versioned
+commits, and written to mongo in size-capped unordered insert_many batches (or
+handed to a FlightWriter from shared/mongo_writer.py), so memory stays bounded
+by the page size however far behind the sweep is. It runs inline on the marker
+shard's consumer or as its own process (stale-sweeper.py). Flights whose tracks
+were partly moved to mongo (shared/track_tiers.py) are stitched back together
+before they are archived.
+"""
+
+import logging
+
+from shared import metrics
+from shared.flight_update import version_of
+from shared.mongo_writer import insert_documents
+from shared.simplify import simplify_archive
+
+logger = logging.getLogger()
+
+stale_age = 3600  # seconds since a flight was last seen before it is archived
+sweep_chunk_size = 500  # flights read, deleted and archived per round trip
+mongo_batch_size = 500  # documents per insert_many
+
+
+def flight_status(flight_dict, airport_id):
+    """Marks an archived flight as landed at airport_id, or out of range if no airport was found."""
+    if airport_id == 0:
+        flight_dict['FlightStatus'] = 'OutOfRange'
+    else:
+        flight_dict['LandedAirportID'] = airport_id
+        flight_dict['FlightStatus'] = 'Landed'
+
+
+def insert_flights(dbmongo, flights_to_mongo, batch_size=mongo_batch_size, failed_flights=None):
+    """Inserts archived flights in unordered batches; returns the number written.
+
+    If failed_flights is a list, the flights that were not written are added to it.
+    """
+    inserted = 0
+    for start in range(0, len(flights_to_mongo), batch_size):
+        batch = flights_to_mongo[start:start + batch_size]
+        failed_indexes = [] if failed_flights is not None else None
+        written, failed = insert_documents(dbmongo.flighthistory, batch, failed_indexes)
+        inserted += written
+        if failed_flights is not None:
+            failed_flights.extend(batch[n] for n in failed_indexes)
+    return inserted
+
+
+def sweep_stale_flights(file_time, updater, dbmongo, airport_lookup, max_age=stale_age, chunk_size=sweep_chunk_size, batch_size=mongo_batch_size,
+                        writer=None, tiers=None):
+    """Archives and removes flights not seen for max_age seconds; returns (flights archived, flights removed).
+
+    With a writer, flights are queued on it and counted as archived without waiting for mongo. With tiers (a TrackTiers),
+    spilled segments are stitched back on and deleted once the flight is archived: the segments of flights handed to the
+    writer are left to its on_written callback, and those of a failed insert to the TTL index.
+    """
+    r = updater.store.r
+    archived = 0
+    removed = 0
+    skipped = set()  # stale entries left in place because a consumer updated the flight meanwhile
+    while True:
+        # archived and orphaned entries leave the set, so every page is read from the start, past the skipped ones
+        page_size = chunk_size + len(skipped)
+        page = [i.decode() if isinstance(i, bytes) else i for i in
+                r.zrangebyscore('flight_scan_times', '0', file_time - max_age, start=0, num=page_size)]
+        stale_flight_list = [i for i in page if i not in skipped]
+        if len(stale_flight_list) == 0:
+            break
+        flights = updater.load_many(stale_flight_list)
+        orphans = [i for i, flight_dict in zip(stale_flight_list, flights) if flight_dict is None]
+        if len(orphans) > 0:
+            r.zrem('flight_scan_times', *orphans)  # scan time left behind without a flight
+        stale_flights = [flight_dict for flight_dict in flights if flight_dict is not None]
+        # skip flights that were updated by a consumer since they were read
+        applied = updater.delete_many([(flight_dict['Icao'], version_of(flight_dict)) for flight_dict in stale_flights])
+        skipped.update(flight_dict['Icao'] for flight_dict, deleted in zip(stale_flights, applied) if not deleted)
+        stale_flights = [flight_dict for flight_dict, deleted in zip(stale_flights, applied) if deleted]
+        removed += len(stale_flights)
+        if tiers is not None:
+            tiers.stitch_many(stale_flights)
+
+        ended = [n for n, flight_dict in enumerate(stale_flights) if len(flight_dict['geometry']['coordinates']) > 0
+                 and len(flight_dict['geometry']['coordinates'][-1]) >= 2]
+        airport_ids = [0] * len(stale_flights)
+        for n, airport_id in zip(ended, airport_lookup([stale_flights[n]['geometry']['coordinates'][-1][0:2] for n in ended])):
+            airport_ids[n] = airport_id
+        flights_to_mongo = []
+        for flight_dict, airport_id in zip(stale_flights, airport_ids):
+            flight_status(flight_dict, airport_id)
+            flight_dict['geometry']['coordinates'] = simplify_archive(flight_dict['geometry']['coordinates'])
+            if len(flight_dict['geometry']['coordinates']) > 1:
+                flights_to_mongo.append(flight_dict)
+        kept = []  # flights whose segments must outlive this sweep
+        if writer is not None:
+            writer.write_many(flights_to_mongo)
+            archived += len(flights_to_mongo)
+            kept = flights_to_mongo
+        elif len(flights_to_mongo) > 0:
+            archived += insert_flights(dbmongo, flights_to_mongo, batch_size, kept)
+        if tiers is not None:
+            kept = set(id(flight_dict) for flight_dict in kept)
+            tiers.forget(stale_flights)
+            tiers.delete_segments([flight_dict for flight_dict in stale_flights if id(flight_dict) not in kept])
+        if len(page) < page_size:
+            break
+    metrics.increment('stale_flights_total', removed)
+    metrics.increment('flights_archived_total', archived)
+    if removed == 0:
+        logger.debug("No flights inserted")
+    return archived, removed
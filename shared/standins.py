@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process stand-ins for the services the pipeline talks to.
+
+Used by benchmark.py (and replay runs) to drive the converter and the queue
+consumer without RabbitMQ, Redis, MongoDB or S3. Each stand-in implements only
+the calls this repository makes, with the same reply types as the real client:
+
+MemoryRedis    redis-py StrictRedis subset: strings, hashes, sorted sets and
+               pipelines with WATCH/MULTI, but no Lua, so flight commits run
+               with use_scripts=False through the WATCH/MULTI path of
+               shared/flight_update.py. Clients created with the same
+               MemoryRedisData share one keyspace, like two connections to one
+               server; decode_responses is honoured.
+MemoryChannel  pika BlockingChannel subset with per-queue deques and publisher
+               confirms that always succeed.
+MemoryMongo    database of collections that keep inserted documents in lists,
+               with equality, $in, $gt/$gte/$lt/$lte, $or and box
+               $geoIntersects filters, and find() projections, sorts and
+               limits.
+MemoryBackend  SnapshotPublisher backend that keeps uploaded objects in a dict.
+
+load_script() imports converter.py or queue-consumer.py so their functions can
+be driven with these.
+"""
+
+from collections import defaultdict, deque
+import bisect
+import copy
+import importlib.util
+import os
+import types
+
+from redis.exceptions import WatchError
+
+from shared.history_query import segment_meets_box
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(name, filename):
+    """Imports one of the top-level scripts (whose file names are not valid module names) without running main()."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(repository, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, bytearray):
+        return bytes(value)
+    if isinstance(value, str):
+        return value.encode()
+    return repr(value).encode() if isinstance(value, float) else str(value).encode()
+
+
+def _text(value):
+    return value.decode() if isinstance(value, (bytes, bytearray)) else str(value)
+
+
+def _score(value):
+    if isinstance(value, (bytes, str)):
+        value = _text(value)
+        if value in ('-inf', '+inf', 'inf'):
+            return float(value)
+    return float(value)
+
+
+class MemoryRedisData(object):
+    """The keyspace shared by every MemoryRedis client made from it."""
+
+    def __init__(self):
+        self.strings = {}  # key -> bytearray
+        self.hashes = {}  # key -> {field str: value bytes}
+        self.zsets = {}  # key -> {member str: score}
+        self.versions = defaultdict(int)  # key -> write count, for WATCH
+
+    def touch(self, key):
+        self.versions[key] += 1
+
+    def delete(self, key):
+        found = 0
+        for space in (self.strings, self.hashes, self.zsets):
+            if space.pop(key, None) is not None:
+                found = 1
+        self.touch(key)
+        return found
+
+
+class MemoryRedis(object):
+    """The subset of redis.StrictRedis used by this repository, kept in memory."""
+
+    def __init__(self, data=None, decode_responses=False):
+        self.data = data if data is not None else MemoryRedisData()
+        self.decode_responses = decode_responses
+
+    def _reply(self, value):
+        if value is None:
+            return None
+        return _text(value) if self.decode_responses else bytes(value)
+
+    def _member(self, member):
+        return member if self.decode_responses else member.encode()
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        raise NotImplementedError("MemoryRedis has no Lua; commit with FlightUpdater(store, use_scripts=False)")
+
+    def execute_command(self, *args):
+        return getattr(self, _text(args[0]).lower())(*args[1:])
+
+    def flushall(self):
+        self.data.__init__()
+
+    # keys and strings
+    def exists(self, key):
+        return int(key in self.data.strings or key in self.data.hashes or key in self.data.zsets)
+
+    def delete(self, *keys):
+        return sum(self.data.delete(key) for key in keys)
+
+    def keys(self, pattern='*'):
+        found = set(self.data.strings) | set(self.data.hashes) | set(self.data.zsets)
+        return [self._member(key) for key in found]
+
+    def get(self, key):
+        return self._reply(self.data.strings.get(key))
+
+    def set(self, key, value):
+        self.data.delete(key)
+        self.data.strings[key] = bytearray(_bytes(value))
+        return True
+
+    def append(self, key, value):
+        stored = self.data.strings.setdefault(key, bytearray())
+        stored += _bytes(value)
+        self.data.touch(key)
+        return len(stored)
+
+    def setrange(self, key, offset, value):
+        stored = self.data.strings.setdefault(key, bytearray())
+        value = _bytes(value)
+        if len(stored) < offset:
+            stored += b'\0' * (offset - len(stored))
+        stored[offset:offset + len(value)] = value
+        self.data.touch(key)
+        return len(stored)
+
+    def getrange(self, key, start, end):
+        stored = self.data.strings.get(key, bytearray())
+        length = len(stored)
+        start = max(start + length, 0) if start < 0 else start
+        end = end + length if end < 0 else min(end, length - 1)
+        if length == 0 or start > end:
+            return self._reply(b'')
+        return self._reply(stored[start:end + 1])
+
+    def strlen(self, key):
+        return len(self.data.strings.get(key, b''))
+
+    # hashes
+    def hget(self, key, field):
+        return self._reply(self.data.hashes.get(key, {}).get(_text(field)))
+
+    def hgetall(self, key):
+        return {self._member(field): self._reply(value) for field, value in self.data.hashes.get(key, {}).items()}
+
+    def hset(self, key, field, value):
+        self.data.hashes.setdefault(key, {})[_text(field)] = _bytes(value)
+        self.data.touch(key)
+        return 1
+
+    def hmset(self, key, mapping):
+        fields = self.data.hashes.setdefault(key, {})
+        for field, value in mapping.items():
+            fields[_text(field)] = _bytes(value)
+        self.data.touch(key)
+        return True
+
+    # sorted sets
+    def zadd(self, key, score, member):
+        self.data.zsets.setdefault(key, {})[_text(member)] = _score(score)
+        self.data.touch(key)
+        return 1
+
+    def zrem(self, key, *members):
+        zset = self.data.zsets.get(key, {})
+        removed = sum(1 for member in members if zset.pop(_text(member), None) is not None)
+        self.data.touch(key)
+        return removed
+
+    def zcard(self, key):
+        return len(self.data.zsets.get(key, {}))
+
+    def _sorted(self, key):
+        return sorted(self.data.zsets.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def zrange(self, key, start, end, withscores=False):
+        items = self._sorted(key)
+        end = len(items) + end if end < 0 else end
+        return self._items(items[start:end + 1], withscores)
+
+    def zrevrange(self, key, start, end, withscores=False):
+        items = self._sorted(key)[::-1]
+        end = len(items) + end if end < 0 else end
+        return self._items(items[start:end + 1], withscores)
+
+    def zrangebyscore(self, key, low, high, start=None, num=None, withscores=False):
+        items = self._sorted(key)
+        scores = [score for member, score in items]
+        items = items[bisect.bisect_left(scores, _score(low)):bisect.bisect_right(scores, _score(high))]
+        if start is not None:
+            items = items[start:start + num]
+        return self._items(items, withscores)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.data.zsets.get(key, {})
+        doomed = [member for member, score in zset.items() if _score(low) <= score <= _score(high)]
+        for member in doomed:
+            del zset[member]
+        self.data.touch(key)
+        return len(doomed)
+
+    def zremrangebyrank(self, key, start, end):
+        zset = self.data.zsets.get(key, {})
+        items = self._sorted(key)
+        start = max(len(items) + start, 0) if start < 0 else start
+        end = len(items) + end if end < 0 else end
+        doomed = [member for member, score in items[start:end + 1]] if end >= 0 else []
+        for member in doomed:
+            del zset[member]
+        self.data.touch(key)
+        return len(doomed)
+
+    def _items(self, items, withscores):
+        if withscores:
+            return [(self._member(member), score) for member, score in items]
+        return [self._member(member) for member, score in items]
+
+    def georadius(self, *args, **kwargs):
+        raise NotImplementedError("MemoryRedis has no geo sets; load an AirportIndex instead")
+
+
+class MemoryPipeline(object):
+    """Buffers commands and runs them in order on execute(); supports WATCH/MULTI."""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.watched = None
+        self.immediate = False
+
+    def _queue(self, function, args, kwargs):
+        if self.immediate:
+            return function(*args, **kwargs)
+        self.commands.append((function, args, kwargs))
+        return self
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        return lambda *args, **kwargs: self._queue(method, args, kwargs)
+
+    def watch(self, *keys):
+        self.watched = {key: self.client.data.versions[key] for key in keys}
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        if self.watched is not None:
+            watched, self.watched = self.watched, None
+            if any(self.client.data.versions[key] != version for key, version in watched.items()):
+                raise WatchError("Watched variable changed.")
+        return [function(*args, **kwargs) for function, args, kwargs in commands]
+
+    def reset(self):
+        self.commands = []
+        self.watched = None
+        self.immediate = False
+
+
+class MemoryChannel(object):
+    """The subset of a pika BlockingChannel used by the converter and consumer."""
+
+    def __init__(self):
+        self.queues = defaultdict(deque)
+        self.acked = 0
+
+    def queue_declare(self, queue, durable=False, passive=False):
+        self.queues[queue]
+        return types.SimpleNamespace(method=types.SimpleNamespace(queue=queue, message_count=len(self.queues[queue])))
+
+    def basic_qos(self, prefetch_count=0):
+        pass
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.queues[routing_key].append((_bytes(body), properties))
+        return True
+
+    def basic_ack(self, delivery_tag=None):
+        self.acked += 1
+
+    def drain(self, queue):
+        """Yields (method, properties, body) for every message on a queue, in order, until it is empty."""
+        messages = self.queues[queue]
+        delivery_tag = 0
+        while len(messages) > 0:
+            body, properties = messages.popleft()
+            delivery_tag += 1
+            yield types.SimpleNamespace(routing_key=queue, delivery_tag=delivery_tag), properties, body
+
+
+def _intersects_boxes(geometry, polygons):
+    """$geoIntersects of a Point or LineString with box-shaped (Multi)Polygons, taking edges as straight lon/lat lines
+    where mongo follows great circles."""
+    rings = [polygons['coordinates'][0]] if polygons['type'] == 'Polygon' else [polygon[0] for polygon in polygons['coordinates']]
+    boxes = [(min(p[0] for p in ring), min(p[1] for p in ring), max(p[0] for p in ring), max(p[1] for p in ring)) for ring in rings]
+    points = [geometry['coordinates']] * 2 if geometry['type'] == 'Point' else geometry['coordinates']
+    return any(segment_meets_box(a, b, box) for a, b in zip(points, points[1:]) for box in boxes)
+
+
+class MemoryCollection(object):
+    """A mongo collection that keeps inserted documents in a list."""
+
+    def __init__(self):
+        self.documents = []
+
+    def insert_one(self, document):
+        self.documents.append(copy.deepcopy(document))
+        return types.SimpleNamespace(inserted_id=len(self.documents) - 1)
+
+    def insert_many(self, documents, ordered=True):
+        start = len(self.documents)
+        self.documents.extend(copy.deepcopy(document) for document in documents)
+        return types.SimpleNamespace(inserted_ids=list(range(start, len(self.documents))))
+
+    def create_index(self, keys, **kwargs):
+        return '_'.join(str(part) for key in keys for part in key)
+
+    @staticmethod
+    def _matches(document, query):
+        for key, condition in query.items():
+            if key == '$or':
+                if not any(MemoryCollection._matches(document, alternative) for alternative in condition):
+                    return False
+                continue
+            value = document.get(key)
+            if isinstance(condition, dict) and any(operator.startswith('$') for operator in condition):
+                for operator, operand in condition.items():
+                    if operator == '$in' and value not in operand:
+                        return False
+                    if operator == '$gte' and (value is None or value < operand):
+                        return False
+                    if operator == '$gt' and (value is None or value <= operand):
+                        return False
+                    if operator == '$lte' and (value is None or value > operand):
+                        return False
+                    if operator == '$lt' and (value is None or value >= operand):
+                        return False
+                    if operator == '$geoIntersects' and (value is None or not _intersects_boxes(value, operand['$geometry'])):
+                        return False
+            elif value != condition:
+                return False
+        return True
+
+    def find(self, query=None, projection=None, sort=None, limit=0):
+        found = [document for document in self.documents if self._matches(document, query or {})]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda document: document.get(key), reverse=direction < 0)
+        if limit > 0:
+            found = found[:limit]
+        excluded = [key for key, shown in (projection or {}).items() if not shown]
+        return [{key: value for key, value in copy.deepcopy(document).items() if key not in excluded} for document in found]
+
+    def replace_one(self, query, document, upsert=False):
+        for n, existing in enumerate(self.documents):
+            if self._matches(existing, query):
+                self.documents[n] = copy.deepcopy(document)
+                return types.SimpleNamespace(matched_count=1, upserted_id=None)
+        if upsert:
+            self.documents.append(copy.deepcopy(document))
+            return types.SimpleNamespace(matched_count=0, upserted_id=document.get('_id'))
+        return types.SimpleNamespace(matched_count=0, upserted_id=None)
+
+    def delete_many(self, query):
+        kept = [document for document in self.documents if not self._matches(document, query)]
+        deleted = len(self.documents) - len(kept)
+        self.documents[:] = kept
+        return types.SimpleNamespace(deleted_count=deleted)
+
+    def count(self):
+        return len(self.documents)
+
+
+class MemoryMongo(object):
+    """A mongo database whose collections are created on first access."""
+
+    def __init__(self):
+        self.collections = defaultdict(MemoryCollection)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.collections[name]
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+
+class MemoryBackend(object):
+    """SnapshotPublisher backend keeping uploaded objects in memory."""
+
+    supports_content_encoding = True
+
+    def __init__(self):
+        self.objects = {}  # key -> (body, content encoding)
+
+    def put(self, key, body, content_type='application/json', content_encoding=None):
+        self.objects[key] = (body, content_encoding)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic Virtual Radar Server traffic for benchmarks.
+
+SyntheticSky keeps a population of aircraft and, for each poll, advances them
+and returns an AircraftList.json style dict (acList with short trails in the
+'sa' format: lat, lon, time in ms, altitude). Three kinds of aircraft are
+flown:
+
+cruise        straight legs at airliner altitudes with the odd heading change
+surveillance  low, slow orbits around a fixed point: the flights the
+              consumer scores highly and publishes
+landing       descends onto one of the synthetic airports and stays there, so
+              the landing checks fire
+
+Aircraft leave the feed after a random lifetime and new ones take their place,
+which gives the stale sweep work to do. airports() lists the airports used, for
+building an airport index.
+
+SyntheticVrsServer serves a sky over HTTP like AircraftList.json, honouring
+the bounding box filters and ldv delta polling, as a stand-in for the VRS
+instances the converter's async poller talks to.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import math
+import random
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import parse_qs, urlparse
+
+earth_radius = 6371008.8  # metres
+knots = 0.514444  # metres per second
+
+
+class SyntheticAircraft(object):
+
+    def __init__(self, sky, kind):
+        rng = sky.rng
+        sky.serial += 1
+        self.id = sky.serial
+        self.icao = '{0:06X}'.format(0xA00000 + self.id)
+        self.kind = kind
+        self.born = sky.time
+        self.lifetime = rng.uniform(0.5, 2.0) * sky.mean_lifetime
+        self.trail = []
+        if kind == 'landing':
+            self.airport = rng.choice(sky.airport_list)
+            distance = rng.uniform(20000, 60000)
+            bearing = rng.uniform(0, 2 * math.pi)
+            self.latitude = self.airport[1] + math.degrees(distance * math.cos(bearing) / earth_radius)
+            self.longitude = self.airport[2] + math.degrees(distance * math.sin(bearing) / earth_radius) / math.cos(math.radians(self.airport[1]))
+            self.altitude = rng.uniform(5000, 10000)
+            self.speed = rng.uniform(140, 180) * knots
+        else:
+            self.latitude = rng.uniform(*sky.latitude_range)
+            self.longitude = rng.uniform(*sky.longitude_range)
+            if kind == 'surveillance':
+                self.altitude = rng.choice([3500, 5000, 6500, 9000])
+                self.speed = rng.uniform(90, 140) * knots
+                self.turn_rate = rng.choice([-1, 1]) * 360.0 / rng.uniform(120, 400)  # degrees per second
+            else:
+                self.altitude = rng.uniform(25000, 41000)
+                self.speed = rng.uniform(420, 520) * knots
+        self.heading = rng.uniform(0, 360)
+
+    def step(self, seconds, rng):
+        if self.kind == 'surveillance':
+            self.heading = (self.heading + self.turn_rate * seconds) % 360
+        elif self.kind == 'landing':
+            north = math.radians(self.airport[1] - self.latitude) * earth_radius
+            east = math.radians(self.airport[2] - self.longitude) * earth_radius * math.cos(math.radians(self.latitude))
+            remaining = math.hypot(north, east)
+            if remaining < 200:
+                self.speed = 0.0  # taxied in, stays put until it leaves the feed
+                self.altitude = 25
+                return
+            self.heading = math.degrees(math.atan2(east, north)) % 360
+            self.altitude = max(min(self.altitude, remaining / 6.0), 25)  # roughly a 3 degree glide path in feet
+            self.speed = min(self.speed, max(remaining / seconds, 1.0))
+        elif rng.random() < 0.01:
+            self.heading = (self.heading + rng.uniform(-45, 45)) % 360
+        distance = self.speed * seconds
+        self.latitude += math.degrees(distance * math.cos(math.radians(self.heading)) / earth_radius)
+        self.longitude += math.degrees(distance * math.sin(math.radians(self.heading)) / earth_radius) / \
+            max(math.cos(math.radians(self.latitude)), 0.01)
+        self.longitude = (self.longitude + 180.0) % 360.0 - 180.0
+        self.latitude = max(min(self.latitude, 84.0), -84.0)
+
+    def item(self, trail_points, since=None):
+        """The acList entry; with since (unix ms) only trail points after it and the fields that move, as in a delta."""
+        cos = []
+        for point in self.trail[-trail_points:]:
+            if since is None or point[2] > since:
+                cos.extend(point)
+        if since is not None:
+            delta = {'Id': self.id}
+            if len(cos) > 0:
+                delta.update({'Alt': int(self.altitude), 'Lat': self.latitude, 'Long': self.longitude,
+                              'Trak': round(self.heading, 1), 'Spd': round(self.speed / knots, 1), 'Cos': cos})
+            return delta
+        return {'Id': self.id, 'Icao': self.icao, 'Reg': 'N' + str(self.id), 'Type': 'C172' if self.kind != 'cruise' else 'B738',
+                'Call': 'SYN' + str(self.id), 'Alt': int(self.altitude), 'Lat': self.latitude, 'Long': self.longitude,
+                'Trak': round(self.heading, 1), 'Spd': round(self.speed / knots, 1), 'TT': 'a', 'Cos': cos}
+
+
+class SyntheticSky(object):
+    """Generates successive VRS AircraftList snapshots for a population of aircraft."""
+
+    def __init__(self, aircraft_count=1000, trail_points=60, sample_seconds=5, surveillance_fraction=0.05,
+                 landing_fraction=0.05, airport_count=200, mean_lifetime=3600, start_time=1500000000, seed=1,
+                 latitude_range=(25.0, 49.0), longitude_range=(-124.0, -67.0)):
+        self.rng = random.Random(seed)
+        self.aircraft_count = aircraft_count
+        self.trail_points = trail_points
+        self.sample_seconds = sample_seconds
+        self.surveillance_fraction = surveillance_fraction
+        self.landing_fraction = landing_fraction
+        self.mean_lifetime = mean_lifetime
+        self.latitude_range = latitude_range
+        self.longitude_range = longitude_range
+        self.time = start_time
+        self.serial = 0
+        self.airport_list = [('SYN{0}'.format(i), self.rng.uniform(*latitude_range), self.rng.uniform(*longitude_range))
+                             for i in range(airport_count)]
+        self.aircraft = [self._spawn() for _ in range(aircraft_count)]
+        self.advance(trail_points * sample_seconds)  # start with full trails
+
+    def _spawn(self):
+        draw = self.rng.random()
+        if draw < self.surveillance_fraction:
+            return SyntheticAircraft(self, 'surveillance')
+        if draw < self.surveillance_fraction + self.landing_fraction:
+            return SyntheticAircraft(self, 'landing')
+        return SyntheticAircraft(self, 'cruise')
+
+    def airports(self):
+        """(airport ID, latitude, longitude) of the airports landing aircraft head for."""
+        return list(self.airport_list)
+
+    def advance(self, seconds):
+        """Flies every aircraft forward, recording a trail point every sample_seconds and replacing departed aircraft."""
+        end = self.time + seconds
+        while self.time < end:
+            self.time += self.sample_seconds
+            for aircraft in self.aircraft:
+                aircraft.step(self.sample_seconds, self.rng)
+                aircraft.trail.append([round(aircraft.latitude, 6), round(aircraft.longitude, 6), self.time * 1000, int(aircraft.altitude)])
+                del aircraft.trail[:-self.trail_points]
+        for i, aircraft in enumerate(self.aircraft):
+            if self.time - aircraft.born > aircraft.lifetime:
+                self.aircraft[i] = self._spawn()
+
+    def snapshot(self, seconds=60):
+        """Advances the sky by one poll interval and returns the AircraftList.json dict a full-trail poll would get."""
+        self.advance(seconds)
+        return self.aircraft_list()
+
+    def aircraft_list(self, since=None, bounds=None):
+        """The AircraftList.json dict for the sky as it is: trail points after since (unix ms) only, if given, and
+        only aircraft inside bounds (south, west, north, east), if given."""
+        aircraft_list = []
+        for aircraft in self.aircraft:
+            if len(aircraft.trail) == 0:
+                continue
+            if bounds is not None and not (bounds[0] <= aircraft.latitude <= bounds[2] and bounds[1] <= aircraft.longitude <= bounds[3]):
+                continue
+            aircraft_list.append(aircraft.item(self.trail_points, since))
+        return {'acList': aircraft_list,
+                'totalAc': len(aircraft_list),
+                'lastDv': str(self.time * 1000),
+                'stm': self.time * 1000}
+
+
+class SyntheticVrsServer(ThreadingMixIn, HTTPServer):
+    """Serves a SyntheticSky on http://127.0.0.1:<port>/VirtualRadar/AircraftList.json from a daemon thread.
+
+    The sky does not move on its own; advance it between polls under the lock. Every request is counted in requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, sky, port=0):
+        self.sky = sky
+        self.lock = threading.Lock()
+        self.requests = []  # query parameters of every request served
+        HTTPServer.__init__(self, ('127.0.0.1', port), _SyntheticVrsHandler)
+        self.url = 'http://127.0.0.1:{0}/VirtualRadar/AircraftList.json'.format(self.server_port)
+        thread = threading.Thread(target=self.serve_forever, name='synthetic-vrs')
+        thread.daemon = True
+        thread.start()
+
+
+class _SyntheticVrsHandler(BaseHTTPRequestHandler):
+
+    def do_PUT(self):
+        query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        bounds = None
+        if 'fSBnd' in query:
+            bounds = tuple(float(query[key]) for key in ('fSBnd', 'fWBnd', 'fNBnd', 'fEBnd'))
+        since = int(query['ldv']) if 'ldv' in query else None
+        with self.server.lock:
+            self.server.requests.append(query)
+            body = json.dumps(self.server.sky.aircraft_list(since, bounds)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact track storage in redis.
+
+A flight is kept as two keys instead of one whole-flight JSON blob:
+
+track:<Icao>   string of packed fixed-width coordinate records, grown with APPEND
+flight:<Icao>  hash of the remaining flight fields (LiveTurns, SurveillanceScore,
+               LandedScan, LastTurnPoint, VRS aircraft details...), one JSON value per field
+
+Each record is lon, lat (float64), altitude (int32 feet), time (float64 unix
+seconds) and bearing (float64, NaN until the bearing to the next point is known).
+Appending new points and setting the bearing of the previous last point are
+O(new points); those writes are versioned and live in shared/flight_update.py.
+load() rebuilds the GeoJSON flight dict the rest of the code uses.
+
+The redis client handed to TrackStore must not use decode_responses, since the
+track values are binary. Flights stored by older consumers as one JSON string
+under the bare <Icao> key are not read; track-store-migrate.py converts them.
+"""
+
+import json
+import math
+import struct
+
+from shared import metrics
+
+coordinate_record = struct.Struct('<ddidd')  # lon, lat, altitude, time, bearing
+bearing_offset = 28  # byte offset of the bearing inside a record
+bearing_field = struct.Struct('<d')
+altitude_none = -2147483648  # int32 sentinel for a missing altitude
+tail_read_records = 64  # records fetched by the first read_tail round trip
+
+
+def pack_coordinates(coordinates):
+    """Packs [lon, lat, alt, time(, bearing)] coordinates into fixed-width records."""
+    packed = bytearray()
+    for c in coordinates:
+        altitude = altitude_none if c[2] is None else int(round(c[2]))
+        bearing = c[4] if len(c) > 4 and c[4] is not None else float('nan')  # math.nan needs Python 3.5
+        packed += coordinate_record.pack(c[0], c[1], altitude, c[3], bearing)
+    return bytes(packed)
+
+
+def unpack_coordinates(packed):
+    """Unpacks records into coordinate lists, leaving off the bearing where none is stored."""
+    coordinates = []
+    for longitude, latitude, altitude, unix_time, bearing in coordinate_record.iter_unpack(packed):
+        coordinate = [longitude, latitude, None if altitude == altitude_none else altitude, unix_time]
+        if not math.isnan(bearing):
+            coordinate.append(bearing)
+        coordinates.append(coordinate)
+    return coordinates
+
+
+def encode_fields(flight_fields):
+    """JSON-encodes each flight field for storage in the metadata hash."""
+    return {key: json.dumps(value) for key, value in flight_fields.items()}
+
+
+def decode_fields(stored_fields):
+    """Decodes a metadata hash read back from redis."""
+    return {key.decode() if isinstance(key, bytes) else key: json.loads(value) for key, value in stored_fields.items()}
+
+
+class TrackStore(object):
+    """Reads flights stored as a packed track plus a metadata hash; writes go through shared/flight_update.py."""
+
+    def __init__(self, r):
+        self.r = r
+
+    @staticmethod
+    def track_key(icao):
+        return 'track:' + icao
+
+    @staticmethod
+    def meta_key(icao):
+        return 'flight:' + icao
+
+    def load_head(self, icao):
+        """Returns (fields, last coordinate, record count) in one round trip; fields is None if not tracked."""
+        return self.load_heads([icao])[0]
+
+    def load_heads(self, icao_list):
+        """Returns load_head results for several flights in one round trip."""
+        pipe = self.r.pipeline()
+        for icao in icao_list:
+            pipe.hgetall(self.meta_key(icao))
+            pipe.getrange(self.track_key(icao), -coordinate_record.size, -1)
+            pipe.strlen(self.track_key(icao))
+        with metrics.timer('redis_seconds', op='load_heads'):
+            replies = pipe.execute()
+        heads = []
+        for stored_fields, last_record, track_length in zip(replies[0::3], replies[1::3], replies[2::3]):
+            if not stored_fields:
+                heads.append((None, None, 0))
+                continue
+            last_coordinate = unpack_coordinates(last_record)[0] if last_record else None
+            heads.append((decode_fields(stored_fields), last_coordinate, track_length // coordinate_record.size))
+        return heads
+
+    def read_tail(self, icao, seconds):
+        """Returns the trailing coordinates covering at least the given number of seconds (or the whole track)."""
+        record_count = tail_read_records
+        while True:
+            with metrics.timer('redis_seconds', op='read_tail'):
+                packed = self.r.getrange(self.track_key(icao), -record_count * coordinate_record.size, -1)
+            coordinates = unpack_coordinates(packed)
+            if len(coordinates) < record_count or coordinates[-1][3] - coordinates[0][3] >= seconds:
+                return coordinates
+            record_count *= 2
+
+    def load(self, icao):
+        """Rebuilds the full GeoJSON flight dict, or returns None if the flight is not tracked."""
+        return self.load_many([icao])[0]
+
+    def load_many(self, icao_list):
+        """Rebuilds flight dicts for several flights in one round trip."""
+        pipe = self.r.pipeline()
+        for icao in icao_list:
+            pipe.hgetall(self.meta_key(icao))
+            pipe.get(self.track_key(icao))
+        with metrics.timer('redis_seconds', op='load_many'):
+            replies = pipe.execute()
+        flights = []
+        for stored_fields, packed in zip(replies[0::2], replies[1::2]):
+            if not stored_fields:
+                flights.append(None)
+                continue
+            flight_dict = decode_fields(stored_fields)
+            flight_dict['geometry'] = {'type': 'LineString', 'coordinates': unpack_coordinates(packed or b'')}
+            flights.append(flight_dict)
+        return flights
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hot/cold tiering of flight tracks between redis and mongo.
+
+Only the recent end of a track stays hot in redis. Once a flight holds more than
+hot_max_points records, or its hot records span more than hot_max_seconds,
+spill_due() copies the older records to the flighthistory_segments collection
+as the flight's next numbered segment and drops them from the track with a
+versioned spill commit (see shared/flight_update.py). A spill leaves the newest
+hot_keep_seconds, at most hot_keep_points records of them, but never less than
+hot_min_seconds, since landing checks read the recent track back from redis.
+Turn scoring needs only the last point and LastTurnPoint, so it is unaffected.
+
+The flight fields carry the tiering state: SegmentKey names the flight's
+segments (its Icao and the time of its first point), SpilledSegments and
+SpilledPoints count what is in mongo, and HotSince is the time of the oldest
+record still in redis. A segment is upserted by SegmentKey and number before
+the spill commit, so a spill that loses a race to a merge is retried later and
+overwrites its own segment.
+
+stitch_many() puts the segments back in front of the hot coordinates, for
+publication and for the final archive; segments never change once committed,
+so recently read ones are cached. discard() deletes a flight's segments once it
+has been archived. A flight handed to a FlightWriter is only forget()ten when
+it leaves redis; the writer calls delete_segments() once the archive is in
+mongo, so a failed insert keeps the old end of the track. A TTL index removes
+any segments left behind.
+"""
+
+from collections import OrderedDict
+import datetime
+import logging
+
+from bson.binary import Binary
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from shared import metrics
+from shared.flight_update import version_of
+from shared.track_store import pack_coordinates, unpack_coordinates
+
+logger = logging.getLogger()
+
+hot_max_points = 2000  # records a flight may hold in redis before it is spilled
+hot_max_seconds = 7200  # span of the records in redis before a flight is spilled
+hot_keep_points = 500  # at most this many records are left in redis by a spill
+hot_keep_seconds = 1800  # the newest records a spill leaves, within hot_keep_points
+hot_min_seconds = 600  # never spilled; at least the consumer's landing_check_window
+segment_collection = 'flighthistory_segments'
+segment_ttl = 3 * 86400  # seconds before mongo removes segments of flights that were never archived
+segment_cache_size = 2000  # segments kept in memory for publishing
+
+
+def ensure_segment_indexes(collection):
+    collection.create_index([('SegmentKey', ASCENDING)])
+    collection.create_index([('SpilledAt', ASCENDING)], expireAfterSeconds=segment_ttl)
+
+
+def spill_count(times):
+    """Number of the oldest records of a track (by time, oldest first) to spill."""
+    last = times[-1]
+    spilled = max(next(n for n, t in enumerate(times) if t >= last - hot_keep_seconds), len(times) - hot_keep_points)
+    return min(spilled, next(n for n, t in enumerate(times) if t >= last - hot_min_seconds))
+
+
+class TrackTiers(object):
+    """Spills the old end of long tracks to a mongo segment collection and stitches it back on."""
+
+    def __init__(self, collection, cache_size=segment_cache_size):
+        self.collection = collection
+        self.cache_size = cache_size
+        self.segments = OrderedDict()  # (SegmentKey, number) -> coordinates
+
+    @staticmethod
+    def due(fields, record_count):
+        """Whether a flight head has grown past the hot limits."""
+        if record_count > hot_max_points:
+            return True
+        hot_since, last_seen = fields.get('HotSince'), fields.get('LastSeen')
+        return hot_since is not None and last_seen is not None and last_seen - hot_since > hot_max_seconds
+
+    def spill_due(self, updater, icao_list):
+        """Spills the flights of icao_list that are past the hot limits; returns how many were spilled."""
+        due = [icao for icao, (fields, last_coordinate, record_count) in zip(icao_list, updater.load_heads(icao_list))
+               if fields is not None and self.due(fields, record_count)]
+        if len(due) == 0:
+            return 0
+        spilled = 0
+        with metrics.timer('spill_seconds'):
+            for flight_dict in updater.load_many(list(OrderedDict.fromkeys(due))):
+                if flight_dict is not None and self.spill(updater, flight_dict):
+                    spilled += 1
+        return spilled
+
+    def spill(self, updater, flight_dict):
+        """Writes the flight's next segment and drops it from redis; returns False if nothing was spilled."""
+        icao = flight_dict['Icao']
+        coordinates = flight_dict['geometry']['coordinates']
+        if len(coordinates) < 2:
+            return False
+        count = spill_count([coordinate[3] for coordinate in coordinates])
+        if count <= 0:
+            return False
+        key = flight_dict.get('SegmentKey') or '{0}_{1}'.format(icao, int(coordinates[0][3]))
+        number = flight_dict.get('SpilledSegments', 0)
+        segment = {'_id': '{0}_{1}'.format(key, number), 'SegmentKey': key, 'Icao': icao, 'Segment': number,
+                   'StartTime': coordinates[0][3], 'EndTime': coordinates[count - 1][3], 'Count': count,
+                   'Track': Binary(pack_coordinates(coordinates[:count])), 'SpilledAt': datetime.datetime.utcnow()}
+        try:
+            self.collection.replace_one({'_id': segment['_id']}, segment, upsert=True)
+        except PyMongoError as e:
+            logger.error("Spilling {0} records of {1} failed: {2}".format(count, icao, e))
+            return False
+        updates = {'SegmentKey': key, 'SpilledSegments': number + 1, 'SpilledPoints': flight_dict.get('SpilledPoints', 0) + count,
+                   'HotSince': coordinates[count][3]}
+        if not updater.spill(icao, version_of(flight_dict), count, updates):
+            return False  # merged meanwhile; the segment is written again on the next try
+        metrics.increment('track_spills_total')
+        metrics.increment('track_spilled_points_total', count)
+        return True
+
+    def _remember(self, segment_id, coordinates):
+        self.segments[segment_id] = coordinates
+        self.segments.move_to_end(segment_id)
+        while len(self.segments) > self.cache_size:
+            self.segments.popitem(last=False)
+
+    def stitch_many(self, flights):
+        """Puts the spilled segments back in front of the coordinates of loaded flight dicts (None entries are skipped)."""
+        spilled = [flight_dict for flight_dict in flights if flight_dict is not None and flight_dict.get('SpilledSegments', 0) > 0]
+        wanted = [(flight_dict['SegmentKey'], number) for flight_dict in spilled for number in range(flight_dict['SpilledSegments'])]
+        missing = set(segment_id for segment_id in wanted if segment_id not in self.segments)
+        if len(missing) > 0:
+            with metrics.timer('mongo_read_seconds', op='segments'):
+                for segment in self.collection.find({'SegmentKey': {'$in': sorted(set(key for key, number in missing))}}):
+                    segment_id = (segment['SegmentKey'], segment['Segment'])
+                    if segment_id in missing:
+                        self._remember(segment_id, unpack_coordinates(bytes(segment['Track'])))
+        for flight_dict in spilled:
+            coordinates = []
+            for number in range(flight_dict['SpilledSegments']):
+                segment_id = (flight_dict['SegmentKey'], number)
+                if segment_id not in self.segments:
+                    logger.error("Segment {0} of {1} is missing".format(number, flight_dict['Icao']))
+                    metrics.increment('track_segments_missing_total')
+                    continue
+                self.segments.move_to_end(segment_id)
+                coordinates.extend(list(coordinate) for coordinate in self.segments[segment_id])
+            coordinates.extend(flight_dict['geometry']['coordinates'])
+            flight_dict['geometry']['coordinates'] = coordinates
+        return flights
+
+    def forget(self, flights):
+        """Drops the cached segments of flights that left redis."""
+        keys = set(flight_dict['SegmentKey'] for flight_dict in flights if flight_dict.get('SegmentKey'))
+        for segment_id in [segment_id for segment_id in self.segments if segment_id[0] in keys]:
+            del self.segments[segment_id]
+
+    def delete_segments(self, flights):
+        """Deletes the segments of archived flights from mongo; leaves the cache alone, so a FlightWriter thread may call it."""
+        keys = [flight_dict['SegmentKey'] for flight_dict in flights if flight_dict.get('SegmentKey')]
+        if len(keys) == 0:
+            return
+        try:
+            self.collection.delete_many({'SegmentKey': {'$in': keys}})
+        except PyMongoError as e:
+            logger.error("Deleting the segments of {0} flights failed, leaving them to expire: {1}".format(len(keys), e))
+
+    def discard(self, flights):
+        """Deletes the segments of archived flights."""
+        self.forget(flights)
+        self.delete_segments(flights)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array decoding of VRS Cos trails.
+
+A Cos trail (trFmt 'sa') is a flat list repeating latitude, longitude, time
+(unix ms) and altitude. TrailBatch decodes the trails of many aircraft at once:
+they are joined into one N x 4 float64 array, points outside the valid lon/lat
+range are masked out, and the rest are reordered into records laid out exactly
+like the coordinate records of shared/track_store.py (lon, lat, altitude,
+unix seconds, no bearing), so a snippet frame packs a trail with tobytes()
+instead of a struct call per point. The cost per aircraft is a few slices,
+which is what makes batching worth it on feeds with hundreds of thousands of
+points per poll.
+
+coordinates() builds GeoJSON coordinate lists from the original Cos list with
+slices, keeping each value's JSON type (an integral longitude stays an int, a
+null altitude stays None), so snippets serialize exactly as the per-point loop
+made them.
+"""
+
+from itertools import compress
+
+import numpy as np
+
+from shared.track_store import altitude_none, coordinate_record
+
+point_record = np.dtype([('lon', '<f8'), ('lat', '<f8'), ('alt', '<i4'), ('time', '<f8'), ('bearing', '<f8')])
+assert point_record.itemsize == coordinate_record.size
+
+
+class TrailBatch(object):
+    """The decoded Cos trails of a list of aircraft, by position in the list. A trailing partial point is ignored."""
+
+    def __init__(self, trails):
+        self.trails = trails
+        counts = [len(cos) // 4 for cos in trails]
+        flat = []
+        for cos, count in zip(trails, counts):
+            flat.extend(cos if len(cos) == 4 * count else cos[:4 * count])
+        trail = np.array(flat, dtype=float).reshape(-1, 4)  # null altitudes become NaN
+        self.valid = (np.abs(trail[:, 1]) <= 180) & (np.abs(trail[:, 0]) <= 90)
+        kept = trail[self.valid]
+        self.records = np.empty(len(kept), dtype=point_record)
+        self.records['lon'] = kept[:, 1]
+        self.records['lat'] = kept[:, 0]
+        missing = np.isnan(kept[:, 3])
+        self.records['alt'] = np.where(missing, altitude_none, np.rint(np.where(missing, 0, kept[:, 3])))
+        self.records['time'] = kept[:, 2] / 1000
+        self.records['bearing'] = np.nan
+        self.raw_bounds = [0] + np.cumsum(counts, dtype=np.int64).tolist()  # points of trail n in the joined array
+        self.bounds = np.concatenate(([0], np.cumsum(self.valid, dtype=np.int64)))[self.raw_bounds].tolist()  # and of its valid points
+
+    def __len__(self):
+        return len(self.trails)
+
+    def points(self, n):
+        """The valid points of trail n as coordinate records."""
+        return self.records[self.bounds[n]:self.bounds[n + 1]]
+
+    def last_time(self, n):
+        """Unix seconds of the last valid point of trail n, which must have one."""
+        return float(self.records['time'][self.bounds[n + 1] - 1])
+
+    def coordinates(self, n):
+        """GeoJSON [lon, lat, altitude, unix seconds] lists of the valid points of trail n, with the original value types."""
+        cos = self.trails[n]
+        start, end = self.raw_bounds[n], self.raw_bounds[n + 1]
+        length = 4 * (end - start)
+        longitudes, latitudes, altitudes = cos[1:length:4], cos[0:length:4], cos[3:length:4]
+        if self.bounds[n + 1] - self.bounds[n] != end - start:
+            mask = self.valid[start:end].tolist()
+            longitudes, latitudes, altitudes = list(compress(longitudes, mask)), list(compress(latitudes, mask)), list(compress(altitudes, mask))
+        times = self.records['time'][self.bounds[n]:self.bounds[n + 1]].tolist()
+        return list(map(list, zip(longitudes, latitudes, altitudes, times)))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixed-cadence polling of several Virtual Radar Server sources at once.
+
+A VrsSource is one VRS instance, optionally limited to a bounding box with the
+VRS fSBnd/fWBnd/fNBnd/fEBnd filters, with its own pooled HTTP session and delta
+polling state (lastDv and the last known fields of each aircraft). VrsPoller
+runs on an asyncio loop and wakes on a fixed wall-clock grid: poll n is due at
+start + n * interval however long poll n - 1 took. Every source is read
+concurrently on a thread pool (the streaming parser is synchronous) and its
+aircraft are handed to the handler the converter passes in, batch_size at a
+time and on the loop's thread, while the response is still arriving. A source
+may only parse queued_batches ahead of the handler, so memory stays flat
+however large the responses are. Aircraft another source may also report
+(inside, or within overlap_margin of, that source's box) are held back until
+every source has been read and merged with merge_sources(); with one source,
+or sources whose boxes do not overlap, nothing is held. finish is called once
+the poll is complete. Ticks that pass while a poll overruns are skipped rather
+than run late, and so are polls while the backpressure check says the
+consumers are too far behind. While it sleeps until the next tick or waits for
+a slow source, the poller calls idle every idle_interval seconds, which the
+converter uses to service its RabbitMQ connection's heartbeats.
+
+The poller needs Python 3.5 or later (async def); converter.py only imports it
+with use_async_poller = 1.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+import time
+
+import requests
+
+from shared import metrics
+from shared.vrs_stream import iter_aircraft_list, merge_aircraft_delta, merge_sources
+
+logger = logging.getLogger()
+
+request_timeout = 30  # seconds to connect and between received chunks
+stream_chunk_size = 65536  # bytes read from a response at a time
+batch_size = 200  # aircraft handed to the handler at a time
+queued_batches = 4  # batches a source may parse ahead of the handler
+overlap_margin = 0.5  # degrees around another source's box in which an aircraft may be reported by both
+idle_interval = 5.0  # seconds between idle() calls while the poller waits, for the caller's connection heartbeats
+
+
+class VrsSource(object):
+    """One VRS AircraftList.json endpoint polled for deltas, with full trail refreshes every full_resync_polls."""
+
+    def __init__(self, name, url, credentials, bounds=None, delta_polling=True, full_resync_polls=30, debug_directory=None):
+        self.name = name
+        self.url = url
+        self.bounds = bounds  # (south, west, north, east) in degrees, or None for everything
+        self.delta_polling = delta_polling
+        self.full_resync_polls = full_resync_polls
+        self.debug_directory = debug_directory  # raw responses are saved here for snapshot-replay.py
+        self.session = requests.Session()
+        self.session.auth = (credentials['username'], credentials['password'])
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)  # keep-alive across polls
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.last_dv = None
+        self.polls_since_resync = 0
+        self.delta_state = {}
+
+    def reset(self):
+        """Forgets lastDv and the aircraft state so the next poll fetches full trails."""
+        self.last_dv = None
+        self.polls_since_resync = 0
+        self.delta_state.clear()
+
+    def params(self):
+        if self.delta_polling and self.polls_since_resync >= self.full_resync_polls:
+            self.reset()
+        params = {'trFmt': 'sa'}
+        if self.bounds is not None:
+            params['fSBnd'], params['fWBnd'], params['fNBnd'], params['fEBnd'] = self.bounds
+        if self.delta_polling and self.last_dv is not None:
+            params['ldv'] = self.last_dv  # only send trail points added since the last poll
+        else:
+            params['refreshTrails'] = 1
+        return params
+
+    def chunks(self, response, debug_file):
+        for chunk in response.iter_content(chunk_size=stream_chunk_size):
+            if debug_file is not None:
+                debug_file.write(chunk)
+            yield chunk
+
+    def covers(self, aircraft, margin=0.0):
+        """Whether the aircraft is within margin degrees of the source's box; True without a box or a position."""
+        if self.bounds is None or aircraft.get('Lat') is None or aircraft.get('Long') is None:
+            return True
+        south, west, north, east = self.bounds
+        return south - margin <= aircraft['Lat'] <= north + margin and west - margin <= aircraft['Long'] <= east + margin
+
+    def stream(self, poll_time):
+        """Polls the source once, yielding its aircraft with delta responses filled in as they are parsed.
+
+        A failed poll raises ValueError or a RequestException, and the next poll is a full resync.
+        """
+        debug_file = None
+        header = {}
+        try:
+            with metrics.timer('vrs_fetch_seconds', source=self.name):
+                response = self.session.put(self.url, params=self.params(), stream=True, timeout=request_timeout)
+            try:
+                if not response.ok:
+                    raise requests.exceptions.HTTPError("status code {0}".format(response.status_code))
+                if self.debug_directory is not None:
+                    debug_file = open(os.path.join(self.debug_directory, 'vrssnapshot_{0}.{1}.json'.format(poll_time, self.name)), 'wb')
+                yield from merge_aircraft_delta(iter_aircraft_list(self.chunks(response, debug_file), header), self.delta_state)
+            finally:
+                response.close()
+                if debug_file is not None:
+                    debug_file.close()
+        except (ValueError, requests.exceptions.RequestException):
+            self.reset()
+            metrics.increment('vrs_polls_total', source=self.name, result='error')
+            raise
+        self.last_dv = header.get('lastDv')  # this is a timestamp used by the server to identify updates
+        self.polls_since_resync += 1
+        metrics.increment('vrs_polls_total', source=self.name, result='ok')
+
+
+class VrsPoller(object):
+    """Polls sources concurrently on a fixed cadence, handing their aircraft to handle(aircraft_batch, poll_time) as they
+    arrive and calling finish(poll_time) once every source has been read."""
+
+    def __init__(self, sources, handle, interval=60, backpressure=None, finish=None, batch_size=batch_size, idle=None):
+        self.sources = sources
+        self.handle = handle
+        self.interval = interval
+        self.backpressure = backpressure  # returns True while polls should be skipped
+        self.finish = finish
+        self.batch_size = batch_size
+        self.idle = idle  # called on the loop's thread every idle_interval seconds while waiting
+        self.pool = ThreadPoolExecutor(max_workers=max(len(sources), 1))
+
+    def shared(self, source, aircraft):
+        """Whether another source may report the aircraft too, so it has to be merged before it is handled."""
+        return any(other is not source and other.covers(aircraft, overlap_margin) for other in self.sources)
+
+    def read(self, source, poll_time, loop, batches):
+        """Reads one source on a pool thread, passing batches to the loop; returns the aircraft held back for merging,
+        or None if the poll failed."""
+        def put(item):
+            asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()  # waits while the handler is behind
+        held = []
+        batch = []
+        try:
+            with metrics.timer('vrs_parse_seconds', source=source.name):  # includes the download, which is streamed
+                for aircraft in source.stream(poll_time):
+                    if self.shared(source, aircraft):
+                        held.append(aircraft)
+                        continue
+                    batch.append(aircraft)
+                    if len(batch) >= self.batch_size:
+                        put(batch)
+                        batch = []
+        except (ValueError, requests.exceptions.RequestException) as e:
+            logger.error("Polling {0} failed, next poll is a full resync: {1}".format(source.url, e))
+            held = None
+        finally:
+            if len(batch) > 0:
+                put(batch)
+            put(None)  # this source is done
+        return held
+
+    async def wait(self, awaitable):
+        """Awaits, calling idle() every idle_interval seconds meanwhile."""
+        if self.idle is None:
+            return await awaitable
+        future = asyncio.ensure_future(awaitable)
+        while True:
+            done, pending = await asyncio.wait([future], timeout=idle_interval)
+            if len(done) > 0:
+                return future.result()
+            self.idle()
+
+    async def poll(self, poll_time):
+        """Reads every source, handling aircraft as they arrive; returns False if no source answered."""
+        loop = asyncio.get_event_loop()
+        batches = asyncio.Queue(queued_batches * len(self.sources))
+        readers = [loop.run_in_executor(self.pool, self.read, source, poll_time, loop, batches) for source in self.sources]
+        reading = len(readers)
+        try:
+            while reading > 0:
+                batch = await self.wait(batches.get())
+                if batch is None:
+                    reading -= 1
+                else:
+                    self.handle(batch, poll_time)
+        finally:
+            while reading > 0:  # if the handler failed, let the readers finish rather than block on a full queue
+                if await batches.get() is None:
+                    reading -= 1
+        held = [aircraft_list for aircraft_list in await asyncio.gather(*readers) if aircraft_list is not None]
+        if len(held) == 0:
+            return False
+        aircraft_list, duplicates = merge_sources(held)
+        metrics.increment('duplicate_aircraft_total', duplicates)
+        for start in range(0, len(aircraft_list), self.batch_size):
+            self.handle(aircraft_list[start:start + self.batch_size], poll_time)
+        if self.finish is not None:
+            self.finish(poll_time)
+        return True
+
+    async def run(self, polls=None, start=None):
+        """Polls on the interval grid from start (default now), forever or for the given number of ticks."""
+        start = time.time() if start is None else start
+        tick = 0
+        while polls is None or tick < polls:
+            due = start + tick * self.interval
+            await self.wait(asyncio.sleep(max(due - time.time(), 0)))
+            if self.backpressure is not None and self.backpressure():
+                logger.error("Consumers are behind, skipping the poll due at {0}".format(round(due)))
+                metrics.increment('vrs_polls_skipped_total', reason='backpressure')
+            else:
+                with metrics.timer('vrs_poll_seconds'):
+                    await self.poll(round(due))
+                metrics.write()
+            next_tick = max(math.floor((time.time() - start) / self.interval) + 1, tick + 1)
+            if next_tick > tick + 1:
+                logger.error("Poll due at {0} overran, skipping {1} polls".format(round(due), next_tick - tick - 1))
+                metrics.increment('vrs_polls_skipped_total', next_tick - tick - 1, reason='overrun')
+            tick = next_tick
+
+    def run_forever(self):
+        asyncio.get_event_loop().run_until_complete(self.run())
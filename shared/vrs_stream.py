@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental parser for Virtual Radar Server AircraftList.json responses.
+
+iter_aircraft_list() takes the response body as an iterable of byte chunks and
+yields each entry of acList as soon as it has fully arrived, so aircraft can be
+processed while the rest of the body is still downloading and only one aircraft
+(plus whatever chunk is in flight) is held in memory. Every other top-level key
+(lastDv, totalAc, stm...) is collected into the header dict passed in.
+
+merge_aircraft_delta() fills in the fields a delta response (polled with ldv)
+leaves out, from the state kept for that server, and merge_sources() merges
+the aircraft several servers sent for one poll.
+"""
+
+import codecs
+import json
+import re
+
+whitespace = re.compile(r'[\s,]*')
+decoder = json.JSONDecoder()
+
+
+class IncompleteResponse(ValueError):
+    """Raised when the body ends before the top-level object is closed."""
+
+
+class _ChunkBuffer(object):
+    """Text buffer over byte chunks that parses JSON values without splitting them."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, at_least):
+        """Appends chunks until at_least more characters are buffered or the body ends."""
+        self.text = self.text[self.pos:]
+        self.pos = 0
+        wanted = len(self.text) + at_least
+        pieces = [self.text]
+        length = len(self.text)
+        while length < wanted:
+            try:
+                piece = self.utf8.decode(next(self.chunks))
+            except StopIteration:
+                piece = self.utf8.decode(b'', final=True)
+                self.eof = True
+            pieces.append(piece)
+            length += len(piece)
+            if self.eof:
+                break
+        self.text = ''.join(pieces)
+
+    def skip(self):
+        """Skips whitespace and commas, returning the next significant character ('' at the end of the body)."""
+        while True:
+            self.pos = whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.eof:
+                return ''
+            self._read(1)
+
+    def expect(self, character):
+        if self.skip() != character:
+            raise ValueError("Expected '{0}' in aircraft list at character {1}".format(character, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next JSON value, reading more of the body until it is complete."""
+        self.skip()
+        pending = 1
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise IncompleteResponse("Aircraft list ended inside a value")
+            # grow the buffer geometrically so large trails are not re-parsed for every chunk
+            pending = max(pending, len(self.text) - self.pos)
+            self._read(pending)
+
+
+def iter_aircraft_list(chunks, header):
+    """Yields acList entries from a VRS response body, storing the other top-level keys in header."""
+    buffer = _ChunkBuffer(chunks)
+    buffer.expect('{')
+    while True:
+        character = buffer.skip()
+        if character == '}':
+            return
+        if character == '':
+            raise IncompleteResponse("Aircraft list ended before the closing brace")
+        key = buffer.value()
+        buffer.expect(':')
+        if key != 'acList':
+            header[key] = buffer.value()
+            continue
+        buffer.expect('[')
+        while True:
+            character = buffer.skip()
+            if character == ']':
+                buffer.pos += 1
+                break
+            if character == '':
+                raise IncompleteResponse("Aircraft list ended inside acList")
+            yield buffer.value()
+
+
+def merge_aircraft_delta(aircraft_list, delta_state):
+    """Fills in fields left out of a delta response from the last known state of each aircraft, by VRS Id."""
+    seen_ids = set()
+    for item in aircraft_list:
+        aircraft = dict(delta_state.get(item['Id'], {}))
+        aircraft.update(item)
+        trail = aircraft.pop('Cos', None)
+        delta_state[item['Id']] = aircraft
+        seen_ids.add(item['Id'])
+        if trail is not None:
+            aircraft = dict(aircraft)
+            aircraft['Cos'] = trail  # only the trail points since lastDv when polling deltas
+        yield aircraft
+    # every tracked aircraft is listed (if only by Id), so anything missing has dropped off the server
+    for aircraft_id in list(delta_state):
+        if aircraft_id not in seen_ids:
+            del delta_state[aircraft_id]
+
+
+def trail_end(aircraft):
+    """Time (unix ms) of the newest trail point of an aircraft, or -1 without one."""
+    trail = aircraft.get('Cos')
+    return trail[-2] if trail else -1  # points are latitude, longitude, time, altitude
+
+
+def merge_trails(trails):
+    """The union of several Cos trails, one point per time, oldest first; of points at the same time the first wins."""
+    points = {}
+    for trail in trails:
+        for n in range(0, len(trail) - 3, 4):
+            points.setdefault(trail[n + 2], trail[n:n + 4])
+    return [value for point_time in sorted(points) for value in points[point_time]]
+
+
+def merge_sources(aircraft_lists):
+    """Merges the aircraft lists of several sources; returns (one aircraft per Icao, duplicates dropped).
+
+    The fields of an aircraft come from the copy whose trail reaches furthest, then the one with the longer trail.
+    With delta polling each source sends only the points since its own lastDv, so the trail is the union of every
+    copy's points by time.
+    """
+    copies = {}
+    duplicates = 0
+    for aircraft_list in aircraft_lists:
+        for aircraft in aircraft_list:
+            icao = aircraft.get('Icao')
+            if icao is None:
+                continue
+            if icao in copies:
+                duplicates += 1
+            copies.setdefault(icao, []).append(aircraft)
+    merged = []
+    for aircraft_copies in copies.values():
+        if len(aircraft_copies) == 1:
+            merged.append(aircraft_copies[0])
+            continue
+        aircraft_copies.sort(key=lambda aircraft: (trail_end(aircraft), len(aircraft.get('Cos') or ())), reverse=True)
+        aircraft = aircraft_copies[0]
+        trails = [item['Cos'] for item in aircraft_copies if item.get('Cos')]
+        if len(trails) > 1:
+            aircraft = dict(aircraft)
+            aircraft['Cos'] = merge_trails(trails)
+        merged.append(aircraft)
+    return merged, duplicates
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched frame format for flight snippets on the real_time queue.
+
+One frame carries many aircraft snippets:
+
+header   4s magic b'SSWF', B format version, B flags, I snippet count
+body     per snippet: I metadata length, compact JSON of the snippet without
+         its geometry, I point count, then packed coordinate records
+         (see shared/track_store.py); zlib-compressed when flags & 1
+
+Legacy single-snippet JSON messages and the {'FileTime': ...} marker stay plain
+JSON; is_frame() tells the two apart.
+"""
+
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from shared.track_store import coordinate_record, pack_coordinates, unpack_coordinates
+
+frame_content_type = 'application/x-skyspywatch-frame'
+frame_magic = b'SSWF'
+frame_version = 1
+frame_header = struct.Struct('<4sBBI')
+frame_length = struct.Struct('<I')
+flag_zlib = 1
+zlib_level = 1  # frames are published every poll, so favour speed over ratio
+
+
+def is_frame(body):
+    """Checks whether a queue message body is a batched frame rather than legacy JSON."""
+    return body[:4] == frame_magic
+
+
+def encode_frame(snippets, compress=True):
+    """Packs a list of flight snippet dicts, with coordinate lists or record arrays, into one frame."""
+    body = bytearray()
+    for snippet in snippets:
+        fields = {key: value for key, value in snippet.items() if key != 'geometry'}
+        metadata = json.dumps(fields, separators=(',', ':')).encode()
+        coordinates = snippet['geometry']['coordinates']
+        body += frame_length.pack(len(metadata))
+        body += metadata
+        body += frame_length.pack(len(coordinates))
+        if isinstance(coordinates, np.ndarray):
+            body += coordinates.tobytes()  # already coordinate records, see shared/trail_decode.py
+        else:
+            body += pack_coordinates(coordinates)
+    flags = 0
+    if compress:
+        body = zlib.compress(bytes(body), zlib_level)
+        flags |= flag_zlib
+    return frame_header.pack(frame_magic, frame_version, flags, len(snippets)) + bytes(body)
+
+
+def decode_frame(frame):
+    """Unpacks a frame back into flight snippet dicts with GeoJSON geometry."""
+    magic, version, flags, count = frame_header.unpack_from(frame)
+    if magic != frame_magic or version != frame_version:
+        raise ValueError("Not a version {0} snippet frame".format(frame_version))
+    body = memoryview(frame)[frame_header.size:]
+    if flags & flag_zlib:
+        body = memoryview(zlib.decompress(body))
+    snippets = []
+    offset = 0
+    for _ in range(count):
+        (metadata_length,) = frame_length.unpack_from(body, offset)
+        offset += frame_length.size
+        snippet = json.loads(bytes(body[offset:offset + metadata_length]).decode())
+        offset += metadata_length
+        (point_count,) = frame_length.unpack_from(body, offset)
+        offset += frame_length.size
+        points_end = offset + point_count * coordinate_record.size
+        snippet['geometry'] = {'type': 'LineString', 'coordinates': unpack_coordinates(body[offset:points_end])}
+        offset = points_end
+        snippets.append(snippet)
+    return snippets
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replays archived VRS snapshots through the converter and queue consumer.
+
+Reads the vrssnapshot_<time>[.<source>].json responses converter.py saves with
+write_debug_json_files = 1, oldest first, filling in delta responses from the
+aircraft each source sent before the way the converter does and merging the
+sources of a poll as the async poller does. The snippets of each snapshot
+are split by Icao shard across worker processes, which merge, score and check
+landings with the queue consumer's own functions against in-memory stand-ins
+(shared/standins.py) and sweep stale flights at each snapshot's time, so they
+archive the flights the live pipeline would have. Flights still tracked after
+the last snapshot are swept at the end. Archived flights are bulk-written to a
+mongo database, or to one JSON lines file per worker with --output.
+
+The parsing settings (queue-consumer.py, shared/bearing_engine.py and so on) are
+read from the tree as it is, so re-scoring history means editing them and
+replaying into a fresh database. Web map snapshots are not published.
+
+    python3 snapshot-replay.py /opt/converter-debug --workers 8 --database rt_flights_replay
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import logging
+from logging.config import dictConfig
+import multiprocessing as mp
+import os
+import queue
+import re
+import sys
+import time
+
+from pymongo import MongoClient
+
+from shared.flight_cache import CachedFlightUpdater
+from shared.mongo_writer import compact_document, ensure_indexes
+from shared.sharding import shard_for_icao
+from shared.stale_sweeper import insert_flights, stale_age
+from shared.standins import MemoryMongo, MemoryRedis, MemoryRedisData, load_script, repository
+from shared.track_store import TrackStore
+from shared.track_tiers import TrackTiers, segment_collection
+from shared.vrs_stream import iter_aircraft_list, merge_aircraft_delta, merge_sources
+
+snapshot_pattern = re.compile(r'^vrssnapshot_(\d+)(?:\.([\w-]+))?\.json$')
+read_chunk_size = 65536  # bytes of a snapshot file parsed at a time
+worker_queue_size = 4  # snapshots waiting per worker before the reader blocks
+export_batch_size = 500  # flights per insert_many
+
+logging_config = dict(
+    version=1,
+    formatters={
+        'f': {'format':
+              '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'}
+        },
+    handlers={
+        'h': {'class': 'logging.handlers.RotatingFileHandler',
+              'formatter': 'f',
+              'filename': 'log_snapshot-replay.log',
+              'maxBytes': 4096,
+              'backupCount': 3,
+              'level': logging.DEBUG}
+        },
+    root={
+        'handlers': ['h'],
+        'level': logging.INFO,
+        },
+)
+
+logger = logging.getLogger()
+
+
+def snapshot_files(directory, start=None, end=None):
+    """(file time, [(source, path)...]) of the archived polls in a directory between start and end, oldest first.
+
+    Files saved by the single-source loop have no source name, and come back with source None.
+    """
+    found = defaultdict(list)
+    for filename in os.listdir(directory):
+        match = snapshot_pattern.match(filename)
+        if match is None:
+            continue
+        file_time = int(match.group(1))
+        if (start is None or file_time >= start) and (end is None or file_time <= end):
+            found[file_time].append((match.group(2), os.path.join(directory, filename)))
+    return sorted((file_time, sorted(files, key=lambda source_file: source_file[0] or '')) for file_time, files in found.items())
+
+
+def file_chunks(path):
+    with open(path, 'rb') as snapshot_file:
+        while True:
+            chunk = snapshot_file.read(read_chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_source(path, delta_state):
+    """Aircraft of one archived response, with a delta response filled in from the source's earlier ones."""
+    aircraft_list = merge_aircraft_delta(iter_aircraft_list(file_chunks(path), {}), delta_state)
+    # a replay starting mid-archive begins with a delta, which lists aircraft it has not seen in full by Id only
+    return [aircraft for aircraft in aircraft_list if 'Icao' in aircraft and 'TT' in aircraft]
+
+
+def read_snapshot(converter, files, delta_states):
+    """Returns the snippets converter.py would have queued for the archived responses of one poll."""
+    aircraft_lists = []
+    for source, path in files:
+        try:
+            aircraft_lists.append(read_source(path, delta_states[source]))
+        except ValueError as e:
+            # as after a failed poll, the source's state is dropped and its next full response starts afresh
+            logger.error("Reading {0} failed, skipping it: {1}".format(path, e))
+            delta_states[source].clear()
+    aircraft_list, duplicates = merge_sources(aircraft_lists)
+    return [flight_snippet for flight_id, flight_snippet in converter.flight_snippets(aircraft_list)]
+
+
+def mongo_sink(database, compact=False):
+    """Writes archived flights to the flighthistory collection of a mongo database, in the columnar layout if compact."""
+    dbmongo = MongoClient()[database]
+    ensure_indexes(dbmongo.flighthistory)
+    if compact:
+        return lambda flights: insert_flights(dbmongo, [compact_document(flight_dict) for flight_dict in flights], export_batch_size)
+    return lambda flights: insert_flights(dbmongo, flights, export_batch_size)
+
+
+def json_lines_sink(path):
+    """Appends archived flights to a JSON lines file."""
+    def write(flights):
+        with open(path, 'a') as output_file:
+            for flight_dict in flights:
+                output_file.write(json.dumps(flight_dict) + '\n')
+        return len(flights)
+    return write
+
+
+def export_archived(dbmongo, sink):
+    """Hands the flights archived into the in-memory database to the sink and forgets them; returns how many were written."""
+    archived = dbmongo.flighthistory.documents
+    if len(archived) == 0:
+        return 0
+    written = sink(archived)
+    del archived[:]
+    return written
+
+
+def replay_worker(number, consumer, options, work, results):
+    """Merges the snippets of the shards it is given and sweeps at each snapshot's time, exporting what it archives."""
+    # clients are created after the fork
+    if options.output is not None:
+        sink = json_lines_sink(os.path.join(options.output, 'flights-{0}.jsonl'.format(number)))
+    else:
+        sink = mongo_sink(options.database, consumer.compact_flight_documents == 1)
+    data = MemoryRedisData()
+    r = MemoryRedis(data, decode_responses=True)
+    # MemoryRedis has no Lua, so commits take the WATCH/MULTI path
+    updater = CachedFlightUpdater(TrackStore(MemoryRedis(data)), False, consumer.flight_cache_size,
+                                  consumer.write_batch_size)
+    dbmongo = MemoryMongo()
+    if consumer.use_track_tiers == 1:
+        consumer.track_tiers = TrackTiers(dbmongo[segment_collection])  # long tracks spill as they would live
+    stats = {'snippets': 0, 'archived': 0}
+    file_time = None
+    while True:
+        job = work.get()
+        if job is None:
+            break
+        file_time, flight_snippet_list = job
+        if len(flight_snippet_list) > 0:
+            consumer.flight_merger_bulk(flight_snippet_list, r, updater, dbmongo)
+            stats['snippets'] += len(flight_snippet_list)
+        updater.flush()
+        consumer.clean_stale_flights(file_time, r, updater, dbmongo)
+        stats['archived'] += export_archived(dbmongo, sink)
+    if file_time is not None:
+        consumer.clean_stale_flights(file_time + stale_age + 1, r, updater, dbmongo)  # everything left is stale by now
+        stats['archived'] += export_archived(dbmongo, sink)
+    results.put((number, stats))
+
+
+def hand_off(work, job, worker):
+    """Queues a job for a worker, blocking while its queue is full; raises if the worker died meanwhile."""
+    while True:
+        try:
+            work.put(job, timeout=1)
+            return
+        except queue.Full:
+            if not worker.is_alive():
+                raise RuntimeError("Replay worker {0} exited with code {1}".format(worker.name, worker.exitcode))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('directory', help="directory holding vrssnapshot_<time>.json files")
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help="worker processes; aircraft are split by Icao shard")
+    parser.add_argument('--start', type=int, help="first snapshot time (unix seconds) to replay")
+    parser.add_argument('--end', type=int, help="last snapshot time (unix seconds) to replay")
+    parser.add_argument('--database', default='rt_flights_replay', help="mongo database archived flights are written to")
+    parser.add_argument('--output', help="write archived flights as JSON lines to this directory instead of mongo")
+    parser.add_argument('--airport-index', help="airport index for landing checks (default: queue-consumer.py's)")
+    parser.add_argument('--debug-logging', action='store_true', help="keep the scripts' DEBUG file logging on")
+    options = parser.parse_args()
+    directory = os.path.abspath(options.directory)
+    if options.output is not None:
+        options.output = os.path.abspath(options.output)
+        os.makedirs(options.output, exist_ok=True)
+    os.chdir(repository)  # the scripts read vrscreds.json relative to the working directory
+
+    converter = load_script('converter', 'converter.py')
+    consumer = load_script('queue_consumer', 'queue-consumer.py')
+    converter.build_geofence()  # drops the aircraft the live converter would
+    dictConfig(logging_config)
+    if options.debug_logging:
+        logger.setLevel(logging.DEBUG)
+    if options.airport_index is not None:
+        consumer.airport_index_path = options.airport_index
+    consumer.load_airport_index()  # mapped before the fork so every worker shares it
+    if consumer.airport_index is None:
+        parser.error("no airport index at {0}; build one with airport-index-builder.py".format(consumer.airport_index_path))
+    files = snapshot_files(directory, options.start, options.end)
+    if len(files) == 0:
+        parser.error("no vrssnapshot_<time>.json files in {0}".format(directory))
+
+    context = mp.get_context('fork')
+    results = context.Queue()
+    work_queues = [context.Queue(worker_queue_size) for _ in range(options.workers)]
+    workers = [context.Process(target=replay_worker, args=(n, consumer, options, work_queues[n], results), name='replay-{0}'.format(n))
+               for n in range(options.workers)]
+    for worker in workers:
+        worker.start()
+
+    started = time.time()
+    delta_states = defaultdict(dict)  # source -> last known fields of each aircraft by VRS Id
+    for file_time, poll_files in files:
+        flight_snippet_list = read_snapshot(converter, poll_files, delta_states)
+        partitions = [[] for _ in workers]
+        for flight_snippet in flight_snippet_list:
+            partitions[shard_for_icao(flight_snippet['Icao']) % len(workers)].append(flight_snippet)
+        for work, partition, worker in zip(work_queues, partitions, workers):
+            hand_off(work, (file_time, partition), worker)
+        logger.info("Replayed the poll at {0} ({1} snippets)".format(file_time, len(flight_snippet_list)))
+    for work, worker in zip(work_queues, workers):
+        hand_off(work, None, worker)
+
+    totals = {'snippets': 0, 'archived': 0}
+    failed = False
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            print("{0} failed with exit code {1}".format(worker.name, worker.exitcode))
+            failed = True
+    for _ in range(sum(1 for worker in workers if worker.exitcode == 0)):
+        number, stats = results.get()
+        for key in totals:
+            totals[key] += stats[key]
+    seconds = time.time() - started
+    covered = files[-1][0] - files[0][0]
+    print("Replayed {0} polls ({1} snippets) in {2:.1f}s, {3:.0f}x real time; archived {4} flights".format(
+        len(files), totals['snippets'], seconds, covered / seconds if seconds > 0 else 0.0, totals['archived']))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Archives stale flights from redis to mongo as its own process.
+
+Run this with run_stale_sweep_inline = 0 in queue-consumer.py so the marker
+shard's consumer no longer stalls its queue while a large sweep is in progress.
+"""
+
+import logging
+from logging.config import dictConfig
+import time
+
+from pymongo import MongoClient
+import redis
+
+from shared import metrics
+from shared.airport_index import AirportIndex, georadius_nearest_many
+from shared.flight_update import FlightUpdater
+from shared.mongo_writer import FlightWriter
+from shared.stale_sweeper import sweep_stale_flights
+from shared.track_store import TrackStore
+from shared.track_tiers import TrackTiers, segment_collection
+
+redis_host = 'localhost'
+redis_port = 6379
+sweep_interval = 60  # seconds between sweeps, the converter's polling interval
+use_redis_scripts = 1  # 0 commits with WATCH/MULTI instead of Lua
+airport_index_path = './data/airports.idx'  # built by airport-index-builder.py
+airport_radius = 5000  # metres from an airport that count as landed there
+compact_flight_documents = 0  # keep in step with queue-consumer.py
+use_track_tiers = 1  # keep in step with queue-consumer.py
+metrics_directory = metrics.default_directory  # served by the queue consumer's metrics endpoint
+
+logging_config = dict(
+    version=1,
+    formatters={
+        'f': {'format':
+              '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'}
+        },
+    handlers={
+        'h': {'class': 'logging.handlers.RotatingFileHandler',
+              'formatter': 'f',
+              'filename': 'log_stale-sweeper.log',
+              'maxBytes': 4096,
+              'backupCount': 3,
+              'level': logging.DEBUG}
+        },
+    root={
+        'handlers': ['h'],
+        'level': logging.DEBUG,
+        },
+)
+
+dictConfig(logging_config)
+logger = logging.getLogger()
+
+
+def airport_lookup_for(r):
+    """Returns a batch nearest-airport lookup using the airport index, or the redis airports key without one."""
+    try:
+        airport_index = AirportIndex(airport_index_path)
+        return lambda coordinates: airport_index.nearest_many(coordinates, airport_radius)
+    except (OSError, ValueError) as e:
+        logger.error("No airport index at {0}, using the redis airports key: {1}".format(airport_index_path, e))
+        return lambda coordinates: georadius_nearest_many(r, coordinates, airport_radius)
+
+
+def main():
+    """Sweeps stale flights every sweep_interval seconds."""
+    logger.debug("Process started!")
+    dbmongo = MongoClient().rt_flights_test
+    r = redis.StrictRedis(host=redis_host, port=redis_port, db=0)
+    updater = FlightUpdater(TrackStore(r), use_redis_scripts == 1)
+    airport_lookup = airport_lookup_for(r)
+    tiers = TrackTiers(dbmongo[segment_collection]) if use_track_tiers == 1 else None
+    # segments of a swept flight are deleted once the writer has archived it
+    writer = FlightWriter(dbmongo.flighthistory, compact=compact_flight_documents == 1,
+                          on_written=tiers.delete_segments if tiers is not None else None)
+    metrics.configure('stale-sweeper', metrics_directory)
+    try:
+        while True:
+            started = time.time()
+            with metrics.timer('sweep_seconds'):
+                archived, removed = sweep_stale_flights(round(started), updater, dbmongo, airport_lookup, writer=writer,
+                                                       tiers=tiers)
+            metrics.write()
+            logger.debug("Archived {0} of {1} stale flights in {2:.2f}s".format(archived, removed, time.time() - started))
+            time.sleep(max(sweep_interval - (time.time() - started), 0))
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixtures for the tests, which run the pipeline against the in-process stand-ins
+of shared/standins.py, with no RabbitMQ, Redis, MongoDB or S3:
+
+    python3 -m pytest tests
+"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.flight_cache import CachedFlightUpdater  # noqa: E402
+from shared.standins import MemoryMongo, MemoryRedis, MemoryRedisData, load_script, repository  # noqa: E402
+from shared.track_store import TrackStore  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(monkeypatch, tmp_path):
+    """Runs every test in a temporary directory, with the vrscreds.json the scripts read, so their log files stay out of the repository."""
+    shutil.copy(os.path.join(repository, 'vrscreds.json'), str(tmp_path))
+    monkeypatch.chdir(str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def scripts():
+    """A fresh import of converter.py and queue-consumer.py, which read vrscreds.json from the working directory."""
+    converter = load_script('converter', 'converter.py')
+    consumer = load_script('queue_consumer', 'queue-consumer.py')
+    converter.build_geofence()
+    return converter, consumer
+
+
+@pytest.fixture
+def redis_data():
+    return MemoryRedisData()
+
+
+@pytest.fixture
+def r(redis_data):
+    return MemoryRedis(redis_data, decode_responses=True)
+
+
+@pytest.fixture
+def updater(redis_data):
+    # MemoryRedis has no Lua, so commits take the WATCH/MULTI path
+    return CachedFlightUpdater(TrackStore(MemoryRedis(redis_data)), False)
+
+
+@pytest.fixture
+def dbmongo():
+    return MemoryMongo()
+
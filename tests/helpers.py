@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Flights and tracks for the tests to store and merge."""
+
+
+def flight(icao, coordinates, **fields):
+    """A new flight dict as the consumer stores it."""
+    flight_dict = {'Icao': icao, 'LastSeen': coordinates[-1][3], 'FlightStatus': 'InFlight', 'LandedScan': 0,
+                   'LandedAirportID': None, 'LiveTurns': 0, 'SurveillanceScore': 0, 'LastTurnPoint': coordinates[0],
+                   'TimeWatermark': coordinates[-1][3], 'HotSince': coordinates[0][3],
+                   'geometry': {'type': 'LineString', 'coordinates': coordinates}}
+    flight_dict.update(fields)
+    return flight_dict
+
+
+def straight_track(count, start_time=1500000000.0, seconds=10.0, longitude=-77.0, latitude=38.9, step=0.001, altitude=3000):
+    """count [lon, lat, alt, time] points flown due east."""
+    return [[longitude + n * step, latitude, altitude, start_time + n * seconds] for n in range(count)]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from shared.flight_cache import CachedFlightUpdater
+from shared.flight_update import FlightUpdater, version_of
+from shared.standins import MemoryRedis
+from shared.track_store import TrackStore
+
+from helpers import flight, straight_track
+
+
+def test_load_heads_survives_evicting_its_own_batch(redis_data):
+    writer = FlightUpdater(TrackStore(MemoryRedis(redis_data)), False)
+    icaos = ['A{0}'.format(n) for n in range(5)]
+    for n, icao in enumerate(icaos):
+        assert writer.create(flight(icao, straight_track(n + 2)))
+    updater = CachedFlightUpdater(TrackStore(MemoryRedis(redis_data)), False, capacity=2)
+    heads = updater.load_heads(icaos + ['MISSING', 'A0'])
+    assert [record_count for fields, last_coordinate, record_count in heads] == [2, 3, 4, 5, 6, 0, 2]
+    assert heads[5] == (None, None, 0)
+    assert len(updater.heads) == 2
+
+
+def test_cached_heads_follow_queued_commits(updater):
+    assert updater.create(flight('ABC123', straight_track(3)))
+    fields, last_coordinate, record_count = updater.load_head('ABC123')
+    assert record_count == 3 and updater.pending  # served from the cache, the create not yet written
+    more = straight_track(2, start_time=last_coordinate[3] + 10)
+    assert updater.append('ABC123', version_of(fields), record_count, last_coordinate, more,
+                          {'LastSeen': more[-1][3], 'SurveillanceScore': 5})
+    fields, last_coordinate, record_count = updater.load_head('ABC123')
+    assert record_count == 5 and fields['SurveillanceScore'] == 5 and last_coordinate == more[-1]
+    assert updater.flush() == []
+    assert updater.store.load_head('ABC123')[2] == 5
+
+
+def test_lost_races_come_back_from_flush(updater, redis_data):
+    other = FlightUpdater(TrackStore(MemoryRedis(redis_data)), False)
+    assert other.create(flight('ABC123', straight_track(3)))
+    fields, last_coordinate, record_count = updater.load_head('ABC123')
+    # another worker appends first, so the cached head is out of date
+    assert other.append('ABC123', version_of(fields), record_count, last_coordinate, straight_track(1, start_time=2e9),
+                        {'LastSeen': 2e9, 'SurveillanceScore': 0})
+    tag = object()
+    assert updater.append('ABC123', version_of(fields), record_count, last_coordinate, straight_track(1, start_time=3e9),
+                          {'LastSeen': 3e9, 'SurveillanceScore': 0}, tag)
+    assert updater.flush() == [tag]
+    assert 'ABC123' not in updater.heads
+    assert updater.load_head('ABC123')[0]['LastSeen'] == 2e9
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from shared import scoring
+from shared.flight_update import FlightUpdater, version_of
+from shared.track_store import TrackStore
+
+from helpers import flight, straight_track
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')  # fakeredis runs Lua scripts with lupa
+
+
+def run_commits(use_scripts):
+    """Creates, appends to, spills and deletes a flight, racing a second writer; returns (results, final redis state)."""
+    server = fakeredis.FakeServer()
+    updater = FlightUpdater(TrackStore(fakeredis.FakeStrictRedis(server=server)), use_scripts)
+    other = FlightUpdater(TrackStore(fakeredis.FakeStrictRedis(server=server)), use_scripts)
+    r = updater.store.r
+    results = []
+    states = []
+
+    def state():
+        """Every key, leaving out the random Version tokens."""
+        dump = {}
+        for key in sorted(r.keys()):
+            kind = r.type(key)
+            if kind == b'string':
+                dump[key] = r.get(key)
+            elif kind == b'hash':
+                dump[key] = {field: value for field, value in r.hgetall(key).items() if field != b'Version'}
+            else:
+                dump[key] = r.zrange(key, 0, -1, withscores=True)
+        return dump
+
+    coordinates = straight_track(30)
+    results.append(updater.create(flight('ABC123', coordinates)))
+    results.append(other.create(flight('ABC123', straight_track(3))))  # already tracked
+    states.append(state())
+
+    fields, last_coordinate, record_count = updater.load_head('ABC123')
+    more = straight_track(5, start_time=coordinates[-1][3] + 10, longitude=coordinates[-1][0] + 0.001)
+    last_coordinate = last_coordinate[0:4] + [90.0]  # the bearing now known for the old last point
+    window_scores, scored_at = scoring.apply_turn_events(None, None, [(more[-1][3], 40)])
+    results.append(updater.append('ABC123', version_of(fields), record_count, last_coordinate, more,
+                                  {'LastSeen': more[-1][3], 'SurveillanceScore': 40, 'LiveTurns': 1,
+                                   'WindowScores': window_scores, 'ScoredAt': scored_at}))
+    results.append(other.append('ABC123', version_of(fields), record_count, last_coordinate, more,
+                                {'LastSeen': more[-1][3], 'SurveillanceScore': 0}))  # read before the first append
+    states.append(state())
+    loaded = updater.load('ABC123')
+    assert loaded['geometry']['coordinates'][record_count - 1][4] == 90.0
+    assert [point[0:4] for point in loaded['geometry']['coordinates'][record_count:]] == more
+
+    fields = updater.load_head('ABC123')[0]
+    results.append(updater.spill('ABC123', version_of(fields), 20, {'SpilledSegments': 1, 'SpilledPoints': 20,
+                                                                    'HotSince': coordinates[20][3]}))
+    results.append(other.spill('ABC123', version_of(fields), 20, {'SpilledSegments': 1}))  # stale
+    states.append(state())
+    loaded = updater.load('ABC123')
+    assert [point[0:4] for point in loaded['geometry']['coordinates']] == coordinates[20:] + more
+
+    results.append(other.delete('ABC123', version_of(fields)))  # stale
+    results.append(updater.delete_many([('ABC123', version_of(updater.load_head('ABC123')[0])), ('MISSING', 'stale')]))
+    states.append(state())
+    return results, states
+
+
+def test_lua_commits_apply_only_at_the_expected_version():
+    results, states = run_commits(True)
+    assert results == [True, False, True, False, True, False, False, [True, False]]
+    assert states[1][b'surveillance_rank'] and states[-1] == {}
+
+
+def test_lua_and_watched_commits_leave_the_same_state():
+    assert run_commits(True) == run_commits(False)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from shared.geofence import Geofence, box_contains, polygon_contains
+from shared.trail_decode import TrailBatch
+
+regions = [
+    {'name': 'box', 'bounds': (38.5, -77.6, 39.4, -76.5)},
+    {'name': 'antimeridian', 'bounds': (50.0, 170.0, 60.0, -170.0)},
+    {'name': 'triangle', 'polygon': [[-100.0, 30.0], [-90.0, 30.0], [-95.0, 37.3]]},
+    {'name': 'notch', 'polygon': [[10.0, 45.0], [14.0, 45.0], [14.0, 49.0], [12.0, 46.5], [10.0, 49.0]]},
+]
+
+
+def brute_force(longitudes, latitudes):
+    inside = np.zeros(len(longitudes), dtype=bool)
+    for region in regions:
+        if 'polygon' in region:
+            inside |= polygon_contains(np.array(region['polygon'], dtype=float), longitudes, latitudes)
+        else:
+            inside |= box_contains(region['bounds'], longitudes, latitudes)
+    return inside
+
+
+def sample_points(rng, count):
+    """Points spread over the world, and as many again close to the regions, where the boundary cells are."""
+    longitudes = [rng.uniform(-180, 180, count)]
+    latitudes = [rng.uniform(-90, 90, count)]
+    for region in regions:
+        if 'polygon' in region:
+            polygon = np.array(region['polygon'])
+            west, south, east, north = polygon[:, 0].min(), polygon[:, 1].min(), polygon[:, 0].max(), polygon[:, 1].max()
+        else:
+            south, west, north, east = region['bounds']
+            east = east + 360 if east < west else east
+        longitudes.append((rng.uniform(west - 1, east + 1, count) + 180) % 360 - 180)
+        latitudes.append(rng.uniform(south - 1, north + 1, count))
+    return np.concatenate(longitudes), np.concatenate(latitudes)
+
+
+@pytest.mark.parametrize('cell_size', [0.25, 1.0, 0.1])
+def test_grid_matches_brute_force(cell_size):
+    geofence = Geofence(regions, cell_size)
+    longitudes, latitudes = sample_points(np.random.RandomState(3), 20000)
+    assert np.array_equal(geofence.contains(longitudes, latitudes), brute_force(longitudes, latitudes))
+
+
+def test_grid_matches_brute_force_on_region_edges():
+    geofence = Geofence(regions)
+    longitudes = np.array([-77.6, -76.5, -77.0, -77.0, 170.0, -170.0, 180.0, -180.0, -95.0, -100.0, 12.0, 12.0, 14.0])
+    latitudes = np.array([38.5, 39.4, 38.5, 39.4, 55.0, 55.0, 50.0, 60.0, 30.0, 30.0, 46.5, 46.4, 49.0])
+    assert np.array_equal(geofence.contains(longitudes, latitudes), brute_force(longitudes, latitudes))
+
+
+def test_keep_matches_a_point_by_point_check():
+    rng = np.random.RandomState(5)
+    geofence = Geofence(regions, min_altitude=1000, max_altitude=25000, excluded_callsigns=('AAL',), excluded_types=('B738',))
+    batch = []
+    for n in range(300):
+        points = rng.randint(1, 6)
+        # trails around the first box; 'Cos' is lat, lon, time in ms, altitude
+        cos = []
+        for m in range(points):
+            cos.extend([rng.uniform(38.0, 40.0), rng.uniform(-78.0, -76.0), 1500000000000 + m * 5000,
+                        None if rng.rand() < 0.1 else int(rng.uniform(0, 40000))])
+        batch.append({'Icao': '{0:06X}'.format(n), 'Call': str(rng.choice(['AAL12', 'N123', ''])), 'Type': str(rng.choice(['B738', 'C172'])),
+                      'Cos': cos})
+    trails = TrailBatch([item['Cos'] for item in batch])
+    keep = geofence.keep(batch, trails)
+    for n, item in enumerate(batch):
+        expected = False
+        for longitude, latitude, altitude, unix_time in trails.coordinates(n):
+            in_band = altitude is None or 1000 <= altitude <= 25000  # points without an altitude count
+            if in_band and brute_force(np.array([longitude]), np.array([latitude]))[0]:
+                expected = True
+        expected = expected and not item['Call'].startswith('AAL') and item['Type'] != 'B738'
+        assert keep[n] == expected, item
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+
+from pymongo.errors import ServerSelectionTimeoutError
+import pytest
+import requests
+
+from shared import history_query
+from shared.history_query import HistoryCache, HistoryQuery, parse_query
+from shared.mongo_writer import compact_document
+from shared.standins import MemoryMongo, load_script
+
+
+def random_flights(count, seed=4):
+    rng = random.Random(seed)
+    flights = []
+    for n in range(count):
+        longitude, latitude = rng.uniform(-80, -70), rng.uniform(35, 45)
+        heading_longitude, heading_latitude = rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2)
+        last_seen = 1500000000 + rng.randint(0, 40) * 60  # many flights share a LastSeen
+        coordinates = [[longitude + heading_longitude * m, latitude + heading_latitude * m, 3000, last_seen - (5 - m) * 60]
+                       for m in range(6)]
+        flights.append({'Icao': '{0:06X}'.format(n), 'LastSeen': last_seen, 'SurveillanceScore': rng.randint(0, 30),
+                        'FlightStatus': 'Landed', 'geometry': {'type': 'LineString', 'coordinates': coordinates}})
+    return flights
+
+
+def crosses(flight_dict, bounds, steps=200):
+    """Whether a flight's track passes through a (south, west, north, east) box, by sampling its segments."""
+    south, west, north, east = bounds
+    coordinates = flight_dict['geometry']['coordinates']
+    for a, b in zip(coordinates, coordinates[1:]):
+        for step in range(steps + 1):
+            longitude = a[0] + (b[0] - a[0]) * step / steps
+            latitude = a[1] + (b[1] - a[1]) * step / steps
+            if south <= latitude <= north and west <= longitude <= east:
+                return True
+    return False
+
+
+@pytest.fixture
+def flights():
+    return random_flights(400)
+
+
+@pytest.fixture
+def cache(flights, monkeypatch):
+    monkeypatch.setattr(history_query, 'window_size', 7)  # many windows for a few hundred flights
+    collection = MemoryMongo().flighthistory
+    collection.insert_many([compact_document(flight_dict) if n % 2 else flight_dict for n, flight_dict in enumerate(flights)])
+    return HistoryCache(collection)
+
+
+def walk(cache, query, limit):
+    """Every page of a query, following the page tokens."""
+    found, token, pages = [], '', 0
+    while token is not None:
+        page, token = cache.page(query, token, limit)
+        assert len(page) <= limit
+        found.extend(page)
+        pages += 1
+    return found, pages
+
+
+@pytest.mark.parametrize('limit', [1, 5, 7, 100])
+def test_pages_reach_every_matching_flight(flights, cache, limit):
+    query = HistoryQuery((38.03, -77.51, 41.97, -73.02), 1500000000 + 300, 1500000000 + 2100, None, 12)
+    found, pages = walk(cache, query, limit)
+    expected = sorted((flight_dict for flight_dict in flights if crosses(flight_dict, query.bounds)
+                       and query.start <= flight_dict['LastSeen'] <= query.end and flight_dict['SurveillanceScore'] >= 12),
+                      key=lambda flight_dict: (flight_dict['LastSeen'], flight_dict['Icao']), reverse=True)
+    assert len(expected) > 2 * history_query.window_size  # past the first windows
+    assert [flight_dict['Icao'] for flight_dict in found] == [flight_dict['Icao'] for flight_dict in expected]
+    assert found[0]['geometry']['coordinates'] == expected[0]['geometry']['coordinates']
+    assert pages - -(-len(expected) // limit) in (0, 1)  # the last page may come back empty
+
+
+def test_flights_in_the_widened_box_only_are_left_out():
+    collection = MemoryMongo().flighthistory
+    just_outside = {'Icao': 'OUT', 'LastSeen': 1, 'SurveillanceScore': 0,
+                    'geometry': {'type': 'LineString', 'coordinates': [[-77.04, 38.0, 0, 0], [-77.04, 39.0, 0, 1]]}}
+    crossing = {'Icao': 'IN', 'LastSeen': 2, 'SurveillanceScore': 0,
+                'geometry': {'type': 'LineString', 'coordinates': [[-77.04, 38.5, 0, 0], [-76.9, 38.5, 0, 2]]}}
+    collection.insert_many([just_outside, crossing])
+    query = HistoryQuery((38.0, -77.02, 39.0, -76.0))
+    assert query.quantized().bounds[1] == -77.1  # both flights are in the box sent to mongo
+    page, token = HistoryCache(collection).page(query)
+    assert [flight_dict['Icao'] for flight_dict in page] == ['IN'] and token is None
+
+
+def test_pages_are_served_from_cached_windows(cache):
+    query = HistoryQuery(None, None, None, None, 20)
+    first, pages = walk(cache, query, 10)
+    misses = cache.stats()['misses']
+    again, pages = walk(cache, query, 10)
+    assert again == first
+    assert cache.stats()['misses'] == misses and cache.stats()['hits'] >= misses
+
+
+def test_page_tokens_and_bad_parameters():
+    query, token, limit, output_format = parse_query({'bbox': '38,-78,40,-76', 'page': '[[1500000000.0,"ABC123"],4]',
+                                                      'limit': '5000', 'format': 'frame'})
+    assert query.bounds == (38.0, -78.0, 40.0, -76.0)
+    assert history_query.parse_page_token(token) == ((1500000000.0, 'ABC123'), 4)
+    assert limit == history_query.max_page_size and output_format == 'frame'
+    for parameters in [{'page': 'not a token'}, {'page': '[1]'}, {'bbox': '1,2'}, {'limit': '0'}, {'format': 'xml'}]:
+        with pytest.raises(ValueError):
+            parse_query(parameters)
+
+
+class Unreachable(object):
+    """A flighthistory collection whose server cannot be reached."""
+
+    def find(self, *args, **kwargs):
+        raise ServerSelectionTimeoutError('no servers found')
+
+
+@pytest.mark.parametrize('collection, status', [(Unreachable(), 503), (MemoryMongo().flighthistory, 200)])
+def test_server_answers_503_while_mongo_is_down(collection, status):
+    history_server = load_script('history_server', 'history-server.py')
+    server = history_server.HistoryServer(HistoryCache(collection), 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{0}/flights'.format(server.server_port)
+        assert requests.get(url, params={'bbox': '38,-78,40,-76'}, timeout=10).status_code == status
+        assert requests.get(url, params={'limit': '0'}, timeout=10).status_code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import random
+
+from shared.landing import LandingDetector, RollingTrack, landed_speed, slow_track
+from shared.synthetic_vrs import SyntheticSky
+
+
+def random_track(rng, count):
+    """A track that speeds up, slows down and stops, with uneven gaps between points."""
+    longitude, latitude, unix_time = rng.uniform(-120, -70), rng.uniform(25, 50), 1500000000.0
+    speed = rng.choice([0.0, landed_speed / 2, landed_speed * 0.9, landed_speed * 1.1, 80.0])
+    track = []
+    for _ in range(count):
+        if rng.random() < 0.05:
+            speed = rng.choice([0.0, landed_speed / 2, landed_speed * 0.9, landed_speed * 1.1, 80.0])
+        seconds = rng.choice([1, 5, 10, 30, 60, 90])
+        unix_time += seconds
+        latitude += math.degrees(speed * seconds / 6371008.8)
+        track.append([longitude, latitude, 1000, unix_time])
+    return track
+
+
+def test_rolling_track_matches_slow_track():
+    rng = random.Random(11)
+    checks = slow = 0
+    for _ in range(200):
+        track = random_track(rng, rng.randint(2, 120))
+        rolling = RollingTrack()
+        seen = 0
+        while seen < len(track):
+            chunk = rng.randint(1, 8)
+            # snippets overlap what was already merged; those points are ignored
+            rolling.add(track[max(seen - rng.randint(0, 3), 0):seen + chunk])
+            seen = min(seen + chunk, len(track))
+            assert rolling.is_slow() == slow_track(track[:seen])
+            assert rolling.last() == track[seen - 1]
+            checks += 1
+            slow += rolling.is_slow()
+    assert 0 < slow < checks
+
+
+def test_detector_matches_slow_track_on_synthetic_landings():
+    sky = SyntheticSky(200, 60, surveillance_fraction=0.1, landing_fraction=0.5, seed=3)
+    detector = LandingDetector()
+    tracks = {}
+    slow = 0
+    for _ in range(30):
+        sky.advance(60)
+        for aircraft in sky.aircraft:
+            points = [[point[1], point[0], point[3], point[2] / 1000] for point in aircraft.trail]
+            track = tracks.setdefault(aircraft.icao, [])
+            new_points = [point for point in points if len(track) == 0 or point[3] > track[-1][3]]
+            track.extend(new_points)
+            is_slow = detector.update(aircraft.icao, new_points).is_slow()
+            assert is_slow == slow_track(track)
+            slow += is_slow
+    assert slow > 0
+
+
+def test_detector_seeds_a_new_track_and_forgets_landed_ones():
+    detector = LandingDetector(capacity=2)
+    parked = [[-77.0, 38.9, 25, 1500000000.0 + n * 30] for n in range(12)]
+    assert detector.update('A', parked[-1:], lambda: parked[:-1]).is_slow()
+    detector.update('B', parked)
+    detector.update('C', parked)
+    assert 'A' not in detector.tracks  # least recently updated
+    detector.forget('B')
+    assert list(detector.tracks) == ['C']
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+from shared import metrics
+
+
+def test_updates_from_several_threads_are_not_lost_while_snapshots_run():
+    before = metrics.counters.get(('threaded_total', ()), 0)
+    stop = threading.Event()
+    snapshots = []
+
+    def snapshot_until_stopped():
+        while not stop.is_set():
+            snapshots.append(metrics.snapshot())  # raises if a label set is added during the copy
+
+    def record(worker):
+        for n in range(20000):
+            metrics.increment('threaded_total')
+            metrics.increment('threaded_labelled_total', worker=worker, n=n % 50)  # new label sets while snapshots run
+            metrics.observe('threaded_seconds', 0.001, worker=worker)
+
+    reader = threading.Thread(target=snapshot_until_stopped)
+    reader.start()
+    workers = [threading.Thread(target=record, args=(str(worker),)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stop.set()
+    reader.join()
+    assert len(snapshots) > 0
+    assert metrics.counters[('threaded_total', ())] - before == 80000
+    assert all(sum(metrics.histograms[('threaded_seconds', (('worker', str(worker)),))][:-1]) == 20000 for worker in range(4))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from shared.mongo_writer import FlightWriter, expand_document
+from shared.standins import MemoryMongo
+
+from helpers import flight, straight_track
+
+
+class FailingOnce(object):
+    """A collection whose first insert_many raises an error that is not a PyMongoError."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.calls += 1
+        if self.calls == 1:
+            raise TypeError('cannot encode object')
+        return self.collection.insert_many(documents, ordered=ordered)
+
+
+def test_writer_outlives_a_batch_it_cannot_write():
+    collection = MemoryMongo().flighthistory
+    writer = FlightWriter(FailingOnce(collection), batch_size=2, max_age=0.05)
+    writer.write_many([flight('A', straight_track(3)), flight('B', straight_track(3))])
+    assert writer.flush(5) and writer.failed == 2 and writer.written == 0
+    writer.write(flight('C', straight_track(3)))
+    assert writer.flush(5) and writer.written == 1
+    assert [flight_dict['Icao'] for flight_dict in collection.find({})] == ['C']
+    writer.close(5)
+    assert not writer.thread.is_alive()
+
+
+def test_writer_outlives_a_flight_it_cannot_compact():
+    collection = MemoryMongo().flighthistory
+    writer = FlightWriter(collection, batch_size=10, max_age=0.05, compact=True)
+    writer.write({'Icao': 'BROKEN'})  # no geometry
+    writer.write(flight('A', straight_track(3)))
+    assert writer.flush(5) and writer.failed == 1 and writer.written == 1
+    assert expand_document(list(collection.find({'Icao': 'A'}))[0])['geometry']['coordinates'] == straight_track(3)
+    writer.close(5)
+
+
+def test_flush_gives_up_once_the_thread_is_gone():
+    writer = FlightWriter(MemoryMongo().flighthistory, max_age=0.05)
+    writer.close(5)
+    started = time.time()
+    assert not writer.flush(30)
+    writer.write(flight('A', straight_track(3)))  # dropped rather than blocking
+    assert time.time() - started < 5
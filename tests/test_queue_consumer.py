@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from shared import metrics
+from shared.flight_update import FlightUpdater, version_of
+from shared.heatmap import TurnHeatmap
+from shared.standins import MemoryRedis
+from shared.track_store import TrackStore
+
+from helpers import flight, straight_track
+
+
+def counter(name):
+    return metrics.counters.get((name, ()), 0)
+
+
+def snippet(icao, coordinates):
+    return {'Icao': icao, 'LastSeen': coordinates[-1][3], 'geometry': {'type': 'LineString', 'coordinates': coordinates}}
+
+
+def box_track(start_time, legs=6, points=5, step=0.01):
+    """A track flown east, north, west and south in turn, so every leg starts with a turn."""
+    headings = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+    longitude, latitude, unix_time = -77.0, 38.9, start_time
+    track = []
+    for leg in range(legs):
+        east, north = headings[leg % 4]
+        for _ in range(points):
+            longitude += east * step
+            latitude += north * step
+            unix_time += 10
+            track.append([longitude, latitude, 3000, unix_time])
+    return track
+
+
+def bump_version(redis_data, icao):
+    """Another worker updates the flight without changing its track or counts."""
+    other = FlightUpdater(TrackStore(MemoryRedis(redis_data)), False)
+    fields, last_coordinate, record_count = other.load_head(icao)
+    assert other.append(icao, version_of(fields), record_count, last_coordinate, [],
+                        {'LastSeen': fields['LastSeen'], 'SurveillanceScore': fields['SurveillanceScore']})
+
+
+def merge_turning_snippet(consumer, r, updater, dbmongo, redis_data, conflict):
+    """turns_total, heatmap turns and merge conflicts counted for a snippet full of turns."""
+    consumer.turn_heatmap = TurnHeatmap()
+    first = straight_track(5)
+    assert consumer.flight_merger_bulk([snippet('ABC123', first)], r, updater, dbmongo) == 0
+    if conflict:
+        bump_version(redis_data, 'ABC123')  # the cached head is now out of date
+    turns, conflicts = counter('turns_total'), counter('merge_conflicts_total')
+    assert consumer.flight_merger_bulk([snippet('ABC123', box_track(first[-1][3]))], r, updater, dbmongo) == 0
+    return counter('turns_total') - turns, sum(consumer.turn_heatmap.pending.values()), counter('merge_conflicts_total') - conflicts
+
+
+def test_turns_of_a_merge_that_lost_a_race_are_counted_once(scripts, r, updater, dbmongo, redis_data):
+    converter, consumer = scripts
+    turns, heatmap_turns, conflicts = merge_turning_snippet(consumer, r, updater, dbmongo, redis_data, False)
+    assert conflicts == 0 and turns > 0 and heatmap_turns > 0
+    updater.store.r.flushall()
+    updater.heads.clear()
+    assert merge_turning_snippet(consumer, r, updater, dbmongo, redis_data, True) == (turns, heatmap_turns, 1)
+    assert updater.load_head('ABC123')[0]['LiveTurns'] == turns
+
+
+def test_landing_that_lost_a_race_is_counted_once(scripts, r, updater, dbmongo, redis_data, monkeypatch):
+    converter, consumer = scripts
+    monkeypatch.setattr(consumer, 'find_landings', lambda flight_snippet_list, updater, r: {'ABC123': 7})
+    coordinates = straight_track(5)
+    assert updater.create(flight('ABC123', coordinates, LandedScan=consumer.landing_check_scans - 1))
+    assert updater.flush() == []
+    assert updater.load_head('ABC123')[0] is not None  # cached
+    bump_version(redis_data, 'ABC123')
+    landings, conflicts = counter('landings_total'), counter('merge_conflicts_total')
+    more = straight_track(3, start_time=coordinates[-1][3] + 10, longitude=coordinates[-1][0] + 0.001)
+    assert consumer.flight_merger_bulk([snippet('ABC123', more)], r, updater, dbmongo) == 0
+    assert counter('landings_total') - landings == 1 and counter('merge_conflicts_total') - conflicts == 1
+    archived = list(dbmongo.flighthistory.find({}))
+    assert len(archived) == 1 and archived[0]['FlightStatus'] == 'Landed' and archived[0]['LandedAirportID'] == 7
+    assert updater.load_head('ABC123')[0] is None
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from shared.flight_update import FlightUpdater, version_of
+from shared.stale_sweeper import sweep_stale_flights
+from shared.standins import MemoryRedis
+from shared.track_store import TrackStore
+
+from helpers import flight, straight_track
+
+
+def test_flights_updated_during_a_sweep_are_skipped_without_losing_the_rest(updater, redis_data, dbmongo):
+    icaos = ['{0:06X}'.format(n) for n in range(23)]
+    for n, icao in enumerate(icaos):
+        assert updater.create(flight(icao, straight_track(5, start_time=1500000000.0 + n)))
+    assert updater.flush() == []
+    # a consumer updates these between the sweep's read and its delete; they are still stale, but now sort last
+    busy = set(icaos[::4])
+    other = FlightUpdater(TrackStore(MemoryRedis(redis_data)), False)
+    delete_many = updater.delete_many
+
+    def delete_after_an_update(deletes):
+        for icao, expected_version in deletes:
+            if icao in busy:
+                fields, last_coordinate, record_count = other.load_head(icao)
+                assert other.append(icao, version_of(fields), record_count, last_coordinate, [],
+                                    {'LastSeen': fields['LastSeen'] + 1000, 'SurveillanceScore': 0})
+        return delete_many(deletes)
+
+    updater.delete_many = delete_after_an_update
+    lookups = []
+    archived, removed = sweep_stale_flights(1600000000.0, updater, dbmongo, lambda points: lookups.extend(points) or [9] * len(points),
+                                            chunk_size=3, batch_size=2)
+    assert (archived, removed) == (len(icaos) - len(busy), len(icaos) - len(busy))
+    assert sorted(flight_dict['Icao'] for flight_dict in dbmongo.flighthistory.find({})) == sorted(set(icaos) - busy)
+    assert all(flight_dict['FlightStatus'] == 'Landed' for flight_dict in dbmongo.flighthistory.find({}))
+    assert len(lookups) == archived
+    assert sorted(updater.store.r.zrange('flight_scan_times', 0, -1)) == sorted(icao.encode() for icao in busy)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+from shared.flight_update import FlightUpdater
+from shared.standins import MemoryRedis, load_script
+from shared.track_store import TrackStore, pack_coordinates, unpack_coordinates
+
+from helpers import flight, straight_track
+
+
+def test_records_round_trip_with_and_without_bearings():
+    coordinates = straight_track(3)
+    coordinates[0].append(90.0)
+    coordinates[1][2] = None
+    assert unpack_coordinates(pack_coordinates(coordinates)) == coordinates
+
+
+def test_old_flights_are_moved_to_the_packed_layout(redis_data):
+    migrate = load_script('track_store_migrate', 'track-store-migrate.py')
+    updater = FlightUpdater(TrackStore(MemoryRedis(redis_data)), False)
+    r = updater.store.r
+    old = flight('ABC123', [point + [90.0] for point in straight_track(4)], LiveTurns=2, SurveillanceScore=30)
+    del old['TimeWatermark'], old['HotSince']  # older consumers did not keep these
+    r.set('ABC123', json.dumps(old))
+    r.zadd('flight_scan_times', old['LastSeen'], 'ABC123')
+    r.zadd('surveillance_score', 30, 'ABC123')
+    assert updater.create(flight('DEF456', straight_track(2)))  # already stored in the new layout
+    r.set('DEF456', json.dumps(flight('DEF456', straight_track(5))))
+    r.zadd('flight_scan_times', 1, 'NOTAFLIGHT')
+    assert migrate.migrate(updater, chunk_size=2) == (1, 1)
+    assert not r.exists('ABC123') and r.exists('DEF456')
+    moved = updater.load('ABC123')
+    assert moved['geometry']['coordinates'] == old['geometry']['coordinates']
+    assert moved['LiveTurns'] == 2 and moved['TimeWatermark'] == old['LastSeen'] and moved['HotSince'] == 1500000000.0
+    assert r.zrange('surveillance_score', 0, -1, withscores=True) == [(b'DEF456', 0.0), (b'ABC123', 30.0)]
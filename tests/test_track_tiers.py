@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pymongo.errors import AutoReconnect
+
+from shared.flight_update import version_of
+from shared.mongo_writer import FlightWriter
+from shared.track_tiers import TrackTiers, hot_max_points, hot_min_seconds, segment_collection
+
+from helpers import flight, straight_track
+
+
+def stored(updater, icao):
+    return updater.load_many([icao])[0]
+
+
+def test_spill_then_stitch_gives_back_the_track(updater, dbmongo):
+    tiers = TrackTiers(dbmongo[segment_collection])
+    coordinates = straight_track(hot_max_points + 700)
+    assert updater.create(flight('ABC123', coordinates))
+    updater.flush()
+    assert tiers.spill_due(updater, ['ABC123']) == 1
+    hot = stored(updater, 'ABC123')
+    assert 0 < len(hot['geometry']['coordinates']) < len(coordinates)
+    assert hot['geometry']['coordinates'][-1][3] - hot['geometry']['coordinates'][0][3] >= hot_min_seconds
+    assert hot['SpilledSegments'] == 1 and hot['SpilledPoints'] + len(hot['geometry']['coordinates']) == len(coordinates)
+    assert hot['HotSince'] == hot['geometry']['coordinates'][0][3]
+    assert tiers.stitch_many([hot])[0]['geometry']['coordinates'] == coordinates
+
+    # a second spill, after more points arrive, adds the next segment; a fresh TrackTiers reads both from mongo
+    head, last_coordinate, record_count = updater.load_head('ABC123')
+    more = straight_track(hot_max_points, start_time=coordinates[-1][3] + 10, longitude=coordinates[-1][0] + 0.001)
+    assert updater.append('ABC123', version_of(head), record_count, last_coordinate, more,
+                          {'LastSeen': more[-1][3], 'SurveillanceScore': 0})
+    updater.flush()
+    assert tiers.spill_due(updater, ['ABC123']) == 1
+    hot = stored(updater, 'ABC123')
+    assert hot['SpilledSegments'] == 2
+    assert TrackTiers(dbmongo[segment_collection]).stitch_many([hot])[0]['geometry']['coordinates'] == coordinates + more
+
+    tiers.discard([hot])
+    assert dbmongo[segment_collection].count() == 0
+
+
+def test_spill_that_loses_a_race_keeps_the_track(updater, dbmongo):
+    tiers = TrackTiers(dbmongo[segment_collection])
+    coordinates = straight_track(hot_max_points + 10)
+    assert updater.create(flight('ABC123', coordinates))
+    updater.flush()
+    loaded = stored(updater, 'ABC123')
+    head, last_coordinate, record_count = updater.load_head('ABC123')
+    assert updater.append('ABC123', version_of(head), record_count, last_coordinate, [],
+                          {'LastSeen': coordinates[-1][3], 'SurveillanceScore': 0, 'LandedScan': 1})
+    updater.flush()
+    assert not tiers.spill(updater, loaded)  # read before the append, so its version is stale
+    assert stored(updater, 'ABC123')['geometry']['coordinates'] == coordinates
+    assert 'SpilledSegments' not in stored(updater, 'ABC123')
+
+
+def test_short_tracks_are_not_spilled(updater, dbmongo):
+    tiers = TrackTiers(dbmongo[segment_collection])
+    assert updater.create(flight('ABC123', straight_track(50)))
+    updater.flush()
+    assert tiers.spill_due(updater, ['ABC123']) == 0
+    assert dbmongo[segment_collection].count() == 0
+
+
+class Unreachable(object):
+    """A flighthistory collection whose first insert_many fails the way mongo does."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.calls += 1
+        if self.calls == 1:
+            raise AutoReconnect('connection closed')
+        return self.collection.insert_many(documents, ordered=ordered)
+
+
+def test_segments_outlive_an_archive_that_failed(updater, dbmongo):
+    tiers = TrackTiers(dbmongo[segment_collection])
+    writer = FlightWriter(Unreachable(dbmongo.flighthistory), batch_size=1, max_age=0.05, on_written=tiers.delete_segments)
+    coordinates = straight_track(hot_max_points + 700)
+    assert updater.create(flight('ABC123', coordinates))
+    updater.flush()
+    assert tiers.spill_due(updater, ['ABC123']) == 1
+    landed = tiers.stitch_many([stored(updater, 'ABC123')])[0]
+    tiers.forget([landed])
+    writer.write(landed)
+    assert writer.flush(5) and writer.failed == 1
+    assert dbmongo[segment_collection].count() == 1
+    writer.write(landed)
+    assert writer.flush(5) and writer.written == 1
+    assert dbmongo[segment_collection].count() == 0
+    writer.close(5)
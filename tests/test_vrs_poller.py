@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from shared.synthetic_vrs import SyntheticSky, SyntheticVrsServer
+from shared import vrs_poller
+from shared.vrs_poller import VrsPoller, VrsSource
+from shared.vrs_stream import merge_sources, merge_trails
+
+credentials = {'username': 'test', 'password': 'test'}
+
+
+def points(trail):
+    return [trail[n:n + 4] for n in range(0, len(trail), 4)]
+
+
+@pytest.fixture
+def server():
+    server = SyntheticVrsServer(SyntheticSky(150, 10, seed=2))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_merge_sources_takes_the_union_of_the_trails():
+    older = {'Icao': 'ABC123', 'Alt': 1000, 'Cos': [38.0, -77.0, 1000, 900, 38.1, -77.0, 2000, 950, 38.2, -77.0, 3000, 1000]}
+    newer = {'Icao': 'ABC123', 'Alt': 1200, 'Cos': [38.1, -77.0, 2000, 950, 38.3, -77.0, 4000, 1100]}
+    other = {'Icao': 'DEF456', 'Alt': 5000, 'Cos': [40.0, -70.0, 1000, 5000]}
+    merged, duplicates = merge_sources([[older, other], [newer]])
+    assert duplicates == 1
+    merged = {aircraft['Icao']: aircraft for aircraft in merged}
+    assert merged['ABC123']['Alt'] == 1200  # fields of the copy whose trail reaches furthest
+    assert points(merged['ABC123']['Cos']) == [[38.0, -77.0, 1000, 900], [38.1, -77.0, 2000, 950], [38.2, -77.0, 3000, 1000],
+                                               [38.3, -77.0, 4000, 1100]]
+    assert merged['DEF456'] is other
+    assert len(newer['Cos']) == 8  # the copies are left alone
+
+
+def test_merge_trails_keeps_one_point_per_time_oldest_first():
+    assert merge_trails([[1, 2, 30, 4], [5, 6, 10, 8, 9, 9, 30, 9], []]) == [5, 6, 10, 8, 1, 2, 30, 4]
+
+
+def test_delta_polls_add_up_to_the_full_trails(server):
+    source = VrsSource('synthetic', server.url, credentials)
+    kept = {}  # Icao -> {time: point} from every poll
+    for poll in range(5):
+        for aircraft in source.stream(poll):
+            for point in points(aircraft.get('Cos', [])):
+                kept.setdefault(aircraft['Icao'], {})[point[2]] = point
+        with server.lock:
+            server.sky.advance(20)
+    assert 'ldv' not in server.requests[0] and server.requests[0]['refreshTrails'] == '1'
+    assert all('ldv' in query for query in server.requests[1:])
+    with server.lock:
+        full = server.sky.aircraft_list()
+    for aircraft in full['acList']:
+        seen = kept.get(aircraft['Icao'])
+        if seen is None:
+            continue  # appeared after the last poll
+        for point in points(aircraft['Cos']):
+            if point[2] <= max(seen):
+                assert seen.get(point[2]) == point
+
+
+def run_polls(sources, polls, **options):
+    """The Icaos handed over by each poll, and the batch sizes, for polls run back to back."""
+    handled = [[]]  # aircraft batches of each poll
+    poller = VrsPoller(sources, lambda aircraft_batch, poll_time: handled[-1].append(aircraft_batch), 0.2,
+                       finish=lambda poll_time: handled.append([]), **options)
+    asyncio.run(poller.run(polls=polls))
+    assert handled[-1] == []  # every poll finished
+    return ([sorted(aircraft['Icao'] for aircraft_batch in batches for aircraft in aircraft_batch) for batches in handled[:-1]],
+            [[len(aircraft_batch) for aircraft_batch in batches] for batches in handled[:-1]])
+
+
+def test_bounded_sources_merge_to_the_whole_box(server):
+    west = VrsSource('west', server.url, credentials, bounds=(25.0, -124.0, 49.0, -90.0))
+    east = VrsSource('east', server.url, credentials, bounds=(25.0, -100.0, 49.0, -67.0))
+    (icaos,), sizes = run_polls([west, east], 1)
+    with server.lock:
+        whole = server.sky.aircraft_list(bounds=(25.0, -124.0, 49.0, -67.0))
+        overlap = server.sky.aircraft_list(bounds=(25.0, -100.0, 49.0, -90.0))
+    assert icaos == sorted(aircraft['Icao'] for aircraft in whole['acList'])  # each aircraft once
+    assert len(overlap['acList']) > 0
+    assert {server.requests[0]['fWBnd'], server.requests[1]['fWBnd']} == {'-124.0', '-100.0'}
+
+
+def test_one_source_is_handed_over_in_batches(server):
+    polls, sizes = run_polls([VrsSource('a', server.url, credentials)], 3, batch_size=20)
+    with server.lock:
+        icaos = sorted(aircraft['Icao'] for aircraft in server.sky.aircraft_list()['acList'])
+    assert polls == [icaos] * 3
+    assert all(max(poll_sizes) == 20 and len(poll_sizes) == -(-len(icaos) // 20) for poll_sizes in sizes)
+    assert len(server.requests) == 3
+
+
+def test_overlapping_sources_are_merged_each_poll(server):
+    polls, sizes = run_polls([VrsSource('a', server.url, credentials), VrsSource('b', server.url, credentials)], 3)
+    with server.lock:
+        icaos = sorted(aircraft['Icao'] for aircraft in server.sky.aircraft_list()['acList'])
+    assert polls == [icaos] * 3
+    assert len(server.requests) == 6
+
+
+def test_a_failing_handler_does_not_leave_readers_blocked(server):
+    def handle(aircraft_batch, poll_time):
+        raise RuntimeError('handler failed')
+    poller = VrsPoller([VrsSource('a', server.url, credentials)], handle, batch_size=1)
+    with pytest.raises(RuntimeError):
+        asyncio.run(poller.poll(0))
+    poller.pool.shutdown(wait=True)  # returns once the reader has read to the end
+
+
+def test_idle_is_called_while_waiting_for_the_next_tick(server, monkeypatch):
+    monkeypatch.setattr(vrs_poller, 'idle_interval', 0.05)
+    idled = []
+    poller = VrsPoller([VrsSource('a', server.url, credentials)], lambda aircraft_batch, poll_time: None, 0.5,
+                       idle=lambda: idled.append(True))
+    asyncio.run(poller.run(polls=2))
+    assert len(idled) >= 5
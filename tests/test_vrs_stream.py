@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from shared.synthetic_vrs import SyntheticSky
+from shared.vrs_stream import IncompleteResponse, iter_aircraft_list, merge_aircraft_delta
+
+
+def test_streamed_response_parses_like_json():
+    body = json.dumps(SyntheticSky(150, 10, seed=2).aircraft_list()).encode()
+    header = {}
+    chunks = [body[n:n + 97] for n in range(0, len(body), 97)]
+    assert list(iter_aircraft_list(iter(chunks), header)) == json.loads(body.decode())['acList']
+    assert header['lastDv'] == json.loads(body.decode())['lastDv']
+
+
+def test_truncated_response_raises():
+    body = json.dumps(SyntheticSky(20, 10, seed=2).aircraft_list()).encode()
+    with pytest.raises(IncompleteResponse):
+        list(iter_aircraft_list(iter([body[:len(body) // 2]]), {}))
+
+
+def test_delta_responses_are_filled_in_from_the_last_full_one():
+    delta_state = {}
+    full = [{'Id': 1, 'Icao': 'ABC123', 'Alt': 1000, 'Call': 'TEST1', 'Cos': [38.0, -77.0, 1000, 900]},
+            {'Id': 2, 'Icao': 'DEF456', 'Alt': 5000, 'Cos': [40.0, -70.0, 1000, 5000]}]
+    assert list(merge_aircraft_delta(full, delta_state)) == full
+    delta = [{'Id': 1, 'Alt': 1200, 'Cos': [38.1, -77.0, 2000, 1100]}]
+    assert list(merge_aircraft_delta(delta, delta_state)) == [
+        {'Id': 1, 'Icao': 'ABC123', 'Alt': 1200, 'Call': 'TEST1', 'Cos': [38.1, -77.0, 2000, 1100]}]
+    assert sorted(delta_state) == [1]  # DEF456 was not listed, so it dropped off the server
+    assert 'Cos' not in delta_state[1]  # trails are only the points since the last poll
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+import pika
+import pytest
+
+from shared.airport_index import AirportIndex, build_index
+from shared.flight_cache import CachedFlightUpdater
+from shared.stale_sweeper import stale_age
+from shared.standins import MemoryChannel, MemoryMongo, MemoryRedis, MemoryRedisData, load_script
+from shared.synthetic_vrs import SyntheticSky
+from shared.track_store import TrackStore
+from shared.wire_format import decode_frame, encode_frame, is_frame
+
+
+def sky():
+    return SyntheticSky(300, 20, surveillance_fraction=0.2, landing_fraction=0.2, mean_lifetime=600, seed=7)
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_frame_decodes_to_the_json_snippets(scripts, compress):
+    converter, consumer = scripts
+    synthetic = sky()
+    for _ in range(3):
+        snapshot = synthetic.snapshot()
+        as_json = [json.loads(json.dumps(snippet)) for flight_id, snippet in converter.flight_snippets(snapshot['acList'])]
+        frame = encode_frame([snippet for flight_id, snippet in converter.flight_snippets(snapshot['acList'], True)], compress)
+        assert is_frame(frame)
+        assert len(as_json) > 0
+        assert decode_frame(frame) == as_json
+
+
+def run_pipeline(index_path, use_snippet_frames, polls=12):
+    """Tracked and archived flights after scanning and consuming polls of the synthetic sky."""
+    converter = load_script('converter', 'converter.py')
+    consumer = load_script('queue_consumer', 'queue-consumer.py')
+    converter.use_snippet_frames = use_snippet_frames
+    converter.frame_batch_size = 64  # several frames per queue
+    converter.build_geofence()
+    consumer.airport_index = AirportIndex(index_path)
+    channel = MemoryChannel()
+    converter.connect_channel(channel)
+    data = MemoryRedisData()
+    r = MemoryRedis(data, decode_responses=True)
+    updater = CachedFlightUpdater(TrackStore(MemoryRedis(data)), False)
+    dbmongo = MemoryMongo()
+    synthetic = sky()
+    for _ in range(polls):
+        converter.flight_snapshot_scanner(synthetic.snapshot())
+        converter.flush_snippet_batch()
+        for queue in list(channel.queues):
+            for method, properties, body in channel.drain(queue):
+                consumer.callback(channel, method, properties, body, r, updater, dbmongo)
+        updater.flush()
+        consumer.clean_stale_flights(synthetic.time + stale_age - 120, r, updater, dbmongo)  # gone for two minutes
+
+    def comparable(flights):
+        return sorted((dict((key, value) for key, value in flight_dict.items() if key not in ('Version', '_id'))
+                       for flight_dict in flights), key=lambda flight_dict: (flight_dict['Icao'], flight_dict['LastSeen']))
+
+    tracked = updater.load_many(r.zrange('flight_scan_times', 0, -1))
+    return comparable(tracked), comparable(dbmongo.flighthistory.documents)
+
+
+def test_frames_and_json_messages_merge_to_the_same_flights(tmp_path):
+    index_path = str(tmp_path / 'airports.idx')
+    build_index(sky().airports(), index_path)
+    tracked_frames, archived_frames = run_pipeline(index_path, 1)
+    tracked_json, archived_json = run_pipeline(index_path, 0)
+    assert len(tracked_frames) > 0 and len(archived_frames) > 0
+    assert any(flight_dict['FlightStatus'] == 'Landed' for flight_dict in archived_frames)
+    assert tracked_frames == tracked_json
+    assert archived_frames == archived_json
+
+
+class NackingChannel(MemoryChannel):
+    """A channel acting like pika 1.x in confirm mode: basic_publish returns None, and raises for the first nacks."""
+
+    def __init__(self, nacks):
+        MemoryChannel.__init__(self)
+        self.nacks = nacks
+        self.attempts = 0
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.attempts += 1
+        if self.attempts <= self.nacks:
+            raise pika.exceptions.NackError([])
+        MemoryChannel.basic_publish(self, exchange, routing_key, body, properties)
+        return None
+
+
+@pytest.mark.parametrize('nacks, published', [(0, True), (2, True), (3, False)])
+def test_publishes_are_retried_only_when_nacked(scripts, nacks, published):
+    converter, consumer = scripts
+    converter.channel = NackingChannel(nacks)
+    assert converter.enqueue_flight_snippet(b'frame', routing_key='q') == published
+    assert converter.channel.attempts == min(nacks + 1, converter.publish_attempts)
+    assert len(converter.channel.queues['q']) == int(published)
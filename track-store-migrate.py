@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One-off conversion of flights stored by older consumers, as one whole-flight
+JSON string under the bare <Icao> key, into the track:<Icao> / flight:<Icao>
+layout of shared/track_store.py.
+
+The new consumers never read the old keys, so run this once with the consumers
+and the stale sweeper stopped, before starting the new ones; otherwise the old
+flights are left behind in redis and their sorted set entries are removed as
+orphans by the next stale sweep. Every Icao in flight_scan_times or
+surveillance_score whose old key holds a flight is stored again with a
+versioned create and its old key deleted. An Icao already stored in the new
+layout keeps what it has and its old key is left alone, to be looked at.
+"""
+
+import json
+import sys
+
+import redis
+
+from shared.flight_update import FlightUpdater
+from shared.track_store import TrackStore
+
+redis_host = 'localhost'
+redis_port = 6379
+use_redis_scripts = 1  # 0 commits with WATCH/MULTI instead of Lua
+chunk_size = 500  # flights read per round trip
+
+
+def legacy_flight(value):
+    """The flight dict in an old <Icao> value, or None if the value is not one."""
+    try:
+        flight_dict = json.loads(value.decode() if isinstance(value, bytes) else value)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(flight_dict, dict) or 'Icao' not in flight_dict or 'geometry' not in flight_dict:
+        return None
+    coordinates = flight_dict['geometry']['coordinates']
+    if len(coordinates) > 0:
+        # fields newer consumers keep that old flights never had
+        flight_dict.setdefault('TimeWatermark', max(coordinate[3] for coordinate in coordinates))
+        flight_dict.setdefault('HotSince', coordinates[0][3])
+    return flight_dict
+
+
+def migrate(updater, chunk_size=chunk_size):
+    """Converts every old-format flight; returns (flights converted, old keys left because the flight was already stored)."""
+    r = updater.store.r
+    icaos = sorted(set(r.zrange('flight_scan_times', 0, -1)) | set(r.zrange('surveillance_score', 0, -1)))
+    icaos = [icao.decode() if isinstance(icao, bytes) else icao for icao in icaos]
+    converted = 0
+    left = 0
+    for start in range(0, len(icaos), chunk_size):
+        chunk = icaos[start:start + chunk_size]
+        pipe = r.pipeline(transaction=False)
+        for icao in chunk:
+            pipe.get(icao)
+        values = pipe.execute()
+        for icao, value in zip(chunk, values):
+            flight_dict = legacy_flight(value) if value is not None else None
+            if flight_dict is None:
+                continue
+            if updater.create(flight_dict):
+                r.delete(icao)
+                converted += 1
+            else:
+                left += 1
+    return converted, left
+
+
+if __name__ == '__main__':
+    host = sys.argv[1] if len(sys.argv) > 1 else redis_host
+    updater = FlightUpdater(TrackStore(redis.StrictRedis(host=host, port=redis_port, db=0)), use_redis_scripts == 1)
+    converted, left = migrate(updater)
+    print("Converted", converted, "flights to the packed track layout;", left, "old keys left where the flight was already stored")
@@ -9,6 +9,163 @@
 //   id: 'mapbox.streets'
 // }).addTo(mymap);
 
+// decodes an encoded polyline (quantised, delta-encoded lat/lon) into leaflet latlngs
+function decode_polyline(encoded, precision) {
+    var factor = Math.pow(10, precision);
+    var latlngs = [];
+    var index = 0, lat = 0, lng = 0;
+    while (index < encoded.length) {
+        var deltas = [];
+        for (var n = 0; n < 2; n++) {
+            var value = 0, shift = 0, chunk;
+            do {
+                chunk = encoded.charCodeAt(index++) - 63;
+                value |= (chunk & 0x1f) << shift;
+                shift += 5;
+            } while (chunk >= 0x20);
+            deltas.push((value & 1) ? ~(value >> 1) : (value >> 1));
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        latlngs.push([lat / factor, lng / factor]);
+    }
+    return latlngs;
+}
+
+// index of the level of detail to draw at a zoom level
+function bundle_level(levels, zoom) {
+    var level = 0;
+    for (var i = 0; i < levels.length; i++) {
+        if (zoom >= levels[i]) {
+            level = i;
+        }
+    }
+    return level;
+}
+
+var snapshot_poll_interval = 60000;  // ms, the converter's polling interval
+var flight_renderer = L.canvas();  // one canvas for every track instead of an SVG path each
+var snapshot = null;  // what is drawn: timestamp, levels and the aircraft by Icao
+
+// latlngs of an aircraft at a level of detail: its bundle track followed by any tail added from deltas
+function aircraft_latlngs(aircraft, level) {
+    if (!(level in aircraft.decoded)) {
+        aircraft.decoded[level] = decode_polyline(aircraft.tracks[level], snapshot.precision);
+    }
+    return aircraft.decoded[level].concat(aircraft.tail);
+}
+
+function add_aircraft(flights, icao, score, tracks) {
+    var aircraft = {
+        score: score,
+        tracks: tracks,
+        decoded: {},
+        tail: []
+    };
+    aircraft.line = L.polyline(aircraft_latlngs(aircraft, snapshot.level), {
+        color: 'red',
+        renderer: flight_renderer
+    }).on('click', function(e) {
+        e.target.setStyle({
+            color: 'blue'
+        });
+    }).bindPopup(icao);
+    snapshot.aircraft[icao] = aircraft;
+    flights.addLayer(aircraft.line);
+}
+
+// draws every flight of a snapshot bundle, replacing whatever was drawn
+function draw_bundle(bundle, flights) {
+    flights.clearLayers();
+    snapshot = {
+        timestamp: bundle.TimeStamp,
+        precision: bundle.Precision,
+        levels: bundle.Levels,
+        level: bundle_level(bundle.Levels, mymap.getZoom()),
+        aircraft: {}
+    };
+    for (var i = 0; i < bundle.Aircraft.length; i++) {
+        add_aircraft(flights, bundle.Aircraft[i].Icao, bundle.Aircraft[i].Score, bundle.Aircraft[i].Tracks);
+    }
+}
+
+// patches the drawn flights with the changes since the drawn snapshot
+function apply_delta(delta, flights) {
+    for (var i = 0; i < delta.Removed.length; i++) {
+        if (delta.Removed[i] in snapshot.aircraft) {
+            flights.removeLayer(snapshot.aircraft[delta.Removed[i]].line);
+            delete snapshot.aircraft[delta.Removed[i]];
+        }
+    }
+    for (var i = 0; i < delta.Added.length; i++) {
+        var tracks = snapshot.levels.map(function() {
+            return delta.Added[i].Track;  // full detail at every zoom until the next bundle is loaded
+        });
+        add_aircraft(flights, delta.Added[i].Icao, delta.Added[i].Score, tracks);
+    }
+    for (var i = 0; i < delta.Updated.length; i++) {
+        var aircraft = snapshot.aircraft[delta.Updated[i].Icao];
+        if (aircraft === undefined) {
+            continue;
+        }
+        if ('Score' in delta.Updated[i]) {
+            aircraft.score = delta.Updated[i].Score;
+        }
+        if ('Tail' in delta.Updated[i]) {
+            var tail = decode_polyline(delta.Updated[i].Tail, delta.Precision);
+            for (var j = 0; j < tail.length; j++) {
+                aircraft.tail.push(tail[j]);
+                aircraft.line.addLatLng(tail[j]);
+            }
+        }
+    }
+    snapshot.timestamp = delta.TimeStamp;
+}
+
+// brings the drawn flights up to the latest snapshot, from its delta when it follows the drawn one
+function poll_snapshot(flights) {
+    $.ajax({url: 'latest.json', dataType: 'json', cache: false}).done(function(latest) {
+        if (snapshot !== null && latest.TimeStamp == snapshot.timestamp) {
+            return;
+        }
+        if (snapshot !== null && latest.Delta) {
+            $.getJSON(latest.Delta, function(delta) {
+                if (delta.Previous !== null && delta.Previous == snapshot.timestamp) {
+                    apply_delta(delta, flights);
+                } else {
+                    $.getJSON(latest.Bundle, function(bundle) {
+                        draw_bundle(bundle, flights);
+                    });
+                }
+            });
+        } else {
+            $.getJSON(latest.Bundle, function(bundle) {
+                draw_bundle(bundle, flights);
+            });
+        }
+    });
+}
+
+// draws the latest bundle, then keeps it current from the delta published at each marker
+function follow_snapshots(flights) {
+    poll_snapshot(flights);
+    setInterval(function() {
+        poll_snapshot(flights);
+    }, snapshot_poll_interval);
+    mymap.on('zoomend', function() {
+        if (snapshot === null) {
+            return;
+        }
+        var level = bundle_level(snapshot.levels, mymap.getZoom());
+        if (level != snapshot.level) {
+            snapshot.level = level;
+            for (var icao in snapshot.aircraft) {
+                snapshot.aircraft[icao].line.setLatLngs(aircraft_latlngs(snapshot.aircraft[icao], level));
+            }
+        }
+    });
+}
+
 function get_aircraft_list() {
     // get list of aircraft
     var latest_timestamp;
@@ -20,6 +177,16 @@ function get_aircraft_list() {
     var latest_json_promise = $.getJSON('latest.json');
     latest_json_promise.done(function(data) {
         latest_timestamp = data.TimeStamp;
+        var overlay_flights = {
+            "Flights": flights
+        };
+        if (data.Bundle) {
+            // every flight in one request
+            follow_snapshots(flights);
+            flights.addTo(mymap);
+            L.control.layers(null, overlay_flights).addTo(mymap);
+            return;
+        }
         //console.log(latest_timestamp);
         aircraft_list_promise = $.getJSON(latest_timestamp + '/aircraft_list_' + latest_timestamp + '.json');
         aircraft_list_promise.done(function(data) {
@@ -31,7 +198,9 @@ function get_aircraft_list() {
             for (var i = 0; i < aircraft_array_length; i++) {
                 //console.log(data.Aircraft[i][0]);
                 icao = data.Aircraft[i][0]
-                $.getJSON(latest_timestamp + '/' + icao + '_' + latest_timestamp + '.json', function(data) {
+                // flights that did not change since an earlier snapshot point at the file published then
+                var flight_file = (data.Files && data.Files[icao]) || (latest_timestamp + '/' + icao + '_' + latest_timestamp + '.json');
+                $.getJSON(flight_file, function(data) {
                     //console.log(data['geometry'])
                     flights.addLayer(L.geoJSON(data['geometry'], {
                         style: {